@@ -1,150 +1,208 @@
 import MathTools
-import vtk, qt, ctk, slicer
+import MeshTools
+import MeshCache
+import VolumeTools
+import DistanceField
+import TrajectorySet
+import ConstraintPipeline
+import ParallelPlanner
+import Instrumentation
+import HierarchicalPlanner
+import TrajectoryRanking
+import TrajectoryFile
+import OccupancyPyramid
+import vtk
 import numpy as np
 
-def combineConstraints(entriesAndTargets, ventricles, vessels, cortex, validAngleOfIntersection):
-    validTrajectories = 0
-    paths = {}
-    ventriclesTree, _ = getTree(ventricles)
-    vesselTree, _ = getTree(vessels)
-    cortexTree, cortexPolyData = getTree(cortex, (0, 0.5))
-    for entry, targets in entriesAndTargets.items():
-        for target in targets:
-            if pointsIntersect(ventriclesTree, entry, target):
-                continue
-            if pointsIntersect(vesselTree, entry, target):
-                continue
-            if not hasIntersectionValidAngle(cortexPolyData, cortexTree, entry, target,validAngleOfIntersection):
-                continue
-            key = tuple(entry)
-            if key in paths:
-                paths[key].append(target)
-            else:
-                paths[key] = [target]
-            validTrajectories += 1
+def combineConstraints(entriesAndTargets, ventricles, vessels, cortex, validAngleOfIntersection, collisionMode='mesh', workers=1):
+    result = runConstraintPipeline(entriesAndTargets, ventricles, vessels, cortex, validAngleOfIntersection, collisionMode, workers=workers)
+    Instrumentation.count('validTrajectories', len(result.trajectories))
+    return result.trajectories
 
-    print('Valid Trajectories: ', validTrajectories)
-    return paths
 
+def runConstraintPipeline(entriesAndTargets, ventricles, vessels, cortex, validAngleOfIntersection, collisionMode='mesh', reorder=True, workers=1, hierarchical=False, normalMode='face', prefilters=()):
+    # prefilters (see buildPrefilters) run over every pair first, the result reports them as its first stages
+    trajectories = TrajectorySet.asTrajectorySet(entriesAndTargets)
+    if prefilters:
+        valid, stages = ConstraintPipeline.runPrefilters(trajectories, prefilters)
+        result = runConstraintPipeline(trajectories.filter(valid), ventricles, vessels, cortex, validAngleOfIntersection,
+                                       collisionMode, reorder, workers, hierarchical, normalMode)
+        return result.prepend(stages, valid)
+    if workers != 1:
+        if hierarchical:
+            raise ValueError('hierarchical runs in one process, it needs workers=1')
+        return ParallelPlanner.parallelConstraintPipeline(trajectories, ventricles, vessels, cortex,
+                                                          validAngleOfIntersection, collisionMode, reorder, workers, normalMode)
+    constraints = buildConstraints(ventricles, vessels, cortex, validAngleOfIntersection, collisionMode, normalMode)
+    if hierarchical:
+        # clusters of entries and targets are tested together, only the unclear blocks pair by pair;
+        # the block tests always run in the order of buildConstraints, as with reorder=False
+        return HierarchicalPlanner.hierarchicalConstraints(
+            trajectories, [('ventricles', ventricles), ('vessels', vessels)], constraints[2],
+            lambda area, entries, targets: areaIntersectBatch(area, entries, targets, collisionMode))
+    return ConstraintPipeline.ConstraintPipeline(constraints, reorder=reorder).run(trajectories)
 
-# this function was given by Rachel Sparks
-def printEntryAndTargetsInDict(entriesAndTargets):
-    # we are going to create a poly data defined by a set of points and lines
-    points = vtk.vtkPoints()  # these are our end/start points
-    lines = vtk.vtkCellArray()  # these are the lines connecting them
-    for entry, targets in entriesAndTargets.items():
-        entryId = points.InsertNextPoint(entry[0], entry[1], entry[2])
-        for target in targets:
-            targetInd = points.InsertNextPoint(target[0], target[1], target[2])
 
-            # how to connect my points
-            line = vtk.vtkLine()
-            line.GetPointIds().SetId(0, entryId)
-            line.GetPointIds().SetId(1, targetInd)
-            lines.InsertNextCell(line)
+def buildConstraints(ventricles, vessels, cortex, validAngleOfIntersection, collisionMode='mesh', normalMode='face'):
+    # surfaces and cortex normals are built here so that calibration only times the pair tests
+    # normalMode is 'face', 'smooth' or 'vertex' (see MeshTools.intersectionNormals)
+    if collisionMode == 'mesh':
+        getTriangleGrid(ventricles)
+        getTriangleGrid(vessels)
+    cortexGrid = getTriangleGrid(cortex, (0, 0.5), normals=True)
+    # segments outside the bounds of a structure skip its collision test
+    return [
+        ConstraintPipeline.Constraint('ventricles', lambda entries, targets: ~areaIntersectBatch(ventricles, entries, targets, collisionMode),
+                                      obstacleBounds(ventricles, collisionMode)),
+        ConstraintPipeline.Constraint('vessels', lambda entries, targets: ~areaIntersectBatch(vessels, entries, targets, collisionMode),
+                                      obstacleBounds(vessels, collisionMode)),
+        ConstraintPipeline.Constraint('cortexAngle', lambda entries, targets: validAngleMask(cortexGrid, entries, targets, validAngleOfIntersection, normalMode)),
+    ]
 
-    myPaths = vtk.vtkPolyData()
-    myPaths.SetPoints(points)
-    myPaths.SetLines(lines)
-    return myPaths
+def obstacleBounds(area, collisionMode='mesh'):
+    # RAS box of what the collision test of collisionMode can hit, None for an empty structure
+    if collisionMode == 'mesh':
+        return getTriangleGrid(area).bounds()
+    return VolumeTools.occupiedRASBounds(VolumeTools.getLabelArray(area), VolumeTools.getRASToIJK(area))
+
+def buildPrefilters(maximumIncisionValue, cortex=None, approachAngle=None):
+    """Cheap tests on the coordinates that run before any surface query. The incision
+    length one only drops pairs the scoring would drop. approachAngle (degrees, with
+    cortex) also drops the pairs more than approachAngle away from the cortex normal
+    nearest their entry, an approximation of the angle check left off by default.
+    """
+    prefilters = [ConstraintPipeline.Constraint('incisionLength', lambda entries, targets: (
+        MathTools.getDistancesBetweenPoints(entries, targets) <= maximumIncisionValue) & (maximumIncisionValue > 0.00))]
+    if approachAngle is not None and cortex is not None:
+        cortexGrid = getTriangleGrid(cortex, (0, 0.5))
+        prefilters.append(ConstraintPipeline.Constraint(
+            'approachCone', lambda entries, targets: MeshTools.approachMask(cortexGrid, entries, targets, approachAngle)))
+    return prefilters
+
+
+def dictToArrays(entriesAndTargets):
+    trajectories = TrajectorySet.asTrajectorySet(entriesAndTargets)
+    return trajectories.entryPoints(), trajectories.targetPoints()
+
+
+# the first version of this function, with two new points per line, was given by Rachel Sparks;
+# the lines are now built by trajectoriesPolyData
+def printEntryAndTargetsInDict(entriesAndTargets):
+    with Instrumentation.span('resultExport', entries=len(entriesAndTargets)):
+        return trajectoriesPolyData(entriesAndTargets)
+
+def trajectoriesPolyData(entriesAndTargets, scalars=None, scores=None, topPerEntry=None):
+    """One line per trajectory between points shared by every trajectory of the same entry
+    or target. scalars is an optional list of (name, values) with one value per trajectory
+    for colour mapping. With scores, topPerEntry keeps only the best topPerEntry lines of
+    each entry (a level of detail for large plans).
+    """
+    trajectories = TrajectorySet.asTrajectorySet(entriesAndTargets)
+    rows = np.arange(len(trajectories))
+    if topPerEntry is not None and scores is not None:
+        rows = np.sort(TrajectoryRanking.topRowsPerEntry(trajectories.pairs[:, 0], scores, topPerEntry))
+    pairs = trajectories.pairs[rows]
+    # only the entries and targets that keep a line become points, targets after the entries
+    usedEntries, entryPoints = np.unique(pairs[:, 0], return_inverse=True)
+    usedTargets, targetPoints = np.unique(pairs[:, 1], return_inverse=True)
+    points = np.concatenate([trajectories.entries[usedEntries], trajectories.targets[usedTargets]])
+    lines = np.stack([entryPoints.ravel(), targetPoints.ravel() + len(usedEntries)], axis=1)
+    cellScalars = [(name, np.asarray(values, dtype=np.float64).ravel()[rows]) for name, values in (scalars or [])]
+    return MeshTools.linesPolyData(points, lines, cellScalars)
 
 def entriesAndTargetsInDict(entriesNode, targetsPoints):
     paths = {}
-    for i in range(0, int(entriesNode.GetNumberOfMarkups())):
-        entry = MathTools.getCoordinates(entriesNode, i)
-        for target in targetsPoints:
-            key = tuple(entry)
-            if key in paths:
-                paths[key].append(target)
-            else:
-                paths[key] = [target]
+    for entry in MathTools.getCoordinatesArray(entriesNode).tolist():
+        key = tuple(entry)
+        if key in paths:
+            paths[key].extend(targetsPoints)
+        else:
+            paths[key] = list(targetsPoints)
 
     return paths
 
+def entriesAndTargetsSet(entriesNode, targetsPoints):
+    return TrajectorySet.TrajectorySet.fromProduct(MathTools.getCoordinatesArray(entriesNode), targetsPoints)
+
 def convertMarkupNodeToPoints(markupNode):
-    newTargets = []
-    for i in range(0, int(markupNode.GetNumberOfMarkups())):
-        target = MathTools.getCoordinates(markupNode, i)
-        newTargets.append(target)
-    return newTargets
+    return MathTools.getCoordinatesArray(markupNode).tolist()
 
 
 def getValidTargets(targetsNode, hippo):
-    pointsRejected = 0
-    newTargets = []
-    [xmax, ymax, zmax] = hippo.GetImageData().GetDimensions()
-    subsampleFactor = 1
+    targets = MathTools.getCoordinatesArray(targetsNode)
+    keptIndices, stats = getValidTargetIndices(targets, hippo)
+    Instrumentation.count('rejectedPoints', stats['rejected'])
+    return targets[keptIndices].tolist()
 
-    for i in range(0, int(targetsNode.GetNumberOfMarkups())):
-        target = MathTools.getCoordinates(targetsNode, i)
-        imageVoxelID = hippo.GetImageData().FindPoint(target[0], target[1], target[2])
+def getValidTargetIndices(targets, hippo):
+    with Instrumentation.span('targetFilter', pairsIn=len(targets)) as counters:
+        values, inside = VolumeTools.labelsAtPoints(hippo, targets)
+        keptIndices = np.nonzero(values != 0)[0]
+        counters['pairsOut'] = len(keptIndices)
+    stats = {'total': len(targets), 'kept': len(keptIndices), 'rejected': len(targets) - len(keptIndices),
+             'outsideVolume': int((~inside).sum())}
+    return keptIndices, stats
 
-        xIndex = int(imageVoxelID%xmax)
-        yIndex = int(imageVoxelID%(xmax*ymax)/xmax)
-        zIndex = int((imageVoxelID/(xmax*ymax)))
+def getIncisionsWithValidArea(entriesAndTargets, area, collisionMode='mesh'):
+    trajectories = TrajectorySet.asTrajectorySet(entriesAndTargets)
+    hits = areaIntersectBatch(area, trajectories.entryPoints(), trajectories.targetPoints(), collisionMode)
+    Instrumentation.count('rejectedTrajectories.' + area.GetName(), int(hits.sum()))
+    return trajectories.filter(~hits)
 
-        if hippo.GetImageData().GetScalarComponentAsDouble(xIndex, yIndex, zIndex, 0) != 0:
-            newTargets.append(target)
-        else:
-            pointsRejected += 1
-    print('Rejected Points: ',pointsRejected)
-    return newTargets
+def areaIntersectBatch(area, entries, targets, collisionMode='mesh'):
+    if collisionMode == 'voxel':
+        return voxelIntersectBatch(area, entries, targets)
+    if collisionMode == 'pyramid':
+        return OccupancyPyramid.pyramidIntersectBatch(area, entries, targets)
+    if collisionMode == 'mesh':
+        return pointsIntersectBatch(getTriangleGrid(area), entries, targets)[0]
+    raise ValueError('Unknown collision mode: ' + str(collisionMode))
 
-def getIncisionsWithValidArea(entriesAndTargets, area):
-    paths = {}
-    trajectoriesRejected = 0
-    tree, _ = getTree(area)
-    for entry, targets in entriesAndTargets.items():
-        for target in targets:
-            if not pointsIntersect(tree, entry, target):
-                key = tuple(entry)
-                if key in paths:
-                    paths[key].append(target)
-                else:
-                    paths[key] = [target]
-            else:
-                trajectoriesRejected += 1
-    print('Rejected Trajectories:',trajectoriesRejected)
-    return paths
+def voxelIntersectBatch(area, entryPoints, targetPoints):
+    labels = VolumeTools.getLabelArray(area)
+    start = VolumeTools.rasToIJK(area, entryPoints)
+    end = VolumeTools.rasToIJK(area, targetPoints)
+    hits, _ = VolumeTools.firstOccupiedVoxel(labels, start, end)
+    return hits
+
+def collisionAgreement(entriesAndTargets, area):
+    entries, targets = dictToArrays(entriesAndTargets)
+    if len(entries) == 0:
+        return 1.0
+    meshHits = areaIntersectBatch(area, entries, targets, 'mesh')
+    voxelHits = areaIntersectBatch(area, entries, targets, 'voxel')
+    return float(np.mean(meshHits == voxelHits))
+
+def getSurface(area, value=None):
+    return MeshCache.defaultCache.getSurface(area, value).polyData
 
 def getTree(area, value=None):
-    if value is not None:
-        mesh = vtk.vtkMarchingCubes()
-        mesh.SetInputData(area.GetImageData())
-        mesh.SetValue(value[0], value[1])
-    else:
-        mesh = vtk.vtkDiscreteMarchingCubes()
-        mesh.SetInputData(area.GetImageData())
-    mesh.Update()
-    polyData = mesh.GetOutput()
-    tree = vtk.vtkOBBTree()
-    tree.SetDataSet(polyData)
-    tree.BuildLocator()
-    return tree, polyData
+    surface = MeshCache.defaultCache.getSurface(area, value)
+    return surface.getOBBTree(), surface.polyData
+
+def getTriangleGrid(area, value=None, normals=False):
+    return MeshCache.defaultCache.getSurface(area, value).getTriangleGrid(normals)
 
 def pointsIntersect(tree, entryPoint, targetPoint):
+    Instrumentation.count('vtkCalls.IntersectWithLine')
     pointsWithinTriangle = vtk.vtkPoints()
     pointsIdInTriangle = vtk.vtkIdList()
     if tree.IntersectWithLine(entryPoint, targetPoint, pointsWithinTriangle, pointsIdInTriangle) != 0:
         return True
     return False
 
+def pointsIntersectBatch(grid, entryPoints, targetPoints):
+    return MeshTools.intersectSegments(grid, entryPoints, targetPoints)
+
 def getIncisionsWithValidAngle( entriesAndTargets, cortex, validAngleOfIntersection):
-    paths = {}
-    trajectoriesRejected = 0
-    tree, polyData = getTree(cortex, (0, 0.5))
-    for entry, targets in entriesAndTargets.items():
-        for target in targets:
-            if hasIntersectionValidAngle(polyData, tree, entry, target, validAngleOfIntersection):
-                key = tuple(entry)
-                if key in paths:
-                    paths[key].append(target)
-                else:
-                    paths[key] = [target]
-            else:
-                trajectoriesRejected += 1
-    print('Rejected Trajectories:',trajectoriesRejected)
-    return paths
+    trajectories = TrajectorySet.asTrajectorySet(entriesAndTargets)
+    valid = validAngleMask(getTriangleGrid(cortex, (0, 0.5)), trajectories.entryPoints(), trajectories.targetPoints(),
+                           validAngleOfIntersection)
+    Instrumentation.count('rejectedTrajectories.cortexAngle', int((~valid).sum()))
+    return trajectories.filter(valid)
+
+def validAngleMask(cortexGrid, entries, targets, validAngleOfIntersection, normalMode='face'):
+    return MeshTools.validAngleMask(cortexGrid, entries, targets, validAngleOfIntersection, normalMode)
 
 def hasIntersectionValidAngle(polyData, tree, entryPoint, targetPoint, validAngleOfIntersection):
 
@@ -154,7 +212,11 @@ def hasIntersectionValidAngle(polyData, tree, entryPoint, targetPoint, validAngl
     cellIdOfTriangle = vtk.vtkIdList()
     pointsInCell = vtk.vtkIdList()
 
+    Instrumentation.count('vtkCalls.IntersectWithLine')
     tree.IntersectWithLine(entry, target, pointIntersectWithinTriangle, cellIdOfTriangle)
+    # a trajectory that never crosses the cortex has no valid angle
+    if cellIdOfTriangle.GetNumberOfIds() == 0:
+        return False
     intersectionPoint = pointIntersectWithinTriangle.GetPoint(0)
     polyData.GetCellPoints(cellIdOfTriangle.GetId(0), pointsInCell)
 
@@ -163,36 +225,141 @@ def hasIntersectionValidAngle(polyData, tree, entryPoint, targetPoint, validAngl
     return angle < validAngleOfIntersection
 
 
-def printBestTrajectoryForEachEntry(precisionValue, maximumIncisionValue ,entriesAndTargets, *nodes):
-    trees = treesOfNodes(*nodes)
-    pointsByDistance = {}
-    combinedEntriesAndTargets = {}
-    pointsByDistance = dictByMaximumDistanceFromLinesToNode(precisionValue,entriesAndTargets,*trees)
-    for distance in pointsByDistance:
-        vector = MathTools.returnVectorFromPoints(distance[1][0],distance[1][1])
-        incisionDistance = MathTools.magnitudeVector(vector)
-        if incisionDistance <= maximumIncisionValue and maximumIncisionValue > 0.00:
-            key = tuple(distance[1][0])
-            if not key in combinedEntriesAndTargets:
-                combinedEntriesAndTargets[key] = [distance[1][1]]
-            #print(distance)
+def printBestTrajectoryForEachEntry(precisionValue, maximumIncisionValue ,entriesAndTargets, *nodes, **options):
+    import slicer
+    combinedEntriesAndTargets = bestTrajectoryForEachEntry(precisionValue, maximumIncisionValue, entriesAndTargets, *nodes, **options)
     allPaths = printEntryAndTargetsInDict(combinedEntriesAndTargets)
     pathNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode', 'GoodPaths')
     pathNode.SetAndObserveMesh(allPaths)
     return combinedEntriesAndTargets
 
+def printTopTrajectories(topTrajectories):
+    # GoodPaths node of the best target of every entry of a topTrajectoriesPerEntry result
+    import slicer
+    combinedEntriesAndTargets = targetsByEntry(topTrajectories, 1)
+    pathNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode', 'GoodPaths')
+    pathNode.SetAndObserveMesh(printEntryAndTargetsInDict(combinedEntriesAndTargets))
+    return combinedEntriesAndTargets
+
+def bestTrajectoryForEachEntry(precisionValue, maximumIncisionValue ,entriesAndTargets, *nodes, **options):
+    options['k'] = 1
+    return targetsByEntry(topTrajectoriesPerEntry(precisionValue, maximumIncisionValue, entriesAndTargets, *nodes, **options))
+
+def targetsByEntry(topTrajectories, k=None):
+    # {entry: [target, ...]} of a topTrajectoriesPerEntry result, the first k targets of every entry
+    return dict((entry, [target for _, target in scored[:k]]) for entry, scored in topTrajectories.items())
+
+def topTrajectoriesPerEntry(precisionValue, maximumIncisionValue, entriesAndTargets, *nodes, **options):
+    # {entry: [(score, target), ...]} with the k best targets of every entry, entries by decreasing best score
+    # options: k, criterion ('sum', 'min' or 'weighted'), weights, chunkSize, workers, distanceMode
+    trajectories = TrajectorySet.asTrajectorySet(entriesAndTargets)
+    ranking = TrajectoryRanking.TopKPerEntry(options.get('k', 1))
+    ranking.consume((entryIndices, targetIndices, scores) for entryIndices, targetIndices, scores, _ in
+                    scoreTrajectoryChunks(precisionValue, maximumIncisionValue, trajectories.chunks(options.get('chunkSize', 16384)), nodes, **options))
+    return rankingByEntry(ranking, trajectories.entries, trajectories.targets)
+
+def rankedAndTopTrajectories(precisionValue, maximumIncisionValue, entriesAndTargets, *nodes, **options):
+    # (score, [entry, target]) of every trajectory by decreasing score, and topTrajectoriesPerEntry, from one scoring pass
+    # options: those of topTrajectoriesPerEntry plus export, the path of a TrajectoryFile the scored trajectories are
+    #          written to as well, and its metadata
+    trajectories = TrajectorySet.asTrajectorySet(entriesAndTargets)
+    ranking = TrajectoryRanking.TopKPerEntry(options.get('k', 1))
+    pairs, scores = [np.zeros((0, 2), dtype=np.int64)], [np.zeros(0)]
+    writer = trajectoryWriter(options['export'], trajectories, nodes, options.get('metadata')) if options.get('export') else None
+    try:
+        for entryIndices, targetIndices, chunkScores, distances in scoreTrajectoryChunks(
+                precisionValue, maximumIncisionValue, trajectories.chunks(options.get('chunkSize', 16384)), nodes, **options):
+            ranking.push(entryIndices, targetIndices, chunkScores)
+            pairs.append(np.stack([entryIndices, targetIndices], axis=1))
+            scores.append(chunkScores)
+            if writer is not None:
+                writer.write(entryIndices, targetIndices, chunkScores, distances)
+    finally:
+        if writer is not None:
+            writer.close()
+    pairs, scores = np.concatenate(pairs), np.concatenate(scores)
+    entries, targets = trajectories.entries[pairs[:, 0]], trajectories.targets[pairs[:, 1]]
+    ranked = [(float(scores[i]), [entries[i].tolist(), targets[i].tolist()]) for i in np.argsort(-scores, kind='stable')]
+    return ranked, rankingByEntry(ranking, trajectories.entries, trajectories.targets)
+
+def streamTopTrajectoriesPerEntry(precisionValue, maximumIncisionValue, entryPoints, targetPoints, ventricles, vessels, cortex,
+                                  validAngleOfIntersection, collisionMode='mesh', normalMode='face', prefilters=(), **options):
+    """topTrajectoriesPerEntry of every entry x target pair without building the pairs:
+    chunkSize of them at a time are made, go through the constraints, the length test and
+    the scoring and are pushed to the ranking, so memory follows the chunk size and not
+    the number of pairs. targetPoints should already be inside the hippocampus (that test
+    is per target, see getValidTargets). Returns the best trajectories and a
+    PipelineResult with the stages summed over the chunks.
+    """
+    entryPoints = np.asarray(entryPoints, dtype=np.float64).reshape(-1, 3)
+    targetPoints = np.asarray(targetPoints, dtype=np.float64).reshape(-1, 3)
+    chunkSize = options.get('chunkSize', 16384)
+    pipeline = ConstraintPipeline.ConstraintPipeline(
+        buildConstraints(ventricles, vessels, cortex, validAngleOfIntersection, collisionMode, normalMode))
+    # one order for every chunk, calibrated on pairs spread over the whole product rather than on the first entries
+    sample = TrajectorySet.TrajectorySet.fromProductRows(entryPoints, targetPoints,
+                                                          pipeline.samplePairs(len(entryPoints) * len(targetPoints)))
+    order, calibrationSeconds = pipeline.calibratedOrder(sample, prefilters)
+    summary = ConstraintPipeline.PipelineResult(None, [], [], calibrationSeconds, calibrationSeconds)
+
+    def validChunks():
+        for result in pipeline.stream(TrajectorySet.TrajectorySet.productChunks(entryPoints, targetPoints, chunkSize),
+                                      prefilters, order):
+            summary.add(result)
+            yield result.trajectories
+
+    ranking = TrajectoryRanking.TopKPerEntry(options.get('k', 1))
+    ranking.consume((entryIndices, targetIndices, scores) for entryIndices, targetIndices, scores, _ in
+                    scoreTrajectoryChunks(precisionValue, maximumIncisionValue, validChunks(), (vessels, ventricles), **options))
+    return rankingByEntry(ranking, entryPoints, targetPoints), summary
+
+def exportTrajectories(path, precisionValue, maximumIncisionValue, entriesAndTargets, *nodes, **options):
+    # scores the valid trajectories chunk by chunk into a TrajectoryFile, returns the number of pairs written
+    # options: those of topTrajectoriesPerEntry plus metadata, a dict stored in the file header
+    trajectories = TrajectorySet.asTrajectorySet(entriesAndTargets)
+    with Instrumentation.span('resultExport', pairsIn=len(trajectories)) as counters:
+        with trajectoryWriter(path, trajectories, nodes, options.get('metadata')) as writer:
+            for entryIndices, targetIndices, scores, distances in scoreTrajectoryChunks(
+                    precisionValue, maximumIncisionValue, trajectories.chunks(options.get('chunkSize', 16384)), nodes, **options):
+                writer.write(entryIndices, targetIndices, scores, distances)
+        counters['pairsOut'] = writer.numberOfPairs
+    return writer.numberOfPairs
+
+def trajectoryWriter(path, trajectories, nodes, metadata=None):
+    return TrajectoryFile.TrajectoryWriter(path, trajectories.entries, trajectories.targets,
+                                           [node.GetName() for node in nodes], metadata=metadata)
+
+def rankedTrajectories(precisionValue, maximumIncisionValue ,entriesAndTargets, *nodes, **options):
+    # (score, [entry, target]) by decreasing score, without the incisions longer than maximumIncisionValue
+    ranked = []
+    for distance in sortedByMaximumDistanceFromLinesToNodes(precisionValue,entriesAndTargets,*nodes,**options):
+        vector = MathTools.returnVectorFromPoints(distance[1][0],distance[1][1])
+        incisionDistance = MathTools.magnitudeVector(vector)
+        if incisionDistance <= maximumIncisionValue and maximumIncisionValue > 0.00:
+            ranked.append(distance)
+    return ranked
+
+def rankingByEntry(ranking, entries, targets):
+    best = {}
+    for entryIndex, scored in ranking.results().items():
+        best[tuple(entries[entryIndex].tolist())] = [(score, targets[targetIndex].tolist()) for score, targetIndex in scored]
+    return best
+
+def scoreTrajectoryChunks(precisionValue, maximumIncisionValue, chunks, nodes, **options):
+    # (entry indices, target indices, scores, (N,S) distances) of every TrajectorySet of chunks, consumed one at a
+    # time; incisions longer than maximumIncisionValue are skipped before they are scored
+    for chunk in chunks:
+        keep = (MathTools.getDistancesBetweenPoints(chunk.entryPoints(), chunk.targetPoints()) <= maximumIncisionValue) & (maximumIncisionValue > 0.00)
+        if not keep.any():
+            continue
+        chunk = chunk.filter(keep)
+        distances = distanceMatrix(precisionValue, chunk, *nodes, **options)
+        yield chunk.pairs[:, 0], chunk.pairs[:, 1], TrajectoryRanking.combineScores(distances, options.get('criterion', 'sum'), options.get('weights')), distances
 
 def treesOfNodes(*nodes):
     trees = []
     for node in nodes:
-        mesh = vtk.vtkDiscreteMarchingCubes()
-        mesh.SetInputData(node.GetImageData())
-        mesh.Update()
-        polyData = mesh.GetOutput()
-        tree = vtk.vtkCellLocator()
-        tree.SetDataSet(polyData)
-        tree.BuildLocator()
-        trees.append(tree)
+        trees.append(MeshCache.defaultCache.getSurface(node).getCellLocator())
     return trees
 
 def dictByMaximumDistanceFromLinesToNode(precisionValue,entriesAndTargets,*trees):
@@ -208,44 +375,82 @@ def dictByMaximumDistanceFromLinesToNode(precisionValue,entriesAndTargets,*trees
             if key in pointsByDistance.keys():
                 pointsByDistance[key].append([entry,target])
             else:
-                pointsByDistance[key] = [entry,target]
-    sortedPoints = sorted(pointsByDistance.items(), reverse = True)
+                pointsByDistance[key] = [[entry,target]]
+    # trajectories with the same distance are all kept, in the order they were scored
+    sortedPoints = [(key, path) for key, paths in sorted(pointsByDistance.items(), reverse = True) for path in paths]
     return sortedPoints
 
+def sortedByMaximumDistanceFromLinesToNodes(precisionValue,entriesAndTargets,*nodes,**options):
+    # options: workers, number of processes used to score the trajectories
+    #          distanceMode, 'exact' distance to the surfaces or 'sampled' from the distance fields every precisionValue
+    #          criterion and weights, how the distances to the nodes make one score (see TrajectoryRanking.combineScores)
+    entries, targets = dictToArrays(entriesAndTargets)
+    distances = TrajectoryRanking.combineScores(distanceMatrix(precisionValue, entriesAndTargets, *nodes, **options),
+                                                options.get('criterion', 'sum'), options.get('weights'))
+    order = np.argsort(-distances, kind='stable')
+    return [(float(distances[i]), [entries[i].tolist(), targets[i].tolist()]) for i in order]
+
+def distanceMatrix(precisionValue, entriesAndTargets, *nodes, **options):
+    # (N,S) minimum distance from every trajectory to each node, in workers when options has workers != 1
+    # options: workers, distanceMode ('exact' distance to the surfaces or 'sampled' from the distance fields every precisionValue)
+    workers = options.get('workers', 1)
+    distanceMode = options.get('distanceMode', 'exact')
+    trajectories = TrajectorySet.asTrajectorySet(entriesAndTargets)
+    with Instrumentation.span('distanceScoring', pairsIn=len(trajectories), nodes=len(nodes)):
+        if workers != 1:
+            return ParallelPlanner.parallelDistances(trajectories, precisionValue, nodes, workers, distanceMode)
+        entries, targets = trajectories.entryPoints(), trajectories.targetPoints()
+        distances = np.zeros((len(entries), len(nodes)))
+        for index, node in enumerate(nodes):
+            distances[:, index] = distancesFromLinesToNodes(precisionValue, entries, targets, node, distanceMode=distanceMode)
+        return distances
+
+def distancesFromLinesToNodes(precisionValue, entries, targets, *nodes, **options):
+    # per trajectory sum over the nodes of the minimum distance to each node's surface,
+    # precisionValue is only used by the sampled distanceMode
+    distances = np.zeros(len(entries))
+    for node in nodes:
+        if options.get('distanceMode', 'exact') == 'sampled':
+            distances += DistanceField.minimumDistances(node, entries, targets, precisionValue)
+        else:
+            distances += MeshCache.defaultCache.getSurface(node).getBVH().minimumDistances(entries, targets)
+    return distances
+
 def distanceToClosestPointToLine(tree,point1,point2,precision):
-    minDistance = 0
+    minDistance = np.inf
     xEntry, yEntry, zEntry = point1[0], point1[1], point1[2]
     xTarget, yTarget, zTarget = point2[0], point2[1], point2[2]
-    for step in np.arange(0,1,precision):
+    steps = np.arange(0,1,precision)
+    Instrumentation.count('vtkCalls.FindClosestPoint', len(steps))
+    for step in steps:
         x = xEntry + step*(xTarget - xEntry)
         y = yEntry + step*(yTarget - yEntry)
         z = zEntry + step*(zTarget - zEntry)
         testPoint = (x,y,z)
         closestPoint = [0.0,0.0,0.0]
-        vector = MathTools.returnVectorFromPoints(point1, point2)
-        minDistance = MathTools.magnitudeVector(vector)
         ID = 0
         cellId = vtk.reference(ID)
         subId = vtk.reference(ID)
-        closestPointDist2 = vtk.reference(ID)
+        closestPointDist2 = vtk.reference(0.0)
         tree.FindClosestPoint(testPoint, closestPoint, cellId, subId, closestPointDist2)
-        if closestPointDist2 < minDistance:
-            minDistance = closestPointDist2
-        minDistance
+        # FindClosestPoint returns the squared distance
+        distance = np.sqrt(float(closestPointDist2))
+        if distance < minDistance:
+            minDistance = distance
     return minDistance
     
 def addEntriesAndTargetsInDictFromID(entriesID,targetsID):
+    import slicer
     entriesNode = slicer.util.getNode("entries")
     targetsNode = slicer.util.getNode("targets")
+    entries = MathTools.getCoordinatesArray(entriesNode)[list(entriesID)].tolist()
+    targets = MathTools.getCoordinatesArray(targetsNode)[list(targetsID)].tolist()
     paths = {}
-    for i in entriesID:
-        entry = MathTools.getCoordinates(entriesNode, i)
-        for j in targetsID:
-            target = MathTools.getCoordinates(targetsNode,j)
-            key = tuple(entry)
-            if key in paths:
-                paths[key].append(target)
-            else:
-                paths[key] = [target]
+    for entry in entries:
+        key = tuple(entry)
+        if key in paths:
+            paths[key].extend(targets)
+        else:
+            paths[key] = list(targets)
 
-    return paths
\ No newline at end of file
+    return paths
\ No newline at end of file
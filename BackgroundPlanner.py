@@ -0,0 +1,129 @@
+import threading
+import time
+import traceback
+import queue
+import numpy as np
+import vtk
+import Algorithms
+import ConstraintPipeline
+import HeadlessPlanner
+import ParallelPlanner
+import PlanningOptions
+import TrajectorySet
+import VolumeTools
+
+
+class PlanningJob(object):
+    """Runs the planning steps of Task1Logic.run in a worker thread, a chunk of
+    entries at a time. The markup coordinates and the label volumes are copied
+    when the job is created, on the main thread, so the worker never reads a
+    node. Every finished chunk puts the best trajectory of its entries on a queue
+    that the main thread drains with poll(), which is where the MRML nodes get
+    updated. cancel() stops the job after the chunk being processed. options and
+    settings are the PlanningOptions of the run; the worker thread runs the
+    constraints itself, so workers and hierarchical are not used.
+
+    Messages are dicts with a 'type' of 'progress' (done, total, best),
+    'finished' (cancelled, seconds, stages) or 'error' (message).
+    """
+
+    def __init__(self, hippo, ventricles, vessels, cortex, targetPoints, entryPoints, validAngleOfIntersection,
+                 precisionValue, maximumIncisionValue, options=None, chunkSize=4096, **settings):
+        self.hippo = snapshotVolume(hippo)
+        self.ventricles = snapshotVolume(ventricles)
+        self.vessels = snapshotVolume(vessels)
+        self.cortex = snapshotVolume(cortex)
+        self.targetPoints = np.array(targetPoints, dtype=np.float64).reshape(-1, 3)
+        self.entryPoints = np.array(entryPoints, dtype=np.float64).reshape(-1, 3)
+        self.validAngleOfIntersection = validAngleOfIntersection
+        self.precisionValue = precisionValue
+        self.maximumIncisionValue = maximumIncisionValue
+        self.options = PlanningOptions.planningOptions(options, **settings)
+        self.chunkSize = chunkSize
+        self.messages = queue.Queue()
+        self.cancelled = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.execute, name='Task1PlanningJob')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def isRunning(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def wait(self, timeout=None):
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def poll(self):
+        # messages put since the last call, for the main thread
+        messages = []
+        while True:
+            try:
+                messages.append(self.messages.get_nowait())
+            except queue.Empty:
+                return messages
+
+    def execute(self):
+        startTime = time.time()
+        try:
+            stages = self.plan()
+            self.messages.put({'type': 'finished', 'cancelled': self.cancelled.is_set(),
+                               'seconds': time.time() - startTime, 'stages': stages})
+        except Exception:
+            self.messages.put({'type': 'error', 'message': traceback.format_exc()})
+
+    def plan(self):
+        keptIndices, _ = Algorithms.getValidTargetIndices(self.targetPoints, self.hippo)
+        trajectories = TrajectorySet.TrajectorySet.fromProduct(self.entryPoints, self.targetPoints[keptIndices])
+        constraints = Algorithms.buildConstraints(self.ventricles, self.vessels, self.cortex,
+                                                  self.validAngleOfIntersection, self.options.collisionMode,
+                                                  self.options.normalMode)
+        pipeline = ConstraintPipeline.ConstraintPipeline(constraints)
+        # chunks end where the entry changes, so the best trajectory of a chunk's entries is final
+        chunks = ParallelPlanner.entryChunks(trajectories.pairs, max(1, -(-len(trajectories) // self.chunkSize)))
+        stages = {}
+        done = 0
+        # one constraint order for every chunk, calibrated on a sample of all the pairs
+        prefilters = Algorithms.buildPrefilters(self.maximumIncisionValue, self.cortex, self.options.approachAngle)
+        order, _ = pipeline.calibratedOrder(trajectories, prefilters)
+        for result in pipeline.stream(self.chunkSets(trajectories, chunks), prefilters, order):
+            for stage in result.stages:
+                merged = stages.setdefault(stage['name'], dict((key, 0) for key in stage if key != 'name'))
+                for key in merged:
+                    merged[key] += stage[key]
+            best = Algorithms.topTrajectoriesPerEntry(self.precisionValue, self.maximumIncisionValue,
+                                                      result.trajectories, self.vessels, self.ventricles, k=1,
+                                                      criterion=self.options.criterion, weights=self.options.weights,
+                                                      distanceMode=self.options.distanceMode)
+            done += len(result.valid)
+            self.messages.put({'type': 'progress', 'done': done, 'total': len(trajectories),
+                               'best': dict((entry, scored[0]) for entry, scored in best.items())})
+        return stages
+
+    def chunkSets(self, trajectories, chunks):
+        for start, stop in chunks:
+            if self.cancelled.is_set():
+                return
+            yield TrajectorySet.TrajectorySet(trajectories.entries, trajectories.targets, trajectories.pairs[start:stop])
+
+
+def snapshotVolume(volumeNode):
+    # a copy of the voxels and the geometry, under its own ID so the caches never mix it up with the live node
+    imageData = vtk.vtkImageData()
+    imageData.DeepCopy(volumeNode.GetImageData())
+    return HeadlessPlanner.LabelVolume(imageData, VolumeTools.getIJKToRAS(volumeNode), volumeNode.GetName(),
+                                       'BackgroundPlanner.' + volumeNode.GetID())
+
+def mergeBest(best, update):
+    """Adds the {entry: (score, target)} of a progress message to best and returns
+    {entry: [target]} ordered by decreasing score like bestTrajectoryForEachEntry.
+    """
+    best.update(update)
+    order = sorted(best, key=lambda entry: best[entry][0], reverse=True)
+    return dict((entry, [best[entry][1]]) for entry in order)
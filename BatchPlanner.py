@@ -0,0 +1,402 @@
+"""Plans every case of a manifest on a pool of local worker processes:
+
+    python BatchPlanner.py cases.json --output-dir results --workers 4
+
+The manifest is JSON. Paths are relative to its folder and a case takes the
+defaults for every parameter it does not set:
+
+    {"defaults": {"angle": 55.0, "collisionMode": "voxel", "timeLimit": 600, "memoryLimit": 4096},
+     "cases": [{"name": "case01", "dataDir": "case01"},
+               {"name": "case02", "dataDir": "case02", "vessels": "atlas/vessels.nii.gz", "maxLength": 80, "k": 3}]}
+
+Besides angle, precision and maxLength a case takes every PlanningOptions
+setting but workers, each case plans in the one process of its worker.
+
+A worker keeps the volumes it loaded, with the meshes, distance fields and
+occupancy pyramids built from them, and a case goes to the idle worker that
+already loaded most of its files. Meshes are also written to a cache folder
+that every worker reads. timeLimit (seconds) and memoryLimit (megabytes of
+address space on top of what the worker holds) apply to each case; a worker
+that does not return within the time limit is killed and replaced.
+
+Every case writes <output-dir>/<name>/trajectories.csv and summary.json, the
+batch writes <output-dir>/batch.json with the status and timings of each case.
+"""
+import argparse
+import collections
+import json
+import logging
+import multiprocessing.connection
+import os
+import signal
+import sys
+import time
+import traceback
+try:
+    import resource
+except ImportError:
+    resource = None
+import DistanceField
+import HeadlessPlanner
+import Instrumentation
+import MathTools
+import MeshCache
+import OccupancyPyramid
+import ParallelPlanner
+import PlanningOptions
+
+inputFiles = (('hippo', 'r_hippo.nii.gz'), ('ventricles', 'ventricles.nii.gz'), ('vessels', 'vessels.nii.gz'),
+              ('cortex', 'cortex.nii.gz'), ('targets', 'targets.fcsv'), ('entries', 'entries.fcsv'))
+# node names the planner expects, as Task1Test loads them
+nodeNames = {'hippo': 'r_hippo', 'ventricles': 'ventricles', 'vessels': 'vessels', 'cortex': 'cortex',
+             'targets': 'targets', 'entries': 'entries'}
+defaults = {'angle': 55.0, 'precision': 0.01, 'maxLength': 9999999999999.0, 'timeLimit': None, 'memoryLimit': None}
+# the PlanningOptions a case may set, the batch workers are the processes
+optionNames = [name for name in PlanningOptions.PlanningOptions.defaults if name != 'workers']
+
+
+def readManifest(path):
+    """Cases of the manifest at path as dicts with every parameter and the
+    absolute path of each input file, the planning settings are in its options.
+    Raises ValueError for a case that misses an input, sets an unknown key or
+    options that cannot run, or reuses a name.
+    """
+    with open(path) as manifestFile:
+        manifest = json.load(manifestFile)
+    folder = os.path.dirname(os.path.abspath(path))
+    cases = []
+    for index, entry in enumerate(manifest.get('cases', [])):
+        case = dict(defaults)
+        case.update(manifest.get('defaults', {}))
+        case.update(entry)
+        case.setdefault('name', 'case%03d' % index)
+        unknown = set(case) - set(defaults) - set(optionNames) - set(nodeNames) - set(['name', 'dataDir'])
+        if unknown:
+            raise ValueError('case %s has unknown keys: %s' % (case['name'], ', '.join(sorted(unknown))))
+        try:
+            case['options'] = PlanningOptions.PlanningOptions(dict((name, case.pop(name)) for name in optionNames
+                                                                   if name in case))
+        except ValueError as error:
+            raise ValueError('case %s: %s' % (case['name'], error))
+        for key, fileName in inputFiles:
+            value = case.get(key)
+            if not value and case.get('dataDir'):
+                value = os.path.join(case['dataDir'], fileName)
+            if not value:
+                raise ValueError('case %s has no %s and no dataDir' % (case['name'], key))
+            case[key] = os.path.normpath(os.path.join(folder, value))
+        cases.append(case)
+    names = [case['name'] for case in cases]
+    if len(set(names)) != len(names):
+        raise ValueError('case names must be unique')
+    return cases
+
+def inputPaths(case):
+    return set(case[key] for key, _ in inputFiles)
+
+
+class CaseTimeout(Exception):
+    pass
+
+def raiseTimeout(signalNumber, frame):
+    raise CaseTimeout()
+
+
+class WorkerMeshCache(MeshCache.MeshCache):
+    """The mesh cache of a worker. The time limit is held back while an entry is
+    written, so a case that runs out of time still leaves a whole entry on disk.
+    """
+
+    def writeToDisk(self, key, surface):
+        if not hasattr(signal, 'pthread_sigmask'):
+            return MeshCache.MeshCache.writeToDisk(self, key, surface)
+        previous = signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGALRM])
+        try:
+            return MeshCache.MeshCache.writeToDisk(self, key, surface)
+        finally:
+            # a timer that went off during the write raises here
+            signal.pthread_sigmask(signal.SIG_SETMASK, previous)
+
+def addressSpaceBytes():
+    # size of the address space of this process (Linux)
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[0]) * resource.getpagesize()
+
+def limitMemory(megabytes):
+    # lowers the soft address space limit to megabytes above the current size, returns the soft limit to restore
+    if not megabytes or resource is None:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    limit = addressSpaceBytes() + int(megabytes * 1024 * 1024)
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+    return soft
+
+def restoreMemory(soft):
+    if soft is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (soft, resource.getrlimit(resource.RLIMIT_AS)[1]))
+
+
+class VolumeStore(object):
+    """Loaded volumes and fiducials of a worker, by path and file modification time.
+    A file loaded again keeps its node (and node ID), so the caches keyed by node
+    reuse what was built from it. The oldest entries are dropped with their caches.
+    """
+
+    def __init__(self, maximumEntries=24):
+        self.maximumEntries = maximumEntries
+        self.nodes = collections.OrderedDict()
+        self.hits = 0
+        self.loads = 0
+
+    def get(self, key, path):
+        status = os.stat(path)
+        storeKey = (key, path, status.st_mtime, status.st_size)
+        if storeKey in self.nodes:
+            self.hits += 1
+            self.nodes.move_to_end(storeKey)
+            return self.nodes[storeKey]
+        self.loads += 1
+        nodeID = 'BatchPlanner.%s.%d' % (nodeNames[key], self.loads)
+        if path.endswith('.fcsv'):
+            node = HeadlessPlanner.loadFiducials(path, nodeNames[key], nodeID)
+        else:
+            node = HeadlessPlanner.loadLabelVolume(path, nodeNames[key], nodeID)
+        self.nodes[storeKey] = node
+        while len(self.nodes) > self.maximumEntries:
+            self.forget(self.nodes.popitem(last=False)[1])
+        return node
+
+    @staticmethod
+    def forget(node):
+        for cache in (DistanceField.fieldCache, OccupancyPyramid.pyramidCache, MathTools.coordinatesCache):
+            cache.pop(node.GetID(), None)
+
+
+def planCase(case, store):
+    startTime = time.time()
+    nodes = dict((key, store.get(key, case[key])) for key, _ in inputFiles)
+    loadSeconds = time.time() - startTime
+    ranked, best, result = HeadlessPlanner.plan(
+        nodes['hippo'], nodes['ventricles'], nodes['vessels'], nodes['cortex'], nodes['targets'], nodes['entries'],
+        case['angle'], case['precision'], case['maxLength'], case['options'])
+    planSeconds = time.time() - startTime - loadSeconds
+    directory = os.path.join(case['outputDirectory'], case['name'])
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    HeadlessPlanner.writeTrajectories(os.path.join(directory, 'trajectories.csv'), ranked, best)
+    return {'loadSeconds': loadSeconds, 'planSeconds': planSeconds, 'writeSeconds': time.time() - startTime - loadSeconds - planSeconds,
+            'rankedTrajectories': len(ranked), 'entriesWithTrajectory': len(best), 'constraints': result.asDict(),
+            'options': case['options'].asDict()}
+
+def runCase(case, store):
+    # runs in a worker, failures become the status of the result
+    result = {'name': case['name'], 'status': 'ok', 'pid': os.getpid()}
+    recorder = Instrumentation.Recorder()
+    loads, hits = store.loads, store.hits
+    startTime = time.time()
+    previousLimit = None
+    try:
+        try:
+            previousLimit = limitMemory(case['memoryLimit'])
+            if case['timeLimit']:
+                signal.setitimer(signal.ITIMER_REAL, case['timeLimit'])
+            with Instrumentation.recording(recorder):
+                result.update(planCase(case, store))
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            restoreMemory(previousLimit)
+    except CaseTimeout:
+        result['status'] = 'timeout'
+    except MemoryError:
+        result['status'] = 'memoryLimit'
+    except Exception:
+        result['status'] = 'error'
+        result['error'] = traceback.format_exc()
+    result['seconds'] = time.time() - startTime
+    result['filesLoaded'] = store.loads - loads
+    result['filesReused'] = store.hits - hits
+    result['meshCache'] = MeshCache.defaultCache.statistics()
+    result['loadedPaths'] = storedPaths(store)
+    result['workerMaximumResidentBytes'] = Instrumentation.maximumResidentBytes()
+    result['instrumentation'] = {'totals': recorder.totals(), 'counters': dict(recorder.counters)}
+    return result
+
+def workerMain(connection, cacheDirectory):
+    MeshCache.defaultCache = WorkerMeshCache(cacheDirectory)
+    signal.signal(signal.SIGALRM, raiseTimeout)
+    store = VolumeStore()
+    while True:
+        try:
+            case = connection.recv()
+        except EOFError:
+            return
+        if case is None:
+            return
+        try:
+            result = runCase(case, store)
+        except CaseTimeout:
+            # the timer went off while the result was being put together
+            result = {'name': case['name'], 'status': 'timeout', 'pid': os.getpid(), 'loadedPaths': storedPaths(store)}
+        connection.send(result)
+
+def storedPaths(store):
+    # the files a worker still holds, for the scheduler
+    return sorted(set(path for _, path, _, _ in store.nodes))
+
+
+class Worker(object):
+
+    def __init__(self, index, cacheDirectory):
+        self.index = index
+        context = ParallelPlanner.getContext()
+        self.connection, childConnection = context.Pipe()
+        self.process = context.Process(target=workerMain, args=(childConnection, cacheDirectory),
+                                       name='BatchPlanner.worker%d' % index)
+        self.process.daemon = True
+        self.process.start()
+        childConnection.close()
+        self.loaded = set()
+        self.case = None
+        self.started = None
+        self.deadline = None
+
+    def submit(self, case, grace):
+        self.connection.send(case)
+        self.case = case
+        self.started = time.time()
+        self.deadline = self.started + case['timeLimit'] + grace if case['timeLimit'] else None
+        self.loaded |= inputPaths(case)
+
+    def finish(self, result):
+        # the worker reports what its store kept, so loaded forgets the files it dropped
+        self.case = None
+        if 'loadedPaths' in result:
+            self.loaded = set(result['loadedPaths'])
+
+    def stop(self, timeout=5.0):
+        try:
+            self.connection.send(None)
+        except (OSError, IOError):
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+
+
+class BatchPlanner(object):
+    """Schedules cases (from readManifest) on worker processes. grace is the time a
+    worker gets past a case's time limit before it is killed.
+    """
+
+    def __init__(self, cases, outputDirectory, workers=None, cacheDirectory=None, grace=10.0):
+        self.cases = [dict(case, outputDirectory=os.path.abspath(outputDirectory)) for case in cases]
+        self.order = dict((case['name'], index) for index, case in enumerate(self.cases))
+        self.outputDirectory = os.path.abspath(outputDirectory)
+        self.numberOfWorkers = max(1, min(workers or ParallelPlanner.defaultWorkers(), len(self.cases)))
+        self.cacheDirectory = cacheDirectory or os.path.join(self.outputDirectory, 'meshCache')
+        self.grace = grace
+
+    def nextCase(self, worker, pending):
+        # the pending case sharing the most files with what the worker loaded, the earliest on a tie
+        return max(pending, key=lambda case: (len(inputPaths(case) & worker.loaded), -self.order[case['name']]))
+
+    def run(self):
+        """Plans every case and returns their results in manifest order."""
+        for directory in (self.outputDirectory, self.cacheDirectory):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        startTime = time.time()
+        pending = list(self.cases)
+        results = {}
+        workers = [Worker(index, self.cacheDirectory) for index in range(self.numberOfWorkers)]
+        try:
+            while pending or any(worker.case is not None for worker in workers):
+                for worker in workers:
+                    if worker.case is None and pending:
+                        case = self.nextCase(worker, pending)
+                        pending.remove(case)
+                        worker.submit(case, self.grace)
+                busy = [worker for worker in workers if worker.case is not None]
+                deadlines = [worker.deadline for worker in busy if worker.deadline is not None]
+                timeout = max(0.0, min(deadlines) - time.time()) if deadlines else None
+                ready = multiprocessing.connection.wait([worker.connection for worker in busy], timeout)
+                for worker in busy:
+                    if worker.connection in ready:
+                        try:
+                            result = worker.connection.recv()
+                        except EOFError:
+                            # killed by the system, a limit the worker could not turn into an exception
+                            result = {'name': worker.case['name'], 'status': 'crashed', 'exitCode': worker.process.exitcode}
+                    elif worker.deadline is not None and time.time() >= worker.deadline:
+                        result = {'name': worker.case['name'], 'status': 'timeout', 'killed': True,
+                                  'seconds': time.time() - worker.started}
+                    else:
+                        continue
+                    result['worker'] = worker.index
+                    result['queueSeconds'] = worker.started - startTime
+                    results[worker.case['name']] = result
+                    self.writeCaseSummary(result)
+                    logging.info('%s: %s in %.2f seconds on worker %d', result['name'], result['status'],
+                                 result.get('seconds', 0.0), worker.index)
+                    worker.finish(result)
+                    if result['status'] == 'crashed' or result.get('killed'):
+                        worker.process.terminate()
+                        worker.process.join()
+                        workers[workers.index(worker)] = Worker(worker.index, self.cacheDirectory)
+        finally:
+            for worker in workers:
+                worker.stop()
+        ordered = [results[case['name']] for case in self.cases]
+        self.writeBatchSummary(ordered, time.time() - startTime)
+        return ordered
+
+    def writeCaseSummary(self, result):
+        directory = os.path.join(self.outputDirectory, result['name'])
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, 'summary.json'), 'w') as summaryFile:
+            json.dump(result, summaryFile, indent=2)
+
+    def writeBatchSummary(self, results, seconds):
+        summary = {'cases': len(results), 'workers': self.numberOfWorkers, 'totalSeconds': seconds,
+                   'caseSeconds': sum(result.get('seconds', 0.0) for result in results),
+                   'statuses': dict(collections.Counter(result['status'] for result in results)),
+                   'results': [dict((key, result.get(key)) for key in ('name', 'status', 'worker', 'seconds', 'queueSeconds',
+                                                                       'loadSeconds', 'planSeconds', 'rankedTrajectories',
+                                                                       'filesLoaded', 'filesReused'))
+                               for result in results]}
+        with open(os.path.join(self.outputDirectory, 'batch.json'), 'w') as summaryFile:
+            json.dump(summary, summaryFile, indent=2)
+        return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Plan the trajectories of every case of a manifest.')
+    parser.add_argument('manifest', help='JSON file with "defaults" and "cases"')
+    parser.add_argument('--output-dir', default='batch', help='folder for the per-case results and batch.json')
+    parser.add_argument('--workers', type=int, default=0, help='worker processes, 0 for every core')
+    parser.add_argument('--cache-dir', help='mesh cache shared by the workers, <output-dir>/meshCache by default')
+    parser.add_argument('--time-limit', type=float, help='default seconds per case')
+    parser.add_argument('--memory-limit', type=float, help='default megabytes per case')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    cases = readManifest(args.manifest)
+    for case in cases:
+        if case['timeLimit'] is None:
+            case['timeLimit'] = args.time_limit
+        if case['memoryLimit'] is None:
+            case['memoryLimit'] = args.memory_limit
+    results = BatchPlanner(cases, args.output_dir, args.workers or None, args.cache_dir).run()
+    failed = [result['name'] for result in results if result['status'] != 'ok']
+    logging.info('Planned %d of %d cases', len(results) - len(failed), len(results))
+    if failed:
+        logging.info('Failed: %s', ', '.join(failed))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
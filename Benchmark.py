@@ -0,0 +1,181 @@
+"""Times every Algorithms stage on synthetic phantoms and writes JSON results that
+can be compared between commits.
+
+    python Benchmark.py --output results.json
+    python Benchmark.py --output new.json --compare results.json --tolerance 1.25
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+import Algorithms
+import DistanceField
+import HeadlessPlanner
+import MathTools
+import MeshCache
+import OccupancyPyramid
+
+
+def labelVolume(labels, name, spacing=1.0):
+    imageData = vtk.vtkImageData()
+    slices, rows, columns = labels.shape
+    imageData.SetDimensions(columns, rows, slices)
+    imageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(np.ascontiguousarray(labels, dtype=np.uint8).ravel(), deep=1))
+    ijkToRAS = np.diag([spacing, spacing, spacing, 1.0])
+    return HeadlessPlanner.LabelVolume(imageData, ijkToRAS, name)
+
+def tubeNetwork(shape, numberOfTubes, radius, seed):
+    # union of straight tubes between random points on the volume faces
+    rng = np.random.RandomState(seed)
+    labels = np.zeros(shape, dtype=bool)
+    kji = np.indices(shape).reshape(3, -1).T.astype(np.float64)
+    for _ in range(numberOfTubes):
+        start = rng.uniform(0, 1, 3) * (np.array(shape) - 1)
+        end = rng.uniform(0, 1, 3) * (np.array(shape) - 1)
+        direction = end - start
+        t = np.clip((kji - start).dot(direction) / direction.dot(direction), 0, 1)
+        closest = start + t[:, None] * direction
+        labels |= (((kji - closest) ** 2).sum(axis=1) < radius ** 2).reshape(shape)
+    return labels
+
+def makePhantom(size=64, numberOfEntries=200, numberOfTargets=100, numberOfTubes=6, seed=0):
+    """Ventricles are a sphere, vessels a tube network, the cortex a shell and the
+    hippocampus a small sphere; entries lie on the outside of the shell and targets
+    are spread around the hippocampus so part of them are rejected.
+    """
+    shape = (size, size, size)
+    k, j, i = np.indices(shape)
+    centre = size / 2.0
+    radius = np.sqrt((i - centre) ** 2 + (j - centre) ** 2 + (k - centre) ** 2)
+    hippoCentre = np.array([1.35, 1.35, 1.35]) * centre
+    hippoRadius = 0.1 * size
+    hippo = (i - hippoCentre[0]) ** 2 + (j - hippoCentre[1]) ** 2 + (k - hippoCentre[2]) ** 2 < hippoRadius ** 2
+
+    rng = np.random.RandomState(seed)
+    azimuth = rng.uniform(0, 2 * np.pi, numberOfEntries)
+    z = rng.uniform(-1, 1, numberOfEntries)
+    shellRadius = 0.46 * size
+    entries = centre + shellRadius * np.stack([np.sqrt(1 - z ** 2) * np.cos(azimuth),
+                                               np.sqrt(1 - z ** 2) * np.sin(azimuth), z], axis=1)
+    targets = hippoCentre + rng.uniform(-1.3, 1.3, (numberOfTargets, 3)) * hippoRadius
+
+    return {
+        'hippo': labelVolume(hippo, 'r_hippo'),
+        'ventricles': labelVolume(radius < 0.15 * size, 'ventricles'),
+        'vessels': labelVolume(tubeNetwork(shape, numberOfTubes, max(1.0, size / 64.0), seed), 'vessels'),
+        'cortex': labelVolume((radius < 0.45 * size) & (radius > 0.38 * size), 'cortex'),
+        'entries': HeadlessPlanner.FiducialList(entries, 'entries'),
+        'targets': HeadlessPlanner.FiducialList(targets, 'targets'),
+    }
+
+
+def timeStage(function, repeats):
+    # first call runs with cold caches, the best of the repeats with warm ones
+    times = []
+    for _ in range(max(repeats, 1)):
+        startTime = time.time()
+        result = function()
+        times.append(time.time() - startTime)
+    return {'coldSeconds': times[0], 'bestSeconds': min(times)}, result
+
+def benchmarkCase(size, numberOfEntries, numberOfTargets, repeats=3, angle=55.0, precision=0.01, collisionMode='mesh'):
+    # every case starts with empty caches, the ones of the caller are put back afterwards
+    caches = (DistanceField.fieldCache, OccupancyPyramid.pyramidCache, MathTools.coordinatesCache)
+    previousCache, previousEntries = MeshCache.defaultCache, [list(cache.items()) for cache in caches]
+    MeshCache.defaultCache = MeshCache.MeshCache(None)
+    for cache in caches:
+        cache.clear()
+    try:
+        return timeStages(size, numberOfEntries, numberOfTargets, repeats, angle, precision, collisionMode)
+    finally:
+        MeshCache.defaultCache = previousCache
+        for cache, entries in zip(caches, previousEntries):
+            cache.clear()
+            cache.update(entries)
+
+def timeStages(size, numberOfEntries, numberOfTargets, repeats, angle, precision, collisionMode):
+    phantom = makePhantom(size, numberOfEntries, numberOfTargets)
+    hippo, ventricles, vessels, cortex = phantom['hippo'], phantom['ventricles'], phantom['vessels'], phantom['cortex']
+    stages = {}
+
+    stages['getValidTargets'], targets = timeStage(
+        lambda: Algorithms.getValidTargets(phantom['targets'], hippo), repeats)
+    candidates = Algorithms.entriesAndTargetsSet(phantom['entries'], targets)
+    stages['getIncisionsWithValidArea.ventricles'], _ = timeStage(
+        lambda: Algorithms.getIncisionsWithValidArea(candidates, ventricles, collisionMode), repeats)
+    stages['getIncisionsWithValidArea.vessels'], _ = timeStage(
+        lambda: Algorithms.getIncisionsWithValidArea(candidates, vessels, collisionMode), repeats)
+    stages['getIncisionsWithValidAngle'], _ = timeStage(
+        lambda: Algorithms.getIncisionsWithValidAngle(candidates, cortex, angle), repeats)
+    stages['combineConstraints'], valid = timeStage(
+        lambda: Algorithms.combineConstraints(candidates, ventricles, vessels, cortex, angle, collisionMode), repeats)
+    # printBestTrajectoryForEachEntry without adding the model node to a scene
+    stages['printBestTrajectoryForEachEntry'], best = timeStage(
+        lambda: Algorithms.bestTrajectoryForEachEntry(precision, 9999999999999, valid, vessels, ventricles), repeats)
+
+    return {'size': size, 'entries': numberOfEntries, 'targets': numberOfTargets, 'collisionMode': collisionMode,
+            'candidatePairs': len(candidates), 'validPairs': len(valid), 'entriesWithTrajectory': len(best),
+            'stages': stages}
+
+def caseKey(case):
+    return '%(size)dvox-%(entries)dx%(targets)d-%(collisionMode)s' % case
+
+def compare(results, baseline, tolerance):
+    # stages whose best time grew by more than tolerance times the baseline
+    baselineCases = dict((caseKey(case), case) for case in baseline['cases'])
+    regressions = []
+    for case in results['cases']:
+        previous = baselineCases.get(caseKey(case))
+        if previous is None:
+            continue
+        for stage, timing in case['stages'].items():
+            if stage not in previous['stages']:
+                continue
+            before = previous['stages'][stage]['bestSeconds']
+            if timing['bestSeconds'] > tolerance * before and timing['bestSeconds'] - before > 1e-3:
+                regressions.append({'case': caseKey(case), 'stage': stage, 'baselineSeconds': before,
+                                    'seconds': timing['bestSeconds']})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the planning stages on synthetic phantoms.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[64], help='phantom edge length in voxels')
+    parser.add_argument('--entries', type=int, nargs='+', default=[100, 400])
+    parser.add_argument('--targets', type=int, nargs='+', default=[50, 200])
+    parser.add_argument('--collision-mode', choices=['mesh', 'voxel', 'pyramid'], default='mesh')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--compare', help='baseline JSON written by an earlier run')
+    parser.add_argument('--tolerance', type=float, default=1.25, help='allowed slowdown factor against the baseline')
+    args = parser.parse_args(argv)
+
+    cases = []
+    for size in args.sizes:
+        for numberOfEntries in args.entries:
+            for numberOfTargets in args.targets:
+                case = benchmarkCase(size, numberOfEntries, numberOfTargets, args.repeats,
+                                     collisionMode=args.collision_mode)
+                print(caseKey(case), json.dumps(dict((stage, round(timing['bestSeconds'], 4))
+                                                     for stage, timing in case['stages'].items())))
+                cases.append(case)
+    results = {'python': platform.python_version(), 'numpy': np.__version__, 'vtk': vtk.vtkVersion.GetVTKVersion(),
+               'machine': platform.machine(), 'cases': cases}
+    with open(args.output, 'w') as outputFile:
+        json.dump(results, outputFile, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baselineFile:
+            regressions = compare(results, json.load(baselineFile), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION %(case)s %(stage)s: %(baselineSeconds).4f -> %(seconds).4f seconds' % regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
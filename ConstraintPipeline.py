@@ -0,0 +1,203 @@
+import time
+import numpy as np
+import Instrumentation
+import VolumeTools
+
+
+class Constraint(object):
+    """A named pair test, evaluate(entryPoints, targetPoints) returns a keep mask.
+    bounds is the RAS (lower, upper) box of what the test looks at, when given
+    the segments that miss it pass without being evaluated.
+    """
+
+    def __init__(self, name, evaluate, bounds=None):
+        self.name = name
+        self.evaluate = evaluate
+        self.bounds = bounds
+
+    def test(self, entries, targets):
+        # keep mask and the number of pairs passed by the bounds
+        if self.bounds is None:
+            return np.asarray(self.evaluate(entries, targets), dtype=bool), 0
+        tEnter, tExit = VolumeTools.clipSegmentsToBox(entries, targets, self.bounds[0], self.bounds[1])
+        near = tEnter <= tExit
+        keep = np.ones(len(entries), dtype=bool)
+        if near.any():
+            keep[near] = np.asarray(self.evaluate(entries[near], targets[near]), dtype=bool)
+        return keep, int(len(entries) - near.sum())
+
+
+class PipelineResult(object):
+
+    def __init__(self, trajectories, stages, order, calibrationSeconds, totalSeconds, valid=None):
+        self.trajectories = trajectories
+        self.valid = valid
+        self.stages = stages
+        self.order = order
+        self.calibrationSeconds = calibrationSeconds
+        self.totalSeconds = totalSeconds
+        self.numberOfValid = len(trajectories) if trajectories is not None else 0
+
+    def add(self, other):
+        # sums the stages and timings of another chunk's result, its trajectories are not kept
+        stages = dict((stage['name'], stage) for stage in self.stages)
+        for stage in other.stages:
+            if stage['name'] not in stages:
+                stages[stage['name']] = dict(stage)
+                self.stages.append(stages[stage['name']])
+                continue
+            for key in ('seconds', 'pairsIn', 'pairsOut', 'rejected', 'skipped'):
+                stages[stage['name']][key] = stages[stage['name']].get(key, 0) + stage.get(key, 0)
+        self.order = self.order or list(other.order)
+        self.calibrationSeconds += other.calibrationSeconds
+        self.totalSeconds += other.totalSeconds
+        self.numberOfValid += other.numberOfValid
+        return self
+
+    def prepend(self, stages, valid):
+        # adds the prefilter stages that left the pairs where valid is set to this result
+        self.stages = list(stages) + self.stages
+        self.order = [stage['name'] for stage in stages] + list(self.order)
+        self.totalSeconds += sum(stage['seconds'] for stage in stages)
+        if self.valid is not None:
+            merged = np.zeros(len(valid), dtype=bool)
+            merged[valid] = self.valid
+            self.valid = merged
+        return self
+
+    def asDict(self):
+        return {'order': list(self.order), 'stages': [dict(stage) for stage in self.stages],
+                'calibrationSeconds': self.calibrationSeconds, 'totalSeconds': self.totalSeconds,
+                'validTrajectories': self.numberOfValid}
+
+    def report(self):
+        lines = ['Constraint order: ' + ', '.join(self.order)]
+        for stage in self.stages:
+            skipped = ', %d outside its bounds' % stage['skipped'] if stage.get('skipped') else ''
+            lines.append('  %s: %d in, %d rejected%s, %.4f seconds' % (stage['name'], stage['pairsIn'],
+                                                                       stage['rejected'], skipped, stage['seconds']))
+        lines.append('Calibration: %.4f seconds, total: %.4f seconds' % (self.calibrationSeconds, self.totalSeconds))
+        return '\n'.join(lines)
+
+
+class ConstraintPipeline(object):
+    """Runs every pair through the constraints once, dropping pairs at the first
+    failed constraint. A sample of the pairs is run through all constraints first
+    to measure cost and rejection rate, and the constraints are ordered by cost
+    per rejected pair. The sample's results are reused, so no pair is tested twice.
+    """
+
+    def __init__(self, constraints, sampleSize=256, reorder=True):
+        self.constraints = list(constraints)
+        self.sampleSize = sampleSize
+        self.reorder = reorder
+
+    def calibrate(self, entries, targets, sample):
+        keep = {}
+        ranks = []
+        for index, constraint in enumerate(self.constraints):
+            startTime = time.time()
+            keep[constraint.name] = constraint.test(entries[sample], targets[sample])[0]
+            cost = (time.time() - startTime) / max(len(sample), 1)
+            rejectionRate = 1.0 - keep[constraint.name].mean() if len(sample) else 0.0
+            ranks.append((cost / max(rejectionRate, 1e-6), index))
+        if self.reorder:
+            order = [self.constraints[index] for _, index in sorted(ranks)]
+        else:
+            order = list(self.constraints)
+        return order, keep
+
+    def samplePairs(self, numberOfPairs):
+        # evenly spaced rows, so the sample spans every entry of an entry-major pair array
+        return np.unique(np.linspace(0, numberOfPairs - 1, min(self.sampleSize, numberOfPairs)).astype(np.int64))
+
+    def calibratedOrder(self, trajectories, prefilters=()):
+        """The constraint order run would use for trajectories and the seconds it took
+        to measure, for runs split in parts that must all use one order (worker
+        chunks, streamed chunks). prefilters drop their pairs from the sample, as
+        they would before run. The results of the sample are not kept.
+        """
+        if not self.reorder:
+            return list(self.constraints), 0.0
+        sample = self.samplePairs(len(trajectories))
+        pairs = trajectories.pairs[sample]
+        entries, targets = trajectories.entries[pairs[:, 0]], trajectories.targets[pairs[:, 1]]
+        for constraint in prefilters:
+            keep = constraint.test(entries, targets)[0]
+            entries, targets = entries[keep], targets[keep]
+        startTime = time.time()
+        with Instrumentation.span('constraintCalibration', pairsIn=len(entries)):
+            order = self.calibrate(entries, targets, np.arange(len(entries)))[0]
+        return order, time.time() - startTime
+
+    def run(self, trajectories, order=None):
+        # order (a list of the constraints) skips the calibration
+        totalStart = time.time()
+        entries, targets = trajectories.entryPoints(), trajectories.targetPoints()
+        numberOfPairs = len(entries)
+        if order is None:
+            sample = self.samplePairs(numberOfPairs)
+            calibrationStart = time.time()
+            with Instrumentation.span('constraintCalibration', pairsIn=len(sample)):
+                order, sampleKeep = self.calibrate(entries, targets, sample)
+            calibrationSeconds = time.time() - calibrationStart
+        else:
+            sample = np.zeros(0, dtype=np.int64)
+            sampleKeep = dict((constraint.name, np.zeros(0, dtype=bool)) for constraint in order)
+            calibrationSeconds = 0.0
+
+        valid = np.ones(numberOfPairs, dtype=bool)
+        unresolved = np.ones(numberOfPairs, dtype=bool)
+        unresolved[sample] = False
+        stages = []
+        for constraint in order:
+            rows = np.nonzero(valid & unresolved)[0]
+            startTime = time.time()
+            with Instrumentation.span('constraint.' + constraint.name, pairsIn=len(rows)) as counters:
+                keep, skipped = constraint.test(entries[rows], targets[rows])
+                counters['pairsOut'] = int(keep.sum())
+                counters['skipped'] = skipped
+            seconds = time.time() - startTime
+            valid[rows[~keep]] = False
+            sampleRows = sample[valid[sample]]
+            sampleKept = sampleKeep[constraint.name][valid[sample]]
+            valid[sampleRows[~sampleKept]] = False
+            pairsIn = len(rows) + len(sampleRows)
+            rejected = int((~keep).sum() + (~sampleKept).sum())
+            stages.append({'name': constraint.name, 'seconds': seconds, 'pairsIn': pairsIn,
+                           'pairsOut': pairsIn - rejected, 'rejected': rejected, 'skipped': skipped})
+        return PipelineResult(trajectories.filter(valid), stages, [constraint.name for constraint in order],
+                              calibrationSeconds, time.time() - totalStart, valid)
+
+    def stream(self, chunks, prefilters=(), order=None):
+        """Runs the TrajectorySets of chunks one at a time and yields the result of
+        each, all in one order: order (see calibratedOrder) or, without it, the order
+        the first chunk calibrates.
+        """
+        for chunk in chunks:
+            valid, stages = runPrefilters(chunk, prefilters)
+            result = self.run(chunk.filter(valid), order)
+            if order is None:
+                byName = dict((constraint.name, constraint) for constraint in self.constraints)
+                order = [byName[name] for name in result.order]
+            yield result.prepend(stages, valid)
+
+
+def runPrefilters(trajectories, prefilters):
+    """Runs cheap constraints over every pair, in their order and without
+    calibration, before a pipeline gets the pairs. Returns the keep mask and a
+    stage per prefilter.
+    """
+    entries, targets = trajectories.entryPoints(), trajectories.targetPoints()
+    valid = np.ones(len(entries), dtype=bool)
+    stages = []
+    for constraint in prefilters:
+        rows = np.nonzero(valid)[0]
+        startTime = time.time()
+        with Instrumentation.span('prefilter.' + constraint.name, pairsIn=len(rows)) as counters:
+            keep = constraint.test(entries[rows], targets[rows])[0]
+            counters['pairsOut'] = int(keep.sum())
+        valid[rows[~keep]] = False
+        stages.append({'name': constraint.name, 'seconds': time.time() - startTime, 'pairsIn': len(rows),
+                       'pairsOut': int(keep.sum()), 'rejected': int((~keep).sum()), 'skipped': 0})
+    return valid, stages
@@ -0,0 +1,149 @@
+import collections
+import numpy as np
+import Instrumentation
+import MeshCache
+import VolumeTools
+
+# node ID -> (modified time, DistanceField), the least recently used go first
+fieldCache = collections.OrderedDict()
+maximumFields = 8
+
+
+def squaredDistanceTransform1D(f, spacing, chunkSize=16384):
+    """Felzenszwalb-Huttenlocher lower envelope along the last axis of f (lines, n),
+    run on all lines at once. f holds squared distances, inf where there is no feature.
+    """
+    result = np.empty_like(f)
+    for start in range(0, len(f), chunkSize):
+        result[start:start + chunkSize] = _lowerEnvelope(f[start:start + chunkSize], spacing)
+    return result
+
+def _lowerEnvelope(f, spacing):
+    lines, n = f.shape
+    positions = np.arange(n) * spacing
+    vertices = np.zeros((lines, n), dtype=np.int64)
+    boundaries = np.full((lines, n), -np.inf)
+    top = np.full(lines, -1, dtype=np.int64)
+
+    for q in range(n):
+        rows = np.nonzero(np.isfinite(f[:, q]))[0]
+        if len(rows) == 0:
+            continue
+        height = f[rows, q] + positions[q] ** 2
+        while True:
+            k = top[rows]
+            stacked = k >= 0
+            crossing = np.full(len(rows), -np.inf)
+            v = vertices[rows[stacked], k[stacked]]
+            crossing[stacked] = (height[stacked] - (f[rows[stacked], v] + positions[v] ** 2)) / (2.0 * (positions[q] - positions[v]))
+            pop = stacked & (crossing <= boundaries[rows, np.maximum(k, 0)]) & (k > 0)
+            if not pop.any():
+                break
+            top[rows[pop]] -= 1
+        k = top[rows] + 1
+        vertices[rows, k] = q
+        boundaries[rows, k] = np.where(k > 0, crossing, -np.inf)
+        top[rows] = k
+
+    result = np.full((lines, n), np.inf)
+    filled = np.nonzero(top >= 0)[0]
+    k = np.zeros(len(filled), dtype=np.int64)
+    lastK = top[filled]
+    for q in range(n):
+        while True:
+            advance = (k < lastK) & (boundaries[filled, np.minimum(k + 1, n - 1)] < positions[q])
+            if not advance.any():
+                break
+            k[advance] += 1
+        v = vertices[filled, k]
+        result[filled, q] = (positions[q] - positions[v]) ** 2 + f[filled, v]
+    return result
+
+def euclideanDistanceTransform(features, spacing):
+    # distance from every voxel to the nearest True voxel of features, spacing per array axis
+    squared = np.where(features, 0.0, np.inf)
+    for axis in range(features.ndim):
+        moved = np.moveaxis(squared, axis, -1)
+        shape = moved.shape
+        moved = squaredDistanceTransform1D(np.ascontiguousarray(moved).reshape(-1, shape[-1]), spacing[axis])
+        squared = np.moveaxis(moved.reshape(shape), -1, axis)
+    return np.sqrt(squared)
+
+
+class DistanceField(object):
+    """Signed distance to a label volume, positive outside the nonzero voxels and
+    negative inside, sampled in RAS through the volume's RAS to IJK matrix.
+    """
+
+    def __init__(self, volumeNode):
+        labels = VolumeTools.getLabelArray(volumeNode) != 0
+        self.rasToIJK = VolumeTools.getRASToIJK(volumeNode)
+        ijkToRAS = np.linalg.inv(self.rasToIJK)
+        # array axes are [k, j, i]
+        spacing = np.linalg.norm(ijkToRAS[:3, :3], axis=0)[::-1]
+        if not labels.any():
+            self.field = np.full(labels.shape, np.inf)
+        else:
+            self.field = (euclideanDistanceTransform(labels, spacing)
+                          - euclideanDistanceTransform(~labels, spacing))
+
+    @classmethod
+    def fromArrays(cls, field, rasToIJK):
+        distanceField = cls.__new__(cls)
+        distanceField.field = field
+        distanceField.rasToIJK = rasToIJK
+        return distanceField
+
+    def isEmpty(self):
+        # an empty label volume has an all-inf field
+        return self.field.size == 0 or np.isinf(self.field.flat[0])
+
+    def sample(self, points):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        if self.isEmpty():
+            # trilinear weights of 0 times inf would give nan, the exact distance is inf as well
+            return np.full(len(points), np.inf)
+        ijk = points.dot(self.rasToIJK[:3, :3].T) + self.rasToIJK[:3, 3]
+        kji = np.clip(ijk[:, ::-1], 0, np.array(self.field.shape) - 1)
+        lower = np.minimum(np.floor(kji).astype(np.int64), np.array(self.field.shape) - 2).clip(0)
+        weight = kji - lower
+        value = np.zeros(len(points))
+        for corner in range(8):
+            offset = np.array([(corner >> 2) & 1, (corner >> 1) & 1, corner & 1])
+            index = np.minimum(lower + offset, np.array(self.field.shape) - 1)
+            w = np.prod(np.where(offset, weight, 1.0 - weight), axis=1)
+            value += w * self.field[index[:, 0], index[:, 1], index[:, 2]]
+        return value
+
+    def minimumDistances(self, entries, targets, precision, chunkSize=4096):
+        # minimum sampled distance along every entry->target segment
+        steps = np.append(np.arange(0, 1, precision), 1.0)[None, :, None]
+        entries = np.asarray(entries, dtype=np.float64).reshape(-1, 3)
+        targets = np.asarray(targets, dtype=np.float64).reshape(-1, 3)
+        distances = np.empty(len(entries))
+        for start in range(0, len(entries), chunkSize):
+            p = entries[start:start + chunkSize, None, :]
+            q = targets[start:start + chunkSize, None, :]
+            samples = self.sample(p + steps * (q - p)).reshape(len(p), -1)
+            distances[start:start + chunkSize] = samples.min(axis=1)
+        return distances
+
+
+def getDistanceField(volumeNode):
+    key = volumeNode.GetID() if hasattr(volumeNode, 'GetID') else id(volumeNode)
+    modifiedTime = max(volumeNode.GetMTime(), volumeNode.GetImageData().GetMTime())
+    with MeshCache.cacheLock:
+        cached = fieldCache.get(key)
+        if cached is not None and cached[0] == modifiedTime:
+            fieldCache.move_to_end(key)
+            return cached[1]
+        with Instrumentation.span('distanceFieldBuild'):
+            field = DistanceField(volumeNode)
+        fieldCache[key] = (modifiedTime, field)
+        fieldCache.move_to_end(key)
+        while len(fieldCache) > maximumFields:
+            fieldCache.popitem(last=False)
+        return field
+
+def minimumDistances(volumeNode, entries, targets, precision):
+    return getDistanceField(volumeNode).minimumDistances(entries, targets, precision)
@@ -0,0 +1,299 @@
+"""Plans trajectories from .nii.gz label volumes and .fcsv fiducial lists without
+Slicer, for batch runs and containers. Only numpy and vtk are imported.
+
+    python HeadlessPlanner.py --data-dir /path/to/case --output trajectories.csv
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+import time
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+import Algorithms
+import Instrumentation
+import MathTools
+import MeshCache
+import ParallelPlanner
+import PlanningOptions
+
+
+class LabelVolume(object):
+    """Stands in for a vtkMRMLLabelMapVolumeNode: image data with origin 0 and
+    spacing 1, the geometry lives in the IJK to RAS matrix as it does in Slicer.
+    """
+
+    def __init__(self, imageData, ijkToRAS, name, nodeID=None):
+        self.imageData = imageData
+        self.ijkToRAS = np.asarray(ijkToRAS, dtype=np.float64)
+        self.name = name
+        # the caches are keyed by node ID, volumes loaded side by side need their own
+        self.nodeID = nodeID or 'HeadlessPlanner.' + name
+
+    def GetImageData(self):
+        return self.imageData
+
+    def GetName(self):
+        return self.name
+
+    def GetID(self):
+        return self.nodeID
+
+    def GetMTime(self):
+        return self.imageData.GetMTime()
+
+    def GetIJKToRASMatrix(self, matrix):
+        setMatrix(matrix, self.ijkToRAS)
+
+    def GetRASToIJKMatrix(self, matrix):
+        setMatrix(matrix, np.linalg.inv(self.ijkToRAS))
+
+
+class FiducialList(object):
+    """Stands in for a vtkMRMLMarkupsFiducialNode holding a fixed (N,3) RAS array."""
+
+    def __init__(self, points, name, nodeID=None):
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        self.name = name
+        self.nodeID = nodeID or 'HeadlessPlanner.' + name
+        # a list loaded again under the same ID must not get the coordinates cached for the previous one
+        self.modifiedTime = vtk.vtkTimeStamp()
+        self.modifiedTime.Modified()
+
+    def GetName(self):
+        return self.name
+
+    def GetID(self):
+        return self.nodeID
+
+    def GetMTime(self):
+        return self.modifiedTime.GetMTime()
+
+    def GetNumberOfMarkups(self):
+        return len(self.points)
+
+    def GetNumberOfFiducials(self):
+        return len(self.points)
+
+    def GetNthFiducialPosition(self, index, position):
+        position[0], position[1], position[2] = self.points[index]
+
+    def GetParentTransformNode(self):
+        return None
+
+    def GetControlPointPositionsWorld(self, positions):
+        positions.SetData(numpy_support.numpy_to_vtk(self.points, deep=True))
+
+
+def setMatrix(matrix, array):
+    for i in range(4):
+        for j in range(4):
+            matrix.SetElement(i, j, array[i][j])
+
+def toArray(matrix):
+    return np.array([[matrix.GetElement(i, j) for j in range(4)] for i in range(4)])
+
+def loadLabelVolume(path, name=None, nodeID=None):
+    reader = vtk.vtkNIFTIImageReader()
+    reader.SetFileName(path)
+    reader.Update()
+    imageData = reader.GetOutput()
+
+    # image coordinates -> NIfTI world (RAS), preferring the sform like Slicer does
+    worldMatrix = reader.GetSFormMatrix() or reader.GetQFormMatrix()
+    world = toArray(worldMatrix) if worldMatrix is not None else np.eye(4)
+    ijkToImage = np.eye(4)
+    ijkToImage[:3, :3] = np.diag(imageData.GetSpacing())
+    ijkToImage[:3, 3] = imageData.GetOrigin()
+
+    change = vtk.vtkImageChangeInformation()
+    change.SetInputData(imageData)
+    change.SetOutputOrigin(0, 0, 0)
+    change.SetOutputSpacing(1, 1, 1)
+    change.Update()
+    if name is None:
+        name = os.path.basename(path).split('.')[0]
+    return LabelVolume(change.GetOutput(), world.dot(ijkToImage), name, nodeID)
+
+def loadFiducials(path, name=None, nodeID=None):
+    points = []
+    lps = False
+    with open(path) as fiducialFile:
+        for line in fiducialFile:
+            line = line.strip()
+            if line.startswith('#'):
+                if 'CoordinateSystem' in line:
+                    system = line.split('=')[-1].strip().upper()
+                    lps = system in ('1', 'LPS')
+                continue
+            if not line:
+                continue
+            fields = line.split(',')
+            points.append([float(fields[1]), float(fields[2]), float(fields[3])])
+    points = np.array(points, dtype=np.float64).reshape(-1, 3)
+    if lps:
+        points[:, :2] *= -1
+    if name is None:
+        name = os.path.basename(path).split('.')[0]
+    return FiducialList(points, name, nodeID)
+
+def plan(hippo, ventricles, vessels, cortex, targetsNode, entriesNode, validAngleOfIntersection, precisionValue,
+         maximumIncisionValue, options=None, export=None, metadata=None, **settings):
+    """Runs the same steps as Task1Logic.run and returns the ranked trajectories as
+    (score, [entry, target]) plus the k best targets of each entry. options and
+    settings are the PlanningOptions of the run. With options.streaming the ranked
+    trajectories are only the k best of each entry and the result has no trajectories.
+    Otherwise export is an optional TrajectoryFile path the scored trajectories are
+    written to, with metadata in its header.
+    """
+    options = PlanningOptions.planningOptions(options, **settings)
+    if options.workers != 1 and ParallelPlanner.activePool is None:
+        # one set of worker processes for the constraints and every scoring chunk
+        with ParallelPlanner.pooled(options.workers):
+            return plan(hippo, ventricles, vessels, cortex, targetsNode, entriesNode, validAngleOfIntersection,
+                        precisionValue, maximumIncisionValue, options, export, metadata)
+    newTargets = Algorithms.getValidTargets(targetsNode, hippo)
+    # length and geometry tests on the coordinates, before any surface query
+    prefilters = Algorithms.buildPrefilters(maximumIncisionValue, cortex, options.approachAngle)
+    if options.streaming:
+        top, result = Algorithms.streamTopTrajectoriesPerEntry(
+            precisionValue, maximumIncisionValue, MathTools.getCoordinatesArray(entriesNode), newTargets, ventricles,
+            vessels, cortex, validAngleOfIntersection, options.collisionMode, options.normalMode, prefilters,
+            workers=options.workers, criterion=options.criterion, weights=options.weights, k=options.k,
+            chunkSize=options.chunkSize, distanceMode=options.distanceMode)
+        logging.info(result.report())
+        ranked = sorted(((score, [list(entry), target]) for entry, scored in top.items() for score, target in scored),
+                        key=lambda item: item[0], reverse=True)
+        return ranked, Algorithms.targetsByEntry(top), result
+    candidates = Algorithms.entriesAndTargetsSet(entriesNode, newTargets)
+    result = Algorithms.runConstraintPipeline(candidates, ventricles, vessels, cortex, validAngleOfIntersection,
+                                              options.collisionMode, workers=options.workers,
+                                              hierarchical=options.hierarchical, normalMode=options.normalMode,
+                                              prefilters=prefilters)
+    logging.info(result.report())
+    # the ranking and the top k of each entry come from one scoring of the valid trajectories
+    ranked, top = Algorithms.rankedAndTopTrajectories(precisionValue, maximumIncisionValue, result.trajectories, vessels,
+                                                      ventricles, workers=options.workers, criterion=options.criterion,
+                                                      weights=options.weights, k=options.k, distanceMode=options.distanceMode,
+                                                      export=export, metadata=metadata)
+    return ranked, Algorithms.targetsByEntry(top), result
+
+def writeTrajectories(path, ranked, best):
+    with Instrumentation.span('resultExport', trajectories=len(ranked)), open(path, 'w') as outputFile:
+        writer = csv.writer(outputFile)
+        writer.writerow(['rank', 'entryR', 'entryA', 'entryS', 'targetR', 'targetA', 'targetS',
+                         'distance', 'length', 'bestForEntry'])
+        for rank, (distance, (entry, target)) in enumerate(ranked):
+            length = MathTools.getDistanceBetweenPoints(entry, target)
+            isBest = best.get(tuple(entry), [None])[0] == target
+            writer.writerow([rank] + list(entry) + list(target) + [distance, length, int(isBest)])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Plan entry/target trajectories without the Slicer GUI.')
+    parser.add_argument('--data-dir', help='folder with r_hippo.nii.gz, ventricles.nii.gz, vessels.nii.gz, '
+                                           'cortex.nii.gz, targets.fcsv and entries.fcsv')
+    parser.add_argument('--hippo')
+    parser.add_argument('--ventricles')
+    parser.add_argument('--vessels')
+    parser.add_argument('--cortex')
+    parser.add_argument('--targets')
+    parser.add_argument('--entries')
+    parser.add_argument('--angle', type=float, default=55.0, help='valid incision angle in degrees')
+    parser.add_argument('--precision', type=float, default=0.01, help='sampling step of --distance-mode sampled')
+    parser.add_argument('--distance-mode', choices=PlanningOptions.distanceModes, default='exact',
+                        help='distance to the vessels and the ventricles the trajectories are scored by')
+    parser.add_argument('--max-length', type=float, default=9999999999999.0, help='maximum incision length')
+    parser.add_argument('--collision-mode', choices=PlanningOptions.collisionModes, default='mesh')
+    parser.add_argument('--workers', type=int, default=1, help='processes to use, 0 for every core')
+    parser.add_argument('--mesh-cache', help='folder to keep the surface meshes in between runs')
+    parser.add_argument('--criterion', choices=['sum', 'min', 'weighted'], default='sum',
+                        help='how the distances to the vessels and the ventricles make one score')
+    parser.add_argument('--weights', type=float, nargs=2, help='vessel and ventricle weights for --criterion weighted')
+    parser.add_argument('--top-k', type=int, default=1, help='targets kept for each entry')
+    parser.add_argument('--normals', choices=PlanningOptions.normalModes, default='face',
+                        help='cortex normal used for the incision angle')
+    parser.add_argument('--hierarchical', action='store_true', help='test clusters of entries and targets first')
+    parser.add_argument('--approach-angle', type=float,
+                        help='also drop pairs this many degrees away from the cortex normal nearest the entry (approximate)')
+    parser.add_argument('--stream', action='store_true',
+                        help='plan the pairs in chunks without building them all, the output has the top-k of each entry')
+    parser.add_argument('--chunk-size', type=int, default=16384, help='pairs per chunk for --stream')
+    parser.add_argument('--output', default='trajectories.csv')
+    parser.add_argument('--summary', help='optional JSON file for the run summary')
+    parser.add_argument('--binary', help='optional TrajectoryFile with every valid trajectory, its score and distances')
+    parser.add_argument('--trace', help='optional Chrome trace (chrome://tracing, ui.perfetto.dev) of the run')
+    parser.add_argument('--instrumentation', help='optional JSON file with every span and counter of the run')
+    parser.add_argument('--memory', action='store_true', help='record the peak traced memory of every span')
+    parser.add_argument('--profile', choices=['cprofile', 'sampling'], help='profile the run')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    def inputPath(value, fileName):
+        if value:
+            return value
+        if not args.data_dir:
+            parser.error('--data-dir or --' + fileName.split('.')[0] + ' is required')
+        return os.path.join(args.data_dir, fileName)
+
+    try:
+        options = PlanningOptions.PlanningOptions(collisionMode=args.collision_mode, workers=args.workers or None,
+                                                  hierarchical=args.hierarchical, normalMode=args.normals,
+                                                  criterion=args.criterion, weights=args.weights, k=args.top_k,
+                                                  streaming=args.stream, chunkSize=args.chunk_size,
+                                                  approachAngle=args.approach_angle, distanceMode=args.distance_mode)
+    except ValueError as error:
+        parser.error(str(error))
+
+    if args.mesh_cache:
+        MeshCache.defaultCache = MeshCache.MeshCache(args.mesh_cache)
+
+    recorder = None
+    if args.trace or args.instrumentation or args.memory or args.profile:
+        recorder = Instrumentation.Recorder(memory=args.memory, profiler=args.profile)
+        Instrumentation.setRecorder(recorder)
+        recorder.start()
+
+    startTime = time.time()
+    hippo = loadLabelVolume(inputPath(args.hippo, 'r_hippo.nii.gz'), 'r_hippo')
+    ventricles = loadLabelVolume(inputPath(args.ventricles, 'ventricles.nii.gz'), 'ventricles')
+    vessels = loadLabelVolume(inputPath(args.vessels, 'vessels.nii.gz'), 'vessels')
+    cortex = loadLabelVolume(inputPath(args.cortex, 'cortex.nii.gz'), 'cortex')
+    targetsNode = loadFiducials(inputPath(args.targets, 'targets.fcsv'), 'targets')
+    entriesNode = loadFiducials(inputPath(args.entries, 'entries.fcsv'), 'entries')
+    loadSeconds = time.time() - startTime
+
+    if args.binary and options.streaming:
+        logging.warning('--binary needs every valid trajectory and is skipped with --stream')
+    # the binary file is written while the plan scores the trajectories
+    export = args.binary if not options.streaming else None
+    ranked, best, result = plan(hippo, ventricles, vessels, cortex, targetsNode, entriesNode, args.angle,
+                                args.precision, args.max_length, options, export,
+                                dict(options.asDict(), angle=args.angle, precision=args.precision, maximumLength=args.max_length))
+    writeTrajectories(args.output, ranked, best)
+    summary = {'loadSeconds': loadSeconds, 'totalSeconds': time.time() - startTime,
+               'rankedTrajectories': len(ranked), 'entriesWithTrajectory': len(best),
+               'constraints': result.asDict()}
+    logging.info('Wrote %d trajectories to %s in %.2f seconds', len(ranked), args.output, summary['totalSeconds'])
+    if recorder is not None:
+        recorder.stop()
+        Instrumentation.setRecorder(None)
+        summary['instrumentation'] = {'totals': recorder.totals(), 'counters': dict(recorder.counters)}
+        logging.info(recorder.report())
+        if args.profile == 'cprofile':
+            logging.info(recorder.profileStatistics())
+        if args.trace:
+            recorder.writeChromeTrace(args.trace)
+        if args.instrumentation:
+            recorder.writeJSON(args.instrumentation)
+    if args.summary:
+        with open(args.summary, 'w') as summaryFile:
+            json.dump(summary, summaryFile, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
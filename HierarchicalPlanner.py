@@ -0,0 +1,138 @@
+import time
+import numpy as np
+import ConstraintPipeline
+import DistanceField
+import Instrumentation
+import TrajectorySet
+import VolumeTools
+
+
+def clusterPoints(points, clusterSize):
+    """Groups points into the cells of a regular grid of clusterSize (an octree
+    level). Returns the cluster of every point, cluster centroids and radii.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    if len(points) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, 3)), np.zeros(0)
+    cells = np.floor(points / clusterSize).astype(np.int64)
+    _, labels = np.unique(cells, axis=0, return_inverse=True)
+    labels = labels.ravel()
+    counts = np.bincount(labels)
+    centroids = np.stack([np.bincount(labels, weights=points[:, axis]) for axis in range(3)], axis=1) / counts[:, None]
+    radii = np.zeros(len(counts))
+    np.maximum.at(radii, labels, np.linalg.norm(points - centroids[labels], axis=1))
+    return labels, centroids, radii
+
+
+def insideVolume(field, points, radii):
+    # balls that stay between the outermost voxel centres, where the surfaces are closed
+    ijk = VolumeTools.applyMatrix(field.rasToIJK, points)
+    reach = radii / np.linalg.norm(np.linalg.inv(field.rasToIJK)[:3, :3], axis=0).min()
+    upper = np.array(field.field.shape[::-1]) - 1
+    return np.all((ijk >= reach[:, None]) & (ijk <= upper - reach[:, None]), axis=1)
+
+def classifyBlocks(field, entryCentres, entryRadii, targetCentres, targetRadii, margin, chunkSize=1024):
+    """Every segment between the ball around an entry centre and the ball around a
+    target centre stays within max(radii) of the centre segment. A block is clear
+    when that capsule (plus margin) is outside the structure, and blocked when the
+    centre segment passes deeper inside it than the capsule radius while both balls
+    are outside it and inside the volume. Returns +1 clear, -1 blocked, 0 ambiguous.
+    """
+    status = np.zeros(len(entryCentres), dtype=np.int8)
+    if len(entryCentres) == 0:
+        return status
+    capsule = np.maximum(entryRadii, targetRadii) + margin
+    lengths = np.linalg.norm(targetCentres - entryCentres, axis=1)
+    numberOfSamples = int(np.ceil(lengths.max() / (margin / 2.0))) + 2
+    t = np.linspace(0.0, 1.0, numberOfSamples)[None, :, None]
+    endsInside = (insideVolume(field, entryCentres, entryRadii + margin) &
+                  insideVolume(field, targetCentres, targetRadii + margin))
+    for start in range(0, len(entryCentres), chunkSize):
+        block = slice(start, start + chunkSize)
+        p = entryCentres[block, None, :]
+        q = targetCentres[block, None, :]
+        samples = field.sample(p + t * (q - p)).reshape(len(p), -1)
+        # the distance changes by at most the sample spacing between two samples
+        slack = lengths[block] / (numberOfSamples - 1) / 2.0
+        clear = samples.min(axis=1) - slack > capsule[block]
+        endsOutside = (endsInside[block] & (samples[:, 0] > entryRadii[block] + margin) &
+                       (samples[:, -1] > targetRadii[block] + margin))
+        blocked = endsOutside & (samples.min(axis=1) < -capsule[block])
+        status[block] = np.where(clear, 1, np.where(blocked, -1, 0))
+    return status
+
+
+def blockFilter(trajectories, field, exactTest, clusterSizes, margin):
+    """Resolves whole entry-cluster x target-cluster blocks against field, from the
+    coarsest cluster size to the finest, and sends only the pairs still unresolved
+    to exactTest(entries, targets) -> hit mask. Returns the hit mask and counts.
+    """
+    hits = np.zeros(len(trajectories), dtype=bool)
+    unresolved = np.arange(len(trajectories))
+    counts = {'blocksClear': 0, 'blocksBlocked': 0, 'blocksAmbiguous': 0}
+    for clusterSize in clusterSizes:
+        if len(unresolved) == 0:
+            break
+        pairs = trajectories.pairs[unresolved]
+        entryLabels, entryCentres, entryRadii = clusterPoints(trajectories.entries, clusterSize)
+        targetLabels, targetCentres, targetRadii = clusterPoints(trajectories.targets, clusterSize)
+        blockKeys = entryLabels[pairs[:, 0]] * len(targetCentres) + targetLabels[pairs[:, 1]]
+        blocks, pairBlocks = np.unique(blockKeys, return_inverse=True)
+        if len(blocks) * 4 > len(unresolved):
+            # blocks this small cost about as much as the pairs they hold
+            break
+        blockEntries, blockTargets = blocks // len(targetCentres), blocks % len(targetCentres)
+        status = classifyBlocks(field, entryCentres[blockEntries], entryRadii[blockEntries],
+                                targetCentres[blockTargets], targetRadii[blockTargets], margin)
+        pairStatus = status[pairBlocks.ravel()]
+        hits[unresolved[pairStatus < 0]] = True
+        unresolved = unresolved[pairStatus == 0]
+        counts['blocksClear'] += int((status > 0).sum())
+        counts['blocksBlocked'] += int((status < 0).sum())
+        counts['blocksAmbiguous'] = int((status == 0).sum())
+    if len(unresolved):
+        pairs = trajectories.pairs[unresolved]
+        hits[unresolved] = exactTest(trajectories.entries[pairs[:, 0]], trajectories.targets[pairs[:, 1]])
+    counts['pairsTestedExactly'] = len(unresolved)
+    return hits, counts
+
+
+def hierarchicalConstraints(entriesAndTargets, areas, angleConstraint, exactTest, clusterSizes=(32.0, 16.0, 8.0, 4.0)):
+    """Runs the area constraints block by block and the angle constraint on the
+    survivors. areas is a list of (name, volumeNode); exactTest(volumeNode, entries,
+    targets) is the per-pair hit test used for ambiguous blocks, so the result is
+    the same as testing every pair.
+    """
+    totalStart = time.time()
+    trajectories = TrajectorySet.asTrajectorySet(entriesAndTargets)
+    valid = np.ones(len(trajectories), dtype=bool)
+    stages = []
+    for name, area in areas:
+        field = DistanceField.getDistanceField(area)
+        # surfaces lie within a voxel diagonal of the voxel centres and the interpolated
+        # field is within another diagonal of the exact distance
+        margin = 4.0 * float(np.linalg.norm(np.linalg.inv(field.rasToIJK)[:3, :3], axis=0).max())
+        rows = np.nonzero(valid)[0]
+        startTime = time.time()
+        with Instrumentation.span('constraint.' + name, pairsIn=len(rows)) as spanCounters:
+            hits, counts = blockFilter(trajectories.filter(valid), field,
+                                       lambda entries, targets: exactTest(area, entries, targets), clusterSizes, margin)
+            spanCounters['pairsOut'] = len(rows) - int(hits.sum())
+            spanCounters.update(counts)
+        valid[rows[hits]] = False
+        stage = {'name': name, 'seconds': time.time() - startTime, 'pairsIn': len(rows),
+                 'pairsOut': len(rows) - int(hits.sum()), 'rejected': int(hits.sum())}
+        stage.update(counts)
+        stages.append(stage)
+
+    rows = np.nonzero(valid)[0]
+    startTime = time.time()
+    with Instrumentation.span('constraint.' + angleConstraint.name, pairsIn=len(rows)) as spanCounters:
+        keep = np.asarray(angleConstraint.evaluate(trajectories.entries[trajectories.pairs[rows, 0]],
+                                                   trajectories.targets[trajectories.pairs[rows, 1]]), dtype=bool)
+        spanCounters['pairsOut'] = int(keep.sum())
+    valid[rows[~keep]] = False
+    stages.append({'name': angleConstraint.name, 'seconds': time.time() - startTime, 'pairsIn': len(rows),
+                   'pairsOut': int(keep.sum()), 'rejected': int((~keep).sum())})
+    return ConstraintPipeline.PipelineResult(trajectories.filter(valid), stages, [stage['name'] for stage in stages],
+                                             0.0, time.time() - totalStart, valid)
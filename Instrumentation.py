@@ -0,0 +1,313 @@
+"""Named spans and counters for the planning steps. Nothing is recorded until a
+Recorder is installed, so the calls left in the code cost a function call:
+
+    recorder = Instrumentation.Recorder(memory=True, profiler='cprofile')
+    with Instrumentation.recording(recorder):
+        logic.run(...)
+    recorder.writeChromeTrace('trace.json')  # chrome://tracing or ui.perfetto.dev
+"""
+import collections
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def maximumResidentBytes():
+    if resource is None:
+        return 0
+    # kilobytes on Linux, bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+class NullSpan(object):
+
+    def __enter__(self):
+        # callers may add counters to the span, they are dropped
+        return {}
+
+    def __exit__(self, *exception):
+        return False
+
+
+class NullRecorder(object):
+    enabled = False
+
+    def span(self, name, **counters):
+        return NullSpan()
+
+    def count(self, name, value=1):
+        pass
+
+
+class Span(object):
+
+    def __init__(self, recorder, name, counters):
+        self.recorder = recorder
+        self.record = {'name': name, 'counters': counters}
+
+    def __enter__(self):
+        recorder = self.recorder
+        stack = recorder.stack()
+        record = self.record
+        record['thread'] = threading.current_thread().name
+        record['threadId'] = threading.current_thread().ident
+        record['depth'] = len(stack)
+        if recorder.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            record['startTracedBytes'] = current
+            # the peak since the parent started, kept so the reset below does not lose it
+            record['outerPeak'] = peak
+            record['childPeak'] = current
+            # Python < 3.9 cannot reset the peak, the span then reports the peak since tracing started
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+        record['startRSSBytes'] = maximumResidentBytes()
+        stack.append(record)
+        record['start'] = time.perf_counter()
+        return record['counters']
+
+    def __exit__(self, *exception):
+        recorder = self.recorder
+        record = self.record
+        record['seconds'] = time.perf_counter() - record['start']
+        record['start'] -= recorder.origin
+        stack = recorder.stack()
+        stack.pop()
+        record['peakRSSGrowthBytes'] = maximumResidentBytes() - record.pop('startRSSBytes')
+        if recorder.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            peak = max(peak, record.pop('childPeak'))
+            record['peakTracedBytes'] = peak - record['startTracedBytes']
+            record['allocatedBytes'] = current - record.pop('startTracedBytes')
+            outerPeak = record.pop('outerPeak')
+            if stack:
+                stack[-1]['childPeak'] = max(stack[-1]['childPeak'], peak, outerPeak)
+        if exception[0] is not None:
+            record['error'] = exception[0].__name__
+        recorder.add(record)
+        return False
+
+
+class Sampler(object):
+    """Samples the Python stack of every other thread every interval seconds and
+    counts them as 'outer;...;inner' stacks (the collapsed format of flame graphs).
+    """
+
+    def __init__(self, interval=0.005, depth=12):
+        self.interval = interval
+        self.depth = depth
+        self.stacks = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.sample, name='Instrumentation.Sampler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def sample(self):
+        ownId = threading.current_thread().ident
+        while not self.stopped.wait(self.interval):
+            for threadId, frame in sys._current_frames().items():
+                if threadId == ownId:
+                    continue
+                names = []
+                while frame is not None and len(names) < self.depth:
+                    code = frame.f_code
+                    names.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), frame.f_lineno))
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(names))] += 1
+
+    def top(self, count=25):
+        return [{'stack': stack, 'samples': samples} for stack, samples in self.stacks.most_common(count)]
+
+
+class Recorder(object):
+    """Collects spans (name, thread, start, seconds, counters and, with memory=True,
+    the tracemalloc peak above the span's start) and global counters. profiler is
+    None, 'cprofile' or 'sampling' and runs between start() and stop().
+    """
+    enabled = True
+
+    def __init__(self, memory=False, profiler=None, sampleInterval=0.005):
+        if profiler not in (None, 'cprofile', 'sampling'):
+            raise ValueError('unknown profiler: %s' % profiler)
+        self.memory = memory
+        self.profiler = profiler
+        self.sampleInterval = sampleInterval
+        self.spans = []
+        self.counters = collections.Counter()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.origin = time.perf_counter()
+        self.profile = None
+        self.sampler = None
+        self.startedTracing = False
+
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def span(self, name, **counters):
+        return Span(self, name, counters)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def add(self, record):
+        with self.lock:
+            self.spans.append(record)
+
+    def merge(self, spans, counters, origin, thread, threadId):
+        # the spans and counters of a worker process, perf_counter is one clock for the processes of a machine
+        with self.lock:
+            for record in spans:
+                self.spans.append(dict(record, start=record['start'] + origin - self.origin, thread=thread,
+                                       threadId=threadId))
+            self.counters.update(counters)
+
+    def start(self):
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.startedTracing = True
+        if self.profiler == 'cprofile':
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        elif self.profiler == 'sampling':
+            self.sampler = Sampler(self.sampleInterval)
+            self.sampler.start()
+
+    def stop(self):
+        if self.profile is not None:
+            self.profile.disable()
+        if self.sampler is not None:
+            self.sampler.stop()
+        if self.startedTracing:
+            tracemalloc.stop()
+            self.startedTracing = False
+
+    def totals(self):
+        # seconds, calls and summed counters by span name
+        totals = collections.OrderedDict()
+        for record in sorted(self.spans, key=lambda record: record['start']):
+            total = totals.setdefault(record['name'], {'calls': 0, 'seconds': 0.0})
+            total['calls'] += 1
+            total['seconds'] += record['seconds']
+            for key, value in record['counters'].items():
+                if isinstance(value, (int, float)):
+                    total[key] = total.get(key, 0) + value
+            if 'peakTracedBytes' in record:
+                total['peakTracedBytes'] = max(total.get('peakTracedBytes', 0), record['peakTracedBytes'])
+        return totals
+
+    def profileStatistics(self, count=25):
+        if self.profile is None:
+            return None
+        output = io.StringIO()
+        pstats.Stats(self.profile, stream=output).sort_stats('cumulative').print_stats(count)
+        return output.getvalue()
+
+    def asDict(self):
+        result = {'spans': sorted(self.spans, key=lambda record: record['start']), 'totals': self.totals(),
+                  'counters': dict(self.counters), 'maximumResidentBytes': maximumResidentBytes()}
+        if self.profile is not None:
+            result['profile'] = self.profileStatistics()
+        if self.sampler is not None:
+            result['samples'] = self.sampler.top()
+        return result
+
+    def report(self):
+        lines = ['Instrumentation:']
+        for name, total in self.totals().items():
+            extra = ', '.join('%s %s' % (key, value) for key, value in total.items() if key not in ('calls', 'seconds'))
+            lines.append('  %s: %d calls, %.4f seconds%s' % (name, total['calls'], total['seconds'],
+                                                            ', ' + extra if extra else ''))
+        for name, value in sorted(self.counters.items()):
+            lines.append('  %s: %s' % (name, value))
+        return '\n'.join(lines)
+
+    def writeJSON(self, path):
+        with open(path, 'w') as outputFile:
+            json.dump(self.asDict(), outputFile, indent=2)
+
+    def chromeTrace(self):
+        # complete ('X') events in microseconds, counters as one 'C' event at the end
+        pid = os.getpid()
+        events = []
+        threads = {}
+        end = 0.0
+        for record in self.spans:
+            threads[record['threadId']] = record['thread']
+            args = dict(record['counters'])
+            for key in ('peakTracedBytes', 'allocatedBytes', 'peakRSSGrowthBytes', 'error'):
+                if key in record:
+                    args[key] = record[key]
+            events.append({'name': record['name'], 'ph': 'X', 'pid': pid, 'tid': record['threadId'],
+                           'ts': record['start'] * 1e6, 'dur': record['seconds'] * 1e6, 'args': args})
+            end = max(end, record['start'] + record['seconds'])
+        for threadId, name in threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': threadId, 'args': {'name': name}})
+        if self.counters:
+            events.append({'name': 'counters', 'ph': 'C', 'pid': pid, 'tid': 0, 'ts': end * 1e6,
+                           'args': dict(self.counters)})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def writeChromeTrace(self, path):
+        with open(path, 'w') as outputFile:
+            json.dump(self.chromeTrace(), outputFile)
+
+
+recorder = NullRecorder()
+
+def getRecorder():
+    return recorder
+
+def setRecorder(newRecorder):
+    # returns the recorder that was installed, None turns recording off
+    global recorder
+    previous = recorder
+    recorder = newRecorder if newRecorder is not None else NullRecorder()
+    return previous
+
+def span(name, **counters):
+    return recorder.span(name, **counters)
+
+def count(name, value=1):
+    recorder.count(name, value)
+
+
+class recording(object):
+    """Installs newRecorder and runs its profiler for the duration of a with block."""
+
+    def __init__(self, newRecorder):
+        self.recorder = newRecorder
+        self.previous = None
+
+    def __enter__(self):
+        self.previous = setRecorder(self.recorder)
+        self.recorder.start()
+        return self.recorder
+
+    def __exit__(self, *exception):
+        self.recorder.stop()
+        setRecorder(self.previous)
+        return False
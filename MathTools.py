@@ -1,15 +1,48 @@
 import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+# node ID -> (modified time, read-only (N,3) coordinates)
+coordinatesCache = {}
 
 def getCoordinates(points, pointIndex):
     pos = [0, 0, 0]
     points.GetNthFiducialPosition(pointIndex, pos)
     return pos
 
+def getCoordinatesArray(points):
+    """All control points of a markup node as one read-only (N,3) float64 array,
+    kept until the node is modified. Index it instead of calling getCoordinates.
+    """
+    key = points.GetID()
+    cached = coordinatesCache.get(key)
+    if cached is not None and cached[0] == points.GetMTime() and len(cached[1]) == points.GetNumberOfMarkups():
+        return cached[1]
+    coordinates = readCoordinates(points)
+    coordinates.setflags(write=False)
+    coordinatesCache[key] = (points.GetMTime(), coordinates)
+    return coordinates
+
+def readCoordinates(points):
+    # world and local positions are the same without a parent transform, which is what getCoordinates returns
+    if hasattr(points, 'GetControlPointPositionsWorld') and points.GetParentTransformNode() is None:
+        positions = vtk.vtkPoints()
+        positions.SetDataTypeToDouble()
+        points.GetControlPointPositionsWorld(positions)
+        if positions.GetNumberOfPoints() == 0:
+            return np.zeros((0, 3))
+        return numpy_support.vtk_to_numpy(positions.GetData()).astype(np.float64, copy=False).reshape(-1, 3)
+    coordinates = np.zeros((int(points.GetNumberOfMarkups()), 3))
+    for i in range(len(coordinates)):
+        coordinates[i] = getCoordinates(points, i)
+    return coordinates
+
 def getAngle(entryPoint, intersectionPoint, p1, p2, p3):
+    # the face normal's sign depends on the triangle winding, so the line/normal angle is folded into [0, 90]
     vectorPerpendicular = returnPerpendicularVectorFromThreePoints(p1, p2, p3)
     vectorIntersection = returnVectorFromPoints(intersectionPoint, entryPoint)
     angle = angleInDegreesBetweenTwoVectors(vectorPerpendicular, vectorIntersection)
-    return angle
+    return min(angle, 180.0 - angle)
 
 def getTrianglePoints(pointsInCell, polyData):
     p1 = polyData.GetPoint(pointsInCell.GetId(0))
@@ -21,7 +54,8 @@ def angleInDegreesBetweenTwoVectors(vector1, vector2):
     dotProduct = np.dot(vector1, vector2)
     magnitudeVector1 = magnitudeVector(vector1)
     magnitudeVector2 = magnitudeVector(vector2)
-    angle = np.degrees(dotProduct / (magnitudeVector1 * magnitudeVector2))
+    cosine = np.clip(dotProduct / (magnitudeVector1 * magnitudeVector2), -1.0, 1.0)
+    angle = np.degrees(np.arccos(cosine))
     return angle
 
 def magnitudeVector(vector):
@@ -41,3 +75,30 @@ def returnVectorFromPoints(point1, point2):
 def getDistanceBetweenPoints(point1, point2):
     distance = magnitudeVector(returnVectorFromPoints(point1,point2))
     return distance
+
+# array versions of the kernels above, points and vectors are (N,3) arrays
+
+def getAngles(entryPoints, intersectionPoints, p1, p2, p3):
+    vectorsPerpendicular = perpendicularVectorsFromThreePoints(p1, p2, p3)
+    vectorsIntersection = vectorsFromPoints(intersectionPoints, entryPoints)
+    angles = anglesInDegreesBetweenVectors(vectorsPerpendicular, vectorsIntersection)
+    return np.minimum(angles, 180.0 - angles)
+
+def anglesInDegreesBetweenVectors(vectors1, vectors2):
+    dotProducts = np.einsum('ij,ij->i', vectors1, vectors2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cosines = dotProducts / (magnitudeVectors(vectors1) * magnitudeVectors(vectors2))
+    return np.degrees(np.arccos(np.clip(cosines, -1.0, 1.0)))
+
+def magnitudeVectors(vectors):
+    vectors = np.asarray(vectors, dtype=np.float64)
+    return np.sqrt(np.einsum('ij,ij->i', vectors, vectors))
+
+def perpendicularVectorsFromThreePoints(points1, points2, points3):
+    return np.cross(vectorsFromPoints(points1, points2), vectorsFromPoints(points1, points3))
+
+def vectorsFromPoints(points1, points2):
+    return np.asarray(points2, dtype=np.float64).reshape(-1, 3) - np.asarray(points1, dtype=np.float64).reshape(-1, 3)
+
+def getDistancesBetweenPoints(points1, points2):
+    return magnitudeVectors(vectorsFromPoints(points1, points2))
@@ -0,0 +1,273 @@
+import collections
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import zipfile
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+import Instrumentation
+import MeshTools
+import SurfaceDistance
+import VolumeTools
+
+# background planning runs share the caches with the main thread: one lock guards the surfaces and
+# the locators built from them here, and the distance fields and occupancy pyramids of their modules
+cacheLock = threading.RLock()
+
+
+class CachedSurface(object):
+    """Surface of one label volume and iso-value, locators are built on first use.
+    With a locatorPrefix (the cache path of the surface without extension) the
+    arrays of the triangle grid and the BVH are saved next to the surface files and
+    loaded instead of being built again.
+    """
+
+    def __init__(self, polyData, triangles=None, locatorPrefix=None):
+        self.polyData = polyData
+        self.triangles = MeshTools.getTriangles(polyData) if triangles is None else triangles
+        self.locatorPrefix = locatorPrefix
+        self.obbTree = None
+        self.cellLocator = None
+        self.triangleGrid = None
+        self.bvh = None
+
+    # the locators are built once under cacheLock, a second thread waits for them
+    def getOBBTree(self):
+        with cacheLock:
+            if self.obbTree is None:
+                with Instrumentation.span('locatorBuild.obbTree', triangles=len(self.triangles)):
+                    self.obbTree = vtk.vtkOBBTree()
+                    self.obbTree.SetDataSet(self.polyData)
+                    self.obbTree.BuildLocator()
+            return self.obbTree
+
+    def getCellLocator(self):
+        with cacheLock:
+            if self.cellLocator is None:
+                with Instrumentation.span('locatorBuild.cellLocator', triangles=len(self.triangles)):
+                    self.cellLocator = vtk.vtkCellLocator()
+                    self.cellLocator.SetDataSet(self.polyData)
+                    self.cellLocator.BuildLocator()
+            return self.cellLocator
+
+    def getTriangleGrid(self, normals=False):
+        # normals=True also gives the grid its surface normals, which are saved as their own locator entry
+        with cacheLock:
+            if self.triangleGrid is None:
+                with Instrumentation.span('locatorBuild.triangleGrid', triangles=len(self.triangles)):
+                    self.triangleGrid = self.loadLocator('grid', MeshTools.TriangleGrid.fromArrays)
+                    if self.triangleGrid is None:
+                        self.triangleGrid = MeshTools.TriangleGrid(self.triangles)
+                        self.saveLocator('grid', self.triangleGrid.arrays())
+            grid = self.triangleGrid
+            if normals and grid.faceNormals is None:
+                with Instrumentation.span('locatorBuild.normals', triangles=len(self.triangles)):
+                    loaded = self.loadLocator('normals', lambda arrays: (arrays['faceNormals'], arrays['smoothNormals'],
+                                                                         arrays['cornerNormals']))
+                    if loaded is None:
+                        grid.computeNormals()
+                        self.saveLocator('normals', {'faceNormals': grid.faceNormals, 'smoothNormals': grid.smoothNormals,
+                                                     'cornerNormals': grid.cornerNormals})
+                    else:
+                        grid.faceNormals, grid.smoothNormals, grid.cornerNormals = loaded
+            return grid
+
+    def getBVH(self):
+        with cacheLock:
+            if self.bvh is None:
+                with Instrumentation.span('locatorBuild.bvh', triangles=len(self.triangles)):
+                    self.bvh = self.loadLocator('bvh', SurfaceDistance.TriangleBVH.fromArrays)
+                    if self.bvh is None:
+                        self.bvh = SurfaceDistance.TriangleBVH(self.triangles)
+                        self.saveLocator('bvh', self.bvh.arrays())
+            return self.bvh
+
+    def locatorPath(self, name):
+        return self.locatorPrefix + '.' + name + '.npz'
+
+    def loadLocator(self, name, fromArrays):
+        # None without a saved locator, an unreadable or mismatched one is deleted so it is saved again
+        if self.locatorPrefix is None or not os.path.exists(self.locatorPath(name)):
+            return None
+        try:
+            with np.load(self.locatorPath(name)) as data:
+                arrays = dict((key, data[key]) for key in data.files)
+            if int(arrays.pop('numberOfTriangles')[0]) != len(self.triangles):
+                raise ValueError('locator of another surface')
+            arrays.setdefault('triangles', self.triangles)
+            return fromArrays(arrays)
+        except (IOError, OSError, EOFError, ValueError, KeyError, IndexError, zipfile.BadZipfile) as error:
+            logging.warning('Discarding %s locator %s: %s', name, self.locatorPath(name), error)
+            removeFile(self.locatorPath(name))
+            return None
+
+    def saveLocator(self, name, arrays):
+        if self.locatorPrefix is None:
+            return
+        # the triangles are already in the .npy of the surface, a locator that sorts them keeps its own copy
+        arrays = dict(arrays, numberOfTriangles=np.array([len(self.triangles)]))
+        if 'triangles' in arrays and np.array_equal(arrays['triangles'], self.triangles):
+            del arrays['triangles']
+        writeAtomically(self.locatorPath(name), lambda path: saveArrays(path, np.savez, **arrays))
+
+
+class MeshCache(object):
+    """Surfaces keyed by a hash of the image data and the iso-value, with an LRU
+    memory tier and an optional on-disk tier (.vtp plus the triangle array as .npy,
+    and the arrays of the locators built for it as .npz).
+    """
+
+    def __init__(self, cacheDirectory=None, maximumEntries=8):
+        self.cacheDirectory = cacheDirectory
+        self.maximumEntries = maximumEntries
+        self.entries = collections.OrderedDict()
+        self.keysByNode = {}
+        self.memoryHits = 0
+        self.diskHits = 0
+        self.misses = 0
+        self.lock = cacheLock
+
+    def contentKey(self, area, value=None):
+        # hashing the voxels is only redone when the node or its image data changed
+        imageData = area.GetImageData()
+        nodeKey = (area.GetID() if hasattr(area, 'GetID') else id(area), value)
+        modifiedTime = max(area.GetMTime(), imageData.GetMTime())
+        cached = self.keysByNode.get(nodeKey)
+        if cached is not None and cached[0] == modifiedTime:
+            return cached[1]
+        digest = hashlib.sha1()
+        digest.update(repr((imageData.GetDimensions(), imageData.GetSpacing(), imageData.GetOrigin(), value,
+                            np.round(VolumeTools.getIJKToRAS(area), 9).tolist())).encode())
+        scalars = numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars())
+        digest.update(str(scalars.dtype).encode())
+        digest.update(np.ascontiguousarray(scalars).tobytes())
+        key = digest.hexdigest()
+        self.keysByNode[nodeKey] = (modifiedTime, key)
+        return key
+
+    def getSurface(self, area, value=None):
+        with self.lock:
+            key = self.contentKey(area, value)
+            if key in self.entries:
+                self.memoryHits += 1
+                Instrumentation.count('meshCache.memoryHits')
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            surface = self.readFromDisk(key)
+            if surface is not None:
+                self.diskHits += 1
+                Instrumentation.count('meshCache.diskHits')
+            else:
+                self.misses += 1
+                Instrumentation.count('meshCache.misses')
+                with Instrumentation.span('meshBuild') as counters:
+                    surface = CachedSurface(MeshTools.extractSurface(area.GetImageData(), value, VolumeTools.getIJKToRAS(area)))
+                    counters['triangles'] = len(surface.triangles)
+                if self.writeToDisk(key, surface):
+                    surface.locatorPrefix = os.path.join(self.cacheDirectory, key)
+            self.entries[key] = surface
+            while len(self.entries) > self.maximumEntries:
+                self.entries.popitem(last=False)
+            return surface
+
+    def paths(self, key):
+        return os.path.join(self.cacheDirectory, key + '.vtp'), os.path.join(self.cacheDirectory, key + '.npy')
+
+    def readFromDisk(self, key):
+        if not self.cacheDirectory:
+            return None
+        polyDataPath, trianglesPath = self.paths(key)
+        if not (os.path.exists(polyDataPath) and os.path.exists(trianglesPath)):
+            return None
+        # an entry of an older layout or cut short by a killed process is dropped and rebuilt
+        try:
+            with open(polyDataPath, 'rb') as polyDataFile:
+                polyDataFile.seek(max(os.path.getsize(polyDataPath) - 64, 0))
+                if b'</VTKFile>' not in polyDataFile.read():
+                    raise ValueError('incomplete surface file')
+            triangles = np.load(trianglesPath)
+            reader = vtk.vtkXMLPolyDataReader()
+            reader.SetFileName(polyDataPath)
+            reader.Update()
+            polyData = reader.GetOutput()
+            if triangles.shape[1:] != (3, 3) or polyData.GetNumberOfPolys() != len(triangles):
+                raise ValueError('surface and triangle files do not match')
+        except (IOError, OSError, EOFError, ValueError) as error:
+            logging.warning('Discarding mesh cache entry %s: %s', key, error)
+            self.removeFromDisk(key)
+            return None
+        return CachedSurface(polyData, triangles, os.path.join(self.cacheDirectory, key))
+
+    def writeToDisk(self, key, surface):
+        # True once both files are in place
+        if not self.cacheDirectory:
+            return False
+        polyDataPath, trianglesPath = self.paths(key)
+
+        def writePolyData(path):
+            writer = vtk.vtkXMLPolyDataWriter()
+            writer.SetFileName(path)
+            writer.SetInputData(surface.polyData)
+            writer.SetDataModeToBinary()
+            if not writer.Write():
+                raise IOError('vtkXMLPolyDataWriter failed')
+
+        # the triangles go first, readers need both files and never see a partial one
+        return (writeAtomically(trianglesPath, lambda path: saveArrays(path, np.save, surface.triangles))
+                and writeAtomically(polyDataPath, writePolyData))
+
+    def removeFromDisk(self, key):
+        # the surface files and every locator saved with them
+        for name in os.listdir(self.cacheDirectory):
+            if name.startswith(key + '.'):
+                removeFile(os.path.join(self.cacheDirectory, name))
+
+    def statistics(self):
+        return {'memoryHits': self.memoryHits, 'diskHits': self.diskHits, 'misses': self.misses,
+                'entries': len(self.entries)}
+
+    def clear(self):
+        self.entries.clear()
+        self.keysByNode.clear()
+
+
+def writeAtomically(path, write):
+    """Calls write with a temporary path in the folder of path, then moves that
+    file to path, so readers see the old file or the whole new one. Returns False
+    (and logs why) when it could not.
+    """
+    temporaryPath = None
+    try:
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            os.makedirs(folder, exist_ok=True)
+        # a fixed suffix, the VTK writers drop a trailing underscore from the file name
+        handle, temporaryPath = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', suffix='.tmp', dir=folder)
+        os.close(handle)
+        write(temporaryPath)
+        os.replace(temporaryPath, path)
+        return True
+    except (IOError, OSError) as error:
+        logging.warning('Could not write mesh cache file %s: %s', path, error)
+        return False
+    finally:
+        if temporaryPath is not None and os.path.exists(temporaryPath):
+            os.remove(temporaryPath)
+
+def saveArrays(path, save, *arrays, **namedArrays):
+    # through a file object, numpy would add its extension to a path
+    with open(path, 'wb') as arrayFile:
+        save(arrayFile, *arrays, **namedArrays)
+
+def removeFile(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+# memory only unless TASK1_MESH_CACHE names a folder for the disk tier
+defaultCache = MeshCache(os.environ.get('TASK1_MESH_CACHE') or None)
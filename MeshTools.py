@@ -0,0 +1,378 @@
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+
+def extractSurface(imageData, value=None, ijkToRAS=None):
+    # marching cubes works in image coordinates, ijkToRAS moves the surface into the RAS frame of the fiducials
+    if value is not None:
+        mesh = vtk.vtkMarchingCubes()
+        mesh.SetInputData(imageData)
+        mesh.SetValue(value[0], value[1])
+    else:
+        mesh = vtk.vtkDiscreteMarchingCubes()
+        mesh.SetInputData(imageData)
+    mesh.Update()
+    if ijkToRAS is None:
+        return mesh.GetOutput()
+    return transformPolyData(mesh.GetOutput(), ijkToRAS)
+
+def transformPolyData(polyData, matrix):
+    # polyData moved by a 4x4 matrix, the winding of flipped frames is left as is
+    if np.allclose(matrix, np.eye(4)):
+        return polyData
+    transform = vtk.vtkTransform()
+    transform.SetMatrix(list(np.asarray(matrix, dtype=np.float64).ravel()))
+    transformFilter = vtk.vtkTransformPolyDataFilter()
+    transformFilter.SetInputData(polyData)
+    transformFilter.SetTransform(transform)
+    transformFilter.Update()
+    return transformFilter.GetOutput()
+
+
+def getTriangles(polyData):
+    # (M,3,3) array of triangle corners, index i is cell id i of a polys-only poly data
+    if polyData.GetPoints() is None or polyData.GetNumberOfPolys() == 0:
+        return np.zeros((0, 3, 3))
+    points = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData()).astype(np.float64)
+    polys = polyData.GetPolys()
+    if hasattr(polys, 'GetConnectivityArray'):
+        ids = numpy_support.vtk_to_numpy(polys.GetConnectivityArray()).reshape(-1, 3)
+    else:
+        ids = numpy_support.vtk_to_numpy(polys.GetData()).reshape(-1, 4)[:, 1:]
+    return points[ids]
+
+
+def linesPolyData(points, lines, cellScalars=None):
+    """Poly data of (L,2) point index pairs into the (P,3) points, filled from the
+    arrays in one call each. cellScalars is an optional list of (name, (L,) values)
+    added as cell data, the first one is the active scalars.
+    """
+    points = np.ascontiguousarray(points, dtype=np.float64).reshape(-1, 3)
+    lines = np.ascontiguousarray(lines, dtype=np.int64).reshape(-1, 2)
+    vtkPoints = vtk.vtkPoints()
+    vtkPoints.SetData(numpy_support.numpy_to_vtk(points, deep=True))
+    cells = vtk.vtkCellArray()
+    if hasattr(cells, 'SetData') and hasattr(cells, 'GetConnectivityArray'):
+        offsets = numpy_support.numpy_to_vtkIdTypeArray(np.arange(0, 2 * len(lines) + 1, 2, dtype=np.int64), deep=True)
+        connectivity = numpy_support.numpy_to_vtkIdTypeArray(lines.ravel(), deep=True)
+        cells.SetData(offsets, connectivity)
+    else:
+        legacy = np.hstack([np.full((len(lines), 1), 2, dtype=np.int64), lines]).ravel()
+        cells.SetCells(len(lines), numpy_support.numpy_to_vtkIdTypeArray(legacy, deep=True))
+    polyData = vtk.vtkPolyData()
+    polyData.SetPoints(vtkPoints)
+    polyData.SetLines(cells)
+    for index, (name, values) in enumerate(cellScalars or []):
+        array = numpy_support.numpy_to_vtk(np.ascontiguousarray(values, dtype=np.float64).ravel(), deep=True)
+        array.SetName(name)
+        if index == 0:
+            polyData.GetCellData().SetScalars(array)
+        else:
+            polyData.GetCellData().AddArray(array)
+    return polyData
+
+
+def unitVectors(vectors):
+    lengths = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return np.where(lengths > 0.0, vectors / np.where(lengths > 0.0, lengths, 1.0), 0.0)
+
+def surfaceNormals(triangles):
+    """Unit normals of an (M,3,3) triangle surface: per triangle (face), per triangle
+    averaged over its corners (smooth) and per corner (M,3,3), where a vertex normal is
+    the area weighted sum of the faces around it. Marching cubes winds every triangle
+    the same way, the whole surface is flipped when needed so the normals of a closed
+    surface point outwards.
+    """
+    triangles = np.asarray(triangles, dtype=np.float64).reshape(-1, 3, 3)
+    if len(triangles) == 0:
+        return np.zeros((0, 3)), np.zeros((0, 3)), np.zeros((0, 3, 3))
+    # twice the area times the unit normal
+    areaNormals = cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+    if dot(triangles[:, 0], areaNormals).sum() < 0.0:
+        areaNormals = -areaNormals
+    _, vertexIds = np.unique(triangles.reshape(-1, 3), axis=0, return_inverse=True)
+    vertexIds = vertexIds.ravel()
+    vertexNormals = np.stack([np.bincount(vertexIds, weights=np.repeat(areaNormals[:, axis], 3))
+                              for axis in range(3)], axis=1)
+    cornerNormals = unitVectors(vertexNormals)[vertexIds].reshape(-1, 3, 3)
+    return unitVectors(areaNormals), unitVectors(cornerNormals.sum(axis=1)), cornerNormals
+
+
+class TriangleGrid(object):
+    """Uniform grid over the triangles of a surface, each triangle is stored in every
+    cell touched by its bounding box grown by a quarter of a cell. Segments sampled
+    every half cell then visit every cell holding a triangle they could cross.
+    Only occupied cells are stored (sorted flat ids in occupiedCells), so memory
+    follows the number of triangles and not the number of cells of the grid.
+    """
+
+    def __init__(self, triangles, cellSize=None):
+        self.triangles = np.ascontiguousarray(triangles, dtype=np.float64).reshape(-1, 3, 3)
+        if cellSize is None:
+            cellSize = self.defaultCellSize(self.triangles)
+        self.cellSize = float(cellSize)
+        self.dilation = self.cellSize / 4.0
+        self.vertex = self.triangles[:, 0]
+        self.edge1 = self.triangles[:, 1] - self.vertex
+        self.edge2 = self.triangles[:, 2] - self.vertex
+        self.faceNormals = self.smoothNormals = self.cornerNormals = None
+        if len(self.triangles) == 0:
+            self.origin = np.zeros(3)
+            self.shape = np.ones(3, dtype=np.int64)
+            self.occupiedCells = np.zeros(0, dtype=np.int64)
+            self.cellStart = np.zeros(1, dtype=np.int64)
+            self.cellTriangles = np.zeros(0, dtype=np.int64)
+            return
+
+        lower = self.triangles.min(axis=1) - self.dilation
+        upper = self.triangles.max(axis=1) + self.dilation
+        self.origin = lower.min(axis=0)
+        self.shape = np.floor((upper.max(axis=0) - self.origin) / self.cellSize).astype(np.int64) + 1
+
+        lo = np.floor((lower - self.origin) / self.cellSize).astype(np.int64)
+        hi = np.floor((upper - self.origin) / self.cellSize).astype(np.int64)
+        spans = hi - lo + 1
+        maxSpan = spans.max(axis=0)
+        cellIds = []
+        triangleIds = []
+        for dx in range(maxSpan[0]):
+            for dy in range(maxSpan[1]):
+                for dz in range(maxSpan[2]):
+                    valid = (dx < spans[:, 0]) & (dy < spans[:, 1]) & (dz < spans[:, 2])
+                    cells = lo[valid] + np.array([dx, dy, dz])
+                    cellIds.append(self.flatten(cells))
+                    triangleIds.append(np.nonzero(valid)[0])
+        cellIds = np.concatenate(cellIds)
+        triangleIds = np.concatenate(triangleIds)
+        order = np.argsort(cellIds, kind='stable')
+        self.occupiedCells, counts = np.unique(cellIds, return_counts=True)
+        self.cellStart = np.concatenate([[0], np.cumsum(counts)])
+        self.cellTriangles = triangleIds[order]
+
+    @classmethod
+    def fromArrays(cls, arrays):
+        # rebuilds a grid from arrays(), without binning the triangles again
+        grid = cls.__new__(cls)
+        grid.triangles = arrays['triangles']
+        grid.cellSize = float(arrays['cellSize'][0])
+        grid.dilation = grid.cellSize / 4.0
+        grid.vertex = grid.triangles[:, 0]
+        grid.edge1 = grid.triangles[:, 1] - grid.vertex
+        grid.edge2 = grid.triangles[:, 2] - grid.vertex
+        grid.origin = arrays['origin']
+        grid.shape = arrays['shape']
+        grid.occupiedCells = arrays['occupiedCells']
+        grid.cellStart = arrays['cellStart']
+        grid.cellTriangles = arrays['cellTriangles']
+        grid.faceNormals = arrays.get('faceNormals')
+        grid.smoothNormals = arrays.get('smoothNormals')
+        grid.cornerNormals = arrays.get('cornerNormals')
+        return grid
+
+    def arrays(self):
+        arrays = {'triangles': self.triangles, 'cellSize': np.array([self.cellSize]), 'origin': self.origin,
+                  'shape': self.shape, 'occupiedCells': self.occupiedCells, 'cellStart': self.cellStart,
+                  'cellTriangles': self.cellTriangles}
+        if self.faceNormals is not None:
+            arrays.update(faceNormals=self.faceNormals, smoothNormals=self.smoothNormals, cornerNormals=self.cornerNormals)
+        return arrays
+
+    def computeNormals(self):
+        # kept with the grid (and in arrays()) once computed
+        if self.faceNormals is None:
+            self.faceNormals, self.smoothNormals, self.cornerNormals = surfaceNormals(self.triangles)
+        return self
+
+    @staticmethod
+    def defaultCellSize(triangles):
+        if len(triangles) == 0:
+            return 1.0
+        edges = np.linalg.norm(triangles[:, 1] - triangles[:, 0], axis=1)
+        extent = triangles.reshape(-1, 3).max(axis=0) - triangles.reshape(-1, 3).min(axis=0)
+        return max(float(edges.mean()), float(extent.max()) / 256.0, 1e-6)
+
+    def bounds(self, margin=1e-3):
+        # RAS box of the triangles, None without any
+        if len(self.triangles) == 0:
+            return None
+        points = self.triangles.reshape(-1, 3)
+        return points.min(axis=0) - margin, points.max(axis=0) + margin
+
+    def flatten(self, cells):
+        return (cells[:, 0] * self.shape[1] + cells[:, 1]) * self.shape[2] + cells[:, 2]
+
+    def occupiedIndex(self, cellIds):
+        # index of each flat cell id in occupiedCells and whether the cell holds any triangle
+        if len(self.occupiedCells) == 0:
+            return np.zeros(len(cellIds), dtype=np.int64), np.zeros(len(cellIds), dtype=bool)
+        index = np.minimum(np.searchsorted(self.occupiedCells, cellIds), len(self.occupiedCells) - 1)
+        return index, self.occupiedCells[index] == cellIds
+
+    def candidatePairs(self, entries, targets):
+        # (segment, triangle) pairs whose triangle may cross the segment
+        lengths = np.linalg.norm(targets - entries, axis=1)
+        counts = np.ceil(lengths / (self.cellSize / 2.0)).astype(np.int64) + 1
+        starts = np.cumsum(counts) - counts
+        segmentIds = np.repeat(np.arange(len(entries)), counts)
+        steps = np.arange(int(counts.sum())) - np.repeat(starts, counts)
+        t = (steps / np.maximum(counts - 1, 1)[segmentIds])[:, None]
+        samples = entries[segmentIds] + t * (targets[segmentIds] - entries[segmentIds])
+
+        cells = np.floor((samples - self.origin) / self.cellSize).astype(np.int64)
+        inside = np.all((cells >= 0) & (cells < self.shape), axis=1)
+        segmentIds = segmentIds[inside]
+        index, occupied = self.occupiedIndex(self.flatten(cells[inside]))
+        numberOfOccupied = len(self.occupiedCells)
+        keys = segmentIds[occupied] * numberOfOccupied + index[occupied]
+        # consecutive samples mostly share a cell, drop those repeats before sorting
+        changed = np.ones(len(keys), dtype=bool)
+        changed[1:] = keys[1:] != keys[:-1]
+        keys = np.unique(keys[changed])
+        segmentIds = keys // numberOfOccupied
+        index = keys % numberOfOccupied
+
+        counts = self.cellStart[index + 1] - self.cellStart[index]
+        starts = np.cumsum(counts) - counts
+        pairSegments = np.repeat(segmentIds, counts)
+        offsets = np.arange(int(counts.sum())) - np.repeat(starts, counts)
+        pairTriangles = self.cellTriangles[np.repeat(self.cellStart[index], counts) + offsets]
+        # a triangle is stored in several cells, test it once per segment
+        keys = np.unique(pairSegments * len(self.triangles) + pairTriangles)
+        return keys // len(self.triangles), keys % len(self.triangles)
+
+
+def cross(a, b):
+    return np.stack([a[:, 1] * b[:, 2] - a[:, 2] * b[:, 1],
+                     a[:, 2] * b[:, 0] - a[:, 0] * b[:, 2],
+                     a[:, 0] * b[:, 1] - a[:, 1] * b[:, 0]], axis=1)
+
+
+def dot(a, b):
+    return a[:, 0] * b[:, 0] + a[:, 1] * b[:, 1] + a[:, 2] * b[:, 2]
+
+
+def segmentTriangleIntersection(p, q, vertex, edge1, edge2, epsilon=1e-12):
+    # Moller-Trumbore on matching rows, returns hit mask and parameter t along p->q
+    direction = q - p
+    h = cross(direction, edge2)
+    a = dot(edge1, h)
+    valid = np.abs(a) > epsilon
+    f = np.zeros_like(a)
+    f[valid] = 1.0 / a[valid]
+    s = p - vertex
+    u = f * dot(s, h)
+    qVector = cross(s, edge1)
+    v = f * dot(direction, qVector)
+    t = f * dot(edge2, qVector)
+    hit = valid & (u >= 0.0) & (v >= 0.0) & (u + v <= 1.0) & (t >= 0.0) & (t <= 1.0)
+    return hit, t
+
+
+def intersectSegments(grid, entries, targets, chunkSize=4096):
+    """Tests every entry->target segment against the triangles of grid.
+    Returns a (N,) hit mask, (N,3) first hit points (nan on a miss) and (N,) cell ids (-1 on a miss).
+    """
+    entries = np.asarray(entries, dtype=np.float64).reshape(-1, 3)
+    targets = np.asarray(targets, dtype=np.float64).reshape(-1, 3)
+    numberOfSegments = len(entries)
+    hits = np.zeros(numberOfSegments, dtype=bool)
+    points = np.full((numberOfSegments, 3), np.nan)
+    cellIds = np.full(numberOfSegments, -1, dtype=np.int64)
+    if len(grid.triangles) == 0:
+        return hits, points, cellIds
+
+    for start in range(0, numberOfSegments, chunkSize):
+        p = entries[start:start + chunkSize]
+        q = targets[start:start + chunkSize]
+        segmentIds, triangleIds = grid.candidatePairs(p, q)
+        if len(segmentIds) == 0:
+            continue
+        hit, t = segmentTriangleIntersection(p[segmentIds], q[segmentIds], grid.vertex[triangleIds],
+                                             grid.edge1[triangleIds], grid.edge2[triangleIds])
+        segmentIds, triangleIds, t = segmentIds[hit], triangleIds[hit], t[hit]
+        if len(segmentIds) == 0:
+            continue
+        order = np.lexsort((t, segmentIds))
+        segmentIds, triangleIds, t = segmentIds[order], triangleIds[order], t[order]
+        first = np.unique(segmentIds, return_index=True)[1]
+        segmentIds, triangleIds, t = segmentIds[first], triangleIds[first], t[first]
+        rows = start + segmentIds
+        hits[rows] = True
+        cellIds[rows] = triangleIds
+        points[rows] = p[segmentIds] + t[:, None] * (q[segmentIds] - p[segmentIds])
+    return hits, points, cellIds
+
+
+def intersectionNormals(grid, cellIds, points, normalMode='face'):
+    # 'face' and 'smooth' are per triangle, 'vertex' interpolates the corner normals at the points
+    grid.computeNormals()
+    if normalMode == 'face':
+        return grid.faceNormals[cellIds]
+    if normalMode == 'smooth':
+        return grid.smoothNormals[cellIds]
+    if normalMode == 'vertex':
+        triangles = grid.triangles[cellIds]
+        edge1, edge2 = triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0]
+        relative = points - triangles[:, 0]
+        d00, d01, d11 = dot(edge1, edge1), dot(edge1, edge2), dot(edge2, edge2)
+        d20, d21 = dot(relative, edge1), dot(relative, edge2)
+        denominator = np.where(d00 * d11 - d01 * d01 != 0.0, d00 * d11 - d01 * d01, 1.0)
+        v = (d11 * d20 - d01 * d21) / denominator
+        w = (d00 * d21 - d01 * d20) / denominator
+        weights = np.stack([1.0 - v - w, v, w], axis=1)
+        return unitVectors(np.einsum('ij,ijk->ik', weights, grid.cornerNormals[cellIds]))
+    raise ValueError('unknown normal mode: %s' % normalMode)
+
+def intersectionAngles(grid, entries, targets, normalMode='face'):
+    """Angle between each trajectory and the surface normal at its first crossing,
+    folded into [0, 90] because only the line matters. nan for pairs that miss the
+    surface or start on it.
+    """
+    entries = np.asarray(entries, dtype=np.float64).reshape(-1, 3)
+    hits, intersectionPoints, cellIds = intersectSegments(grid, entries, targets)
+    angles = np.full(len(hits), np.nan)
+    normals = intersectionNormals(grid, cellIds[hits], intersectionPoints[hits], normalMode)
+    directions = entries[hits] - intersectionPoints[hits]
+    lengths = np.linalg.norm(directions, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cosines = np.abs(dot(directions, normals)) / lengths
+    angles[hits] = np.where(lengths > 0.0, np.degrees(np.arccos(np.clip(cosines, 0.0, 1.0))), np.nan)
+    return angles
+
+
+def nearestFaceNormals(grid, points):
+    # face normal of the triangle nearest each point among those in its grid cell, nan when the cell has none
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    normals = np.full((len(points), 3), np.nan)
+    pointIds, triangleIds = grid.candidatePairs(points, points)
+    if len(pointIds) == 0:
+        return normals
+    distances = np.linalg.norm(grid.triangles[triangleIds].mean(axis=1) - points[pointIds], axis=1)
+    order = np.lexsort((distances, pointIds))
+    nearest = order[np.unique(pointIds[order], return_index=True)[1]]
+    normals[pointIds[nearest]] = grid.computeNormals().faceNormals[triangleIds[nearest]]
+    return normals
+
+def approachMask(grid, entries, targets, approachAngle):
+    """Pairs whose line is within approachAngle of the surface normal nearest the
+    entry, a cheap stand-in for the angle at the first crossing. Entries with no
+    triangle in their cell are kept.
+    """
+    entries = np.asarray(entries, dtype=np.float64).reshape(-1, 3)
+    uniqueEntries, inverse = np.unique(entries, axis=0, return_inverse=True)
+    axes = nearestFaceNormals(grid, uniqueEntries)[inverse.ravel()]
+    directions = unitVectors(np.asarray(targets, dtype=np.float64).reshape(-1, 3) - entries)
+    keep = np.ones(len(entries), dtype=bool)
+    known = ~np.isnan(axes[:, 0])
+    angles = np.degrees(np.arccos(np.clip(np.abs(dot(directions[known], axes[known])), 0.0, 1.0)))
+    keep[known] = angles < approachAngle
+    return keep
+
+def validAngleMask(grid, entries, targets, validAngleOfIntersection, normalMode='face'):
+    # pairs that miss the surface are not valid
+    angles = intersectionAngles(grid, entries, targets, normalMode)
+    valid = np.zeros(len(angles), dtype=bool)
+    hits = ~np.isnan(angles)
+    valid[hits] = angles[hits] < validAngleOfIntersection
+    return valid
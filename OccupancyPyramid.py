@@ -0,0 +1,110 @@
+import collections
+import numpy as np
+import Instrumentation
+import MeshCache
+import VolumeTools
+
+# the pyramids of the most recently used volumes by node, with the modified time they were built at
+pyramidCache = collections.OrderedDict()
+maximumPyramids = 8
+
+
+def pool(occupied, factor, reduce):
+    # reduce (np.any or np.all) over factor^3 blocks, the volume is padded with empty voxels
+    slices, rows, columns = occupied.shape
+    padded = np.zeros(tuple(-(-size // factor) * factor for size in occupied.shape), dtype=bool)
+    padded[:slices, :rows, :columns] = occupied
+    k, j, i = (size // factor for size in padded.shape)
+    return reduce(padded.reshape(k, factor, j, factor, i, factor), axis=(1, 3, 5))
+
+def grow(cells, reduce, fill):
+    # reduce over each cell and its 26 neighbours, outside the volume is fill
+    for axis in range(3):
+        padded = np.pad(cells, [(1, 1) if index == axis else (0, 0) for index in range(3)], constant_values=fill)
+        size = cells.shape[axis]
+        cells = reduce([padded.take(range(offset, offset + size), axis=axis) for offset in range(3)], axis=0)
+    return cells
+
+
+class OccupancyPyramid(object):
+    """Coarse copies of a label volume for the voxel collision test. At each factor a
+    cell is possibly occupied (max pool) when one of its voxels or of its neighbours'
+    voxels is, and certainly occupied (min pool) when every voxel of it and of its
+    neighbours is. A segment that crosses no possibly occupied cell misses the labels,
+    one that crosses a certainly occupied cell hits them; the neighbours cover
+    segments grazing a cell boundary. Only the segments left undecided go down a
+    level, cut down to the part between its first and last possibly occupied cell,
+    and the full resolution labels decide the rest with the result of
+    VolumeTools.firstOccupiedVoxel (segments running exactly along a voxel edge may
+    go either way in both).
+    """
+
+    def __init__(self, labels, factors=(8, 4, 2)):
+        self.labels = labels
+        occupied = labels != 0
+        self.levels = []
+        for factor in sorted(factors, reverse=True):
+            possible = grow(pool(occupied, factor, np.any), np.any, False)
+            certain = grow(pool(occupied, factor, np.all), np.all, False)
+            self.levels.append((factor, possible.view(np.uint8), certain.view(np.uint8)))
+
+    def segmentHits(self, start, end):
+        """Hit mask of the start->end segments (continuous ijk, voxel centres on
+        integers) and the number of segments decided at each level.
+        """
+        start = np.array(start, dtype=np.float64).reshape(-1, 3)
+        end = np.array(end, dtype=np.float64).reshape(-1, 3)
+        hits = np.zeros(len(start), dtype=bool)
+        unresolved = np.arange(len(start))
+        counts = {}
+        for factor, possible, certain in self.levels:
+            if len(unresolved) == 0:
+                break
+            # voxel v of the level holds the full resolution voxels [v * factor, (v + 1) * factor)
+            coarseStart = (start[unresolved] + 0.5) / factor - 0.5
+            coarseEnd = (end[unresolved] + 0.5) / factor - 0.5
+            maybe, firstCells = VolumeTools.firstOccupiedVoxel(possible, coarseStart, coarseEnd)
+            blocked = np.zeros(len(unresolved), dtype=bool)
+            blocked[maybe] = VolumeTools.firstOccupiedVoxel(certain, coarseStart[maybe], coarseEnd[maybe])[0]
+            hits[unresolved[blocked]] = True
+            counts['level%d' % factor] = int((~maybe).sum() + blocked.sum())
+            keep = maybe & ~blocked
+            # the rest of the walk only covers the part between the first and the last possible cell
+            lastCells = VolumeTools.firstOccupiedVoxel(possible, coarseEnd[keep], coarseStart[keep])[1]
+            tEnter = VolumeTools.clipSegmentsToBox(coarseStart[keep], coarseEnd[keep], firstCells[keep] - 0.5 - 1e-9,
+                                                   firstCells[keep] + 0.5 + 1e-9)[0]
+            tExit = VolumeTools.clipSegmentsToBox(coarseStart[keep], coarseEnd[keep], lastCells - 0.5 - 1e-9,
+                                                  lastCells + 0.5 + 1e-9)[1]
+            unresolved = unresolved[keep]
+            segmentStart, direction = start[unresolved], end[unresolved] - start[unresolved]
+            start[unresolved] = segmentStart + np.clip(tEnter, 0.0, 1.0)[:, None] * direction
+            end[unresolved] = segmentStart + np.clip(tExit, 0.0, 1.0)[:, None] * direction
+        if len(unresolved):
+            hits[unresolved] = VolumeTools.firstOccupiedVoxel(self.labels, start[unresolved], end[unresolved])[0]
+        counts['level1'] = len(unresolved)
+        return hits, counts
+
+
+def getOccupancyPyramid(volumeNode):
+    key = volumeNode.GetID() if hasattr(volumeNode, 'GetID') else id(volumeNode)
+    modifiedTime = max(volumeNode.GetMTime(), volumeNode.GetImageData().GetMTime())
+    with MeshCache.cacheLock:
+        cached = pyramidCache.get(key)
+        if cached is not None and cached[0] == modifiedTime:
+            pyramidCache.move_to_end(key)
+            return cached[1]
+        with Instrumentation.span('pyramidBuild'):
+            pyramid = OccupancyPyramid(VolumeTools.getLabelArray(volumeNode))
+        # an edited volume replaces the pyramid of its older modified time
+        pyramidCache[key] = (modifiedTime, pyramid)
+        pyramidCache.move_to_end(key)
+        while len(pyramidCache) > maximumPyramids:
+            pyramidCache.popitem(last=False)
+        return pyramid
+
+def pyramidIntersectBatch(volumeNode, entryPoints, targetPoints):
+    hits, counts = getOccupancyPyramid(volumeNode).segmentHits(VolumeTools.rasToIJK(volumeNode, entryPoints),
+                                                              VolumeTools.rasToIJK(volumeNode, targetPoints))
+    for level, count in counts.items():
+        Instrumentation.count('pyramid.' + level, count)
+    return hits
@@ -0,0 +1,315 @@
+import multiprocessing
+import os
+import numpy as np
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:
+    # Python < 3.8, see PlannerPool
+    resource_tracker = shared_memory = None
+import ConstraintPipeline
+import DistanceField
+import Instrumentation
+import MeshCache
+import MeshTools
+import OccupancyPyramid
+import SurfaceDistance
+import TrajectorySet
+import VolumeTools
+
+# per worker process state, filled in by loadTask
+workerArrays = {}
+workerBlocks = {}
+workerSettings = {}
+workerConstraints = []
+workerKey = []
+
+# the PlannerPool of the running plan, see pooled
+activePool = None
+
+
+class SharedArrays(object):
+    """NumPy arrays copied into named shared memory blocks, workers attach to them
+    by name so the label volumes and meshes are never pickled. An array shared
+    again under the same name is only copied when it is another array object.
+    """
+
+    def __init__(self):
+        self.shared = {}
+
+    def share(self, arrays):
+        # specs (block name, shape, dtype) of arrays by name
+        specs = {}
+        for name, array in arrays.items():
+            cached = self.shared.get(name)
+            if cached is None or cached[0] is not array:
+                if cached is not None:
+                    release(cached[1])
+                contiguousArray = np.ascontiguousarray(array)
+                block = shared_memory.SharedMemory(create=True, size=max(contiguousArray.nbytes, 1))
+                view = np.ndarray(contiguousArray.shape, dtype=contiguousArray.dtype, buffer=block.buf)
+                view[...] = contiguousArray
+                cached = self.shared[name] = (array, block, (block.name, contiguousArray.shape, contiguousArray.dtype.str))
+            specs[name] = cached[2]
+        return specs
+
+    def close(self):
+        for _, block, _ in self.shared.values():
+            release(block)
+        self.shared = {}
+
+
+def release(block):
+    block.close()
+    block.unlink()
+
+def gather(arrays, prefix):
+    return dict((key[len(prefix) + 1:], value) for key, value in arrays.items() if key.startswith(prefix + '.'))
+
+def getContext():
+    # fork keeps worker start-up cheap, spawn is the only option on some platforms
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context('spawn')
+
+def defaultWorkers():
+    return multiprocessing.cpu_count()
+
+def poolWorkers(workers):
+    # chunks are cut for the pool that runs them
+    return activePool.workers if activePool is not None else workers or defaultWorkers()
+
+def entryChunks(pairs, numberOfChunks):
+    # [start, stop) ranges of the pair array, only cut where the entry changes
+    if len(pairs) == 0:
+        return []
+    boundaries = np.concatenate([[0], np.nonzero(np.diff(pairs[:, 0]))[0] + 1, [len(pairs)]])
+    wanted = np.linspace(0, len(pairs), numberOfChunks + 1)
+    cuts = np.unique(boundaries[np.minimum(np.searchsorted(boundaries, wanted), len(boundaries) - 1)])
+    return [(int(start), int(stop)) for start, stop in zip(cuts[:-1], cuts[1:])]
+
+def runTask(task):
+    # the result, and the spans and counters of the task when the parent is recording
+    function, specs, settings, bounds, trace = task
+    loadTask(specs, settings)
+    if not trace:
+        return function(bounds), None
+    recorder = Instrumentation.Recorder()
+    with Instrumentation.recording(recorder):
+        result = function(bounds)
+    return result, (recorder.spans, dict(recorder.counters), recorder.origin, os.getpid())
+
+def loadTask(specs, settings):
+    # attaches the blocks of specs the worker does not hold yet, the constraints are rebuilt when anything but the pairs
+    # or the constraint order changed
+    key = (sorted(spec for name, spec in specs.items() if name != 'pairs'),
+           sorted(item for item in settings.items() if item[0] != 'order'))
+    if workerKey != [key]:
+        workerKey[:] = [key]
+        del workerConstraints[:]
+    workerArrays.clear()
+    workerSettings.clear()
+    workerSettings.update(settings)
+    blockNames = set(spec[0] for spec in specs.values())
+    for blockName in list(workerBlocks):
+        if blockName not in blockNames:
+            workerBlocks.pop(blockName).close()
+    for name, (blockName, shape, dtype) in specs.items():
+        if blockName not in workerBlocks:
+            workerBlocks[blockName] = shared_memory.SharedMemory(name=blockName)
+        workerArrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=workerBlocks[blockName].buf)
+
+
+def meshConstraint(grid):
+    return lambda entries, targets: ~MeshTools.intersectSegments(grid, entries, targets)[0]
+
+def voxelConstraint(labels, rasToIJK):
+    return lambda entries, targets: ~VolumeTools.firstOccupiedVoxel(
+        labels, VolumeTools.applyMatrix(rasToIJK, entries), VolumeTools.applyMatrix(rasToIJK, targets))[0]
+
+def pyramidConstraint(labels, rasToIJK):
+    pyramid = OccupancyPyramid.OccupancyPyramid(labels)
+    return lambda entries, targets: ~pyramid.segmentHits(
+        VolumeTools.applyMatrix(rasToIJK, entries), VolumeTools.applyMatrix(rasToIJK, targets))[0]
+
+def angleConstraint(grid, validAngleOfIntersection, normalMode='face'):
+    return lambda entries, targets: MeshTools.validAngleMask(grid, entries, targets, validAngleOfIntersection, normalMode)
+
+def buildConstraints(arrays, settings):
+    # the constraints of Algorithms.buildConstraints, from the shared arrays
+    constraints = []
+    for name in ('ventricles', 'vessels'):
+        if settings['collisionMode'] in ('voxel', 'pyramid'):
+            labels, rasToIJK = arrays[name + '.labels'], arrays[name + '.rasToIJK']
+            if settings['collisionMode'] == 'voxel':
+                evaluate = voxelConstraint(labels, rasToIJK)
+            else:
+                evaluate = pyramidConstraint(labels, rasToIJK)
+            bounds = VolumeTools.occupiedRASBounds(labels, rasToIJK)
+        else:
+            grid = MeshTools.TriangleGrid.fromArrays(gather(arrays, name))
+            evaluate = meshConstraint(grid)
+            bounds = grid.bounds()
+        constraints.append(ConstraintPipeline.Constraint(name, evaluate, bounds))
+    cortexGrid = MeshTools.TriangleGrid.fromArrays(gather(arrays, 'cortex'))
+    constraints.append(ConstraintPipeline.Constraint(
+        'cortexAngle', angleConstraint(cortexGrid, settings['validAngleOfIntersection'], settings['normalMode'])))
+    return constraints
+
+def buildWorkerConstraints():
+    if not workerConstraints:
+        workerConstraints.extend(buildConstraints(workerArrays, workerSettings))
+    return workerConstraints
+
+def evaluateChunk(bounds):
+    # the chunk in the order calibrated by the parent, so the stages of every chunk add up
+    start, stop = bounds
+    trajectories = TrajectorySet.TrajectorySet(workerArrays['entries'], workerArrays['targets'],
+                                               workerArrays['pairs'][start:stop])
+    byName = dict((constraint.name, constraint) for constraint in buildWorkerConstraints())
+    order = [byName[name] for name in workerSettings['order']]
+    result = ConstraintPipeline.ConstraintPipeline(order, reorder=False).run(trajectories, order)
+    return result.valid, result.stages
+
+def distanceChunk(bounds):
+    start, stop = bounds
+    pairs = workerArrays['pairs'][start:stop]
+    entries = workerArrays['entries'][pairs[:, 0]]
+    targets = workerArrays['targets'][pairs[:, 1]]
+    distances = np.zeros((len(pairs), workerSettings['numberOfNodes']))
+    for index in range(workerSettings['numberOfNodes']):
+        if workerSettings['distanceMode'] == 'sampled':
+            field = DistanceField.DistanceField.fromArrays(workerArrays['field%d.field' % index],
+                                                           workerArrays['field%d.rasToIJK' % index])
+            distances[:, index] = field.minimumDistances(entries, targets, workerSettings['precisionValue'])
+        else:
+            bvh = SurfaceDistance.TriangleBVH.fromArrays(gather(workerArrays, 'bvh%d' % index))
+            distances[:, index] = bvh.minimumDistances(entries, targets)
+    return distances
+
+
+class PlannerPool(object):
+    """Worker processes and shared arrays kept for every parallel step of a plan:
+    the workers start once, and the meshes, fields, entries and targets are copied
+    to shared memory once, only the pairs of each step are new.
+    """
+
+    def __init__(self, workers=None):
+        if shared_memory is None:
+            raise RuntimeError('planning with workers needs multiprocessing.shared_memory (Python 3.8 or later), '
+                               'plan with workers=1')
+        self.workers = workers or defaultWorkers()
+        # workers started before the first block would run their own resource tracker, which unlinks
+        # the blocks they attached when they exit
+        resource_tracker.ensure_running()
+        self.pool = getContext().Pool(self.workers)
+        self.shared = SharedArrays()
+
+    def map(self, function, arrays, settings, chunks):
+        specs = self.shared.share(arrays)
+        recorder = Instrumentation.getRecorder()
+        results = self.pool.map(runTask, [(function, specs, settings, bounds, recorder.enabled) for bounds in chunks])
+        for _, recorded in results:
+            if recorded is not None:
+                spans, counters, origin, pid = recorded
+                recorder.merge(spans, counters, origin, 'worker %d' % pid, pid)
+        return [result for result, _ in results]
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.shared.close()
+
+
+class pooled(object):
+    """Runs the parallel steps of a with block on one PlannerPool. Does nothing
+    for workers == 1 or inside another pooled block.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.pool = None
+
+    def __enter__(self):
+        global activePool
+        if self.workers != 1 and activePool is None:
+            self.pool = activePool = PlannerPool(self.workers)
+        return activePool
+
+    def __exit__(self, *exception):
+        global activePool
+        if self.pool is not None:
+            activePool = None
+            self.pool.close()
+        return False
+
+
+def runChunks(arrays, settings, function, chunks, workers):
+    # on the pool of the running plan, or on a pool started for this call
+    if activePool is not None:
+        return activePool.map(function, arrays, settings, chunks)
+    pool = PlannerPool(workers)
+    try:
+        return pool.map(function, arrays, settings, chunks)
+    finally:
+        pool.close()
+
+def trajectoryArrays(trajectories):
+    return {'entries': trajectories.entries, 'targets': trajectories.targets, 'pairs': trajectories.pairs}
+
+def prefixed(prefix, arrays):
+    return dict((prefix + '.' + key, array) for key, array in arrays.items())
+
+def parallelConstraintPipeline(entriesAndTargets, ventricles, vessels, cortex, validAngleOfIntersection,
+                               collisionMode='mesh', reorder=True, workers=None, normalMode='face'):
+    workers = poolWorkers(workers)
+    trajectories = TrajectorySet.asTrajectorySet(entriesAndTargets)
+    arrays = trajectoryArrays(trajectories)
+    for name, area in (('ventricles', ventricles), ('vessels', vessels)):
+        if collisionMode in ('voxel', 'pyramid'):
+            arrays[name + '.labels'] = VolumeTools.getLabelArray(area)
+            arrays[name + '.rasToIJK'] = VolumeTools.getRASToIJK(area)
+        else:
+            arrays.update(prefixed(name, MeshCache.defaultCache.getSurface(area).getTriangleGrid().arrays()))
+    # the cortex normals travel with its grid, the workers only look them up
+    arrays.update(prefixed('cortex', MeshCache.defaultCache.getSurface(cortex, (0, 0.5)).getTriangleGrid(normals=True).arrays()))
+    settings = {'collisionMode': collisionMode, 'validAngleOfIntersection': validAngleOfIntersection,
+                'normalMode': normalMode}
+    # one calibration here on a sample of every pair, the workers run each chunk in its order
+    pipeline = ConstraintPipeline.ConstraintPipeline(buildConstraints(arrays, settings), reorder=reorder)
+    order, calibrationSeconds = pipeline.calibratedOrder(trajectories)
+    settings['order'] = tuple(constraint.name for constraint in order)
+
+    chunks = entryChunks(trajectories.pairs, workers * 4)
+    with Instrumentation.span('constraints.parallel', pairsIn=len(trajectories), workers=workers) as counters:
+        results = runChunks(arrays, settings, evaluateChunk, chunks, workers)
+        counters['pairsOut'] = int(sum(result[0].sum() for result in results))
+
+    # chunks come back in submission order, so the merged mask does not depend on scheduling
+    valid = np.concatenate([result[0] for result in results]) if results else np.zeros(0, dtype=bool)
+    stages = {}
+    for _, chunkStages in results:
+        for stage in chunkStages:
+            merged = stages.setdefault(stage['name'], {'name': stage['name'], 'seconds': 0.0, 'pairsIn': 0,
+                                                       'pairsOut': 0, 'rejected': 0, 'skipped': 0})
+            for key in ('seconds', 'pairsIn', 'pairsOut', 'rejected', 'skipped'):
+                merged[key] += stage[key]
+    order = list(settings['order'])
+    totalSeconds = sum(stage['seconds'] for stage in stages.values()) + calibrationSeconds
+    return ConstraintPipeline.PipelineResult(trajectories.filter(valid), [stages[name] for name in order if name in stages],
+                                             order, calibrationSeconds, totalSeconds, valid)
+
+def parallelDistances(entriesAndTargets, precisionValue, nodes, workers=None, distanceMode='exact'):
+    workers = poolWorkers(workers)
+    trajectories = TrajectorySet.asTrajectorySet(entriesAndTargets)
+    arrays = trajectoryArrays(trajectories)
+    for index, node in enumerate(nodes):
+        if distanceMode == 'sampled':
+            field = DistanceField.getDistanceField(node)
+            arrays['field%d.field' % index] = field.field
+            arrays['field%d.rasToIJK' % index] = field.rasToIJK
+        else:
+            arrays.update(prefixed('bvh%d' % index, MeshCache.defaultCache.getSurface(node).getBVH().arrays()))
+    settings = {'numberOfNodes': len(nodes), 'precisionValue': precisionValue, 'distanceMode': distanceMode}
+    results = runChunks(arrays, settings, distanceChunk, entryChunks(trajectories.pairs, workers * 4), workers)
+    # (N,S) distance from every trajectory to each node
+    return np.concatenate(results) if results else np.zeros((0, len(nodes)))
@@ -0,0 +1,109 @@
+import collections
+import TrajectoryRanking
+
+
+# the backends of Algorithms.areaIntersectBatch, the cortex normals of MeshTools.intersectionNormals and
+# the distances of Algorithms.distancesFromLinesToNodes
+collisionModes = ('mesh', 'voxel', 'pyramid')
+normalModes = ('face', 'smooth', 'vertex')
+distanceModes = ('exact', 'sampled')
+
+
+class PlanningOptions(object):
+    """Settings of a planning run that every entry point takes the same way:
+    Task1Logic.run(..., options, **settings) starts from the defaults, then the
+    options (a PlanningOptions or a dict), then the keyword settings. Unknown
+    names raise TypeError and combinations that cannot run raise ValueError.
+
+    collisionMode is 'mesh' (marching cubes surfaces), 'voxel' (line traversal
+    of the label voxels) or 'pyramid' (the voxel traversal behind coarse occupancy
+    levels that decide most pairs first). workers is the number of processes used for the
+    constraints and the distance scoring, None for all cores. hierarchical tests
+    clusters of entries and targets against the distance fields before single pairs,
+    in this process, so it needs workers=1.
+    normalMode is the cortex normal of the angle check, 'face', 'smooth' (averaged
+    over the corners) or 'vertex' (interpolated at the crossing). approachAngle
+    (degrees) adds the approximate approach cone to the prefilters, see
+    Algorithms.buildPrefilters; None leaves it off. distanceMode is how far a
+    trajectory passes from the vessels and the ventricles: 'exact' (to their
+    surfaces) or 'sampled' (from the distance fields every precision along it).
+    criterion is how the distances to the vessels and the ventricles make one score
+    ('sum', 'min' or 'weighted' with one weight each in weights), and k the number of
+    targets kept for each entry. streaming makes, filters and ranks the entry x
+    target pairs chunkSize at a time instead of building them all first, so only
+    the k best of each entry are kept (and hierarchical cannot be used); its
+    constraints run in this process, workers only score the chunks.
+    """
+
+    defaults = collections.OrderedDict([
+        ('collisionMode', 'mesh'),
+        ('workers', 1),
+        ('hierarchical', False),
+        ('normalMode', 'face'),
+        ('approachAngle', None),
+        ('distanceMode', 'exact'),
+        ('criterion', 'sum'),
+        ('weights', None),
+        ('k', 1),
+        ('streaming', False),
+        ('chunkSize', 16384),
+    ])
+
+    def __init__(self, options=None, **settings):
+        values = dict(self.defaults)
+        if isinstance(options, PlanningOptions):
+            options = options.asDict()
+        values.update(options or {})
+        values.update(settings)
+        unknown = sorted(set(values) - set(self.defaults))
+        if unknown:
+            raise TypeError('Unknown planning options: ' + ', '.join(unknown))
+        for name, value in values.items():
+            setattr(self, name, value)
+        self.validate()
+
+    def validate(self):
+        if self.collisionMode not in collisionModes:
+            raise ValueError('Unknown collision mode: ' + str(self.collisionMode))
+        if self.workers is not None and self.workers < 1:
+            raise ValueError('workers must be at least 1 or None: ' + str(self.workers))
+        if self.hierarchical and self.workers != 1:
+            raise ValueError('hierarchical runs in one process, it needs workers=1')
+        if self.hierarchical and self.streaming:
+            raise ValueError('hierarchical needs every pair at once and cannot be streamed')
+        if self.normalMode not in normalModes:
+            raise ValueError('Unknown normal mode: ' + str(self.normalMode))
+        if self.distanceMode not in distanceModes:
+            raise ValueError('Unknown distance mode: ' + str(self.distanceMode))
+        if self.approachAngle is not None and not 0.0 < self.approachAngle <= 90.0:
+            raise ValueError('approachAngle must be in (0, 90] degrees: ' + str(self.approachAngle))
+        if self.criterion not in TrajectoryRanking.criteria:
+            raise ValueError('Unknown score criterion: ' + str(self.criterion))
+        if self.criterion == 'weighted' and (self.weights is None or len(self.weights) != 2):
+            raise ValueError('weighted scores need a vessel and a ventricle weight')
+        if self.k < 1:
+            raise ValueError('k must be at least 1: ' + str(self.k))
+        if self.chunkSize < 1:
+            raise ValueError('chunkSize must be at least 1: ' + str(self.chunkSize))
+
+    def asDict(self):
+        return collections.OrderedDict((name, getattr(self, name)) for name in self.defaults)
+
+    def replace(self, **settings):
+        return PlanningOptions(self, **settings)
+
+    def __eq__(self, other):
+        return isinstance(other, PlanningOptions) and self.asDict() == other.asDict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'PlanningOptions(%s)' % ', '.join('%s=%r' % item for item in self.asDict().items())
+
+
+def planningOptions(options=None, **settings):
+    # the options of a call, kept as they are when there is nothing to merge
+    if isinstance(options, PlanningOptions) and not settings:
+        return options
+    return PlanningOptions(options, **settings)
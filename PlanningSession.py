@@ -0,0 +1,204 @@
+import time
+import numpy as np
+import vtk
+import Algorithms
+import MathTools
+import MeshTools
+import PlanningOptions
+import TrajectoryRanking
+import TrajectorySet
+
+
+class PlanningSession(object):
+    """Keeps the constraint results and distance scores of every entry x target
+    pair so that the plan can be updated without starting over. Moving a markup
+    only recomputes the pairs of the moved entries or targets. Changing the angle
+    or the maximum incision length re-thresholds the cached angles and lengths.
+    The distances are computed once for every pair that misses the ventricles and
+    the vessels, so no slider needs any geometry (except the precision in the
+    sampled distanceMode). options and settings are the PlanningOptions of the
+    session: its collisionMode and distanceMode, and the criterion, weights and k
+    the pairs are ranked with, as in Task1Logic.run.
+    """
+
+    def __init__(self, hippo, ventricles, vessels, cortex, targetsNode, entriesNode, validAngleOfIntersection=55.0,
+                 precisionValue=0.01, maximumIncisionValue=9999999999999.0, options=None, onChanged=None,
+                 **settings):
+        self.hippo = hippo
+        self.ventricles = ventricles
+        self.vessels = vessels
+        self.cortex = cortex
+        self.targetsNode = targetsNode
+        self.entriesNode = entriesNode
+        self.validAngleOfIntersection = validAngleOfIntersection
+        self.precisionValue = precisionValue
+        self.maximumIncisionValue = maximumIncisionValue
+        self.options = PlanningOptions.planningOptions(options, **settings)
+        self.onChanged = onChanged
+        self.observers = []
+        self.lastUpdate = {'pairs': 0, 'seconds': 0.0}
+
+        self.entries = np.zeros((0, 3))
+        self.targets = np.zeros((0, 3))
+        self.targetInside = np.zeros(0, dtype=bool)
+        self.lengths = np.zeros((0, 0))
+        self.ventriclesHit = np.zeros((0, 0), dtype=bool)
+        self.vesselsHit = np.zeros((0, 0), dtype=bool)
+        self.angles = np.zeros((0, 0))
+        # inside the approach cone of the prefilters, everywhere without an approachAngle
+        self.inApproachCone = np.zeros((0, 0), dtype=bool)
+        # distance to the vessels and to the ventricles, nan where not computed
+        self.distances = np.zeros((0, 0, 2))
+        self.cortexGrid = Algorithms.getTriangleGrid(cortex, (0, 0.5), normals=True)
+        self.refreshPoints()
+
+    def observe(self):
+        for node in (self.entriesNode, self.targetsNode):
+            self.observers.append((node, node.AddObserver(vtk.vtkCommand.ModifiedEvent, self.onMarkupModified)))
+
+    def close(self):
+        for node, tag in self.observers:
+            node.RemoveObserver(tag)
+        self.observers = []
+
+    def onMarkupModified(self, caller, event):
+        entries, targets = self.markupPoints()
+        # a target moved out of the hippocampus changes the plan without recomputing any pair
+        if self.pointsChanged(entries, targets):
+            self.updatePoints(entries, targets)
+            if self.onChanged is not None:
+                self.onChanged(self)
+
+    def markupPoints(self):
+        return (np.asarray(MathTools.getCoordinatesArray(self.entriesNode), dtype=np.float64).reshape(-1, 3),
+                np.asarray(MathTools.getCoordinatesArray(self.targetsNode), dtype=np.float64).reshape(-1, 3))
+
+    def refreshPoints(self):
+        return self.updatePoints(*self.markupPoints())
+
+    def pointsChanged(self, entries, targets):
+        return len(entries) != len(self.entries) or len(targets) != len(self.targets) \
+            or changedRows(self.entries, entries).any() or changedRows(self.targets, targets).any()
+
+    def updatePoints(self, entries, targets):
+        """Takes the current entry and target coordinates and recomputes the pairs of
+        every added or moved point. Returns the number of pairs recomputed.
+        """
+        startTime = time.time()
+        entries = np.asarray(entries, dtype=np.float64).reshape(-1, 3)
+        targets = np.asarray(targets, dtype=np.float64).reshape(-1, 3)
+        if not self.pointsChanged(entries, targets):
+            return 0
+        changedEntries = changedRows(self.entries, entries)
+        changedTargets = changedRows(self.targets, targets)
+
+        shape = (len(entries), len(targets))
+        self.lengths = resized(self.lengths, shape, 0.0)
+        self.ventriclesHit = resized(self.ventriclesHit, shape, False)
+        self.vesselsHit = resized(self.vesselsHit, shape, False)
+        self.angles = resized(self.angles, shape, np.nan)
+        self.inApproachCone = resized(self.inApproachCone, shape, True)
+        self.distances = resized(self.distances, shape + (2,), np.nan)
+        self.targetInside = resized(self.targetInside, (len(targets),), False)
+        self.entries, self.targets = entries, targets
+
+        changedTargetIds = np.nonzero(changedTargets)[0]
+        self.targetInside[changedTargetIds] = False
+        self.targetInside[changedTargetIds[Algorithms.getValidTargetIndices(targets[changedTargetIds], self.hippo)[0]]] = True
+
+        touched = changedEntries[:, None] | changedTargets[None, :]
+        # targets outside the hippocampus never make a trajectory, their pairs are left unscored
+        entryIndices, targetIndices = np.nonzero(touched & self.targetInside[None, :])
+        self.evaluatePairs(entryIndices, targetIndices)
+        self.lastUpdate = {'pairs': len(entryIndices), 'seconds': time.time() - startTime}
+        return len(entryIndices)
+
+    def evaluatePairs(self, entryIndices, targetIndices):
+        entries, targets = self.entries[entryIndices], self.targets[targetIndices]
+        self.lengths[entryIndices, targetIndices] = MathTools.getDistancesBetweenPoints(entries, targets)
+        self.ventriclesHit[entryIndices, targetIndices] = Algorithms.areaIntersectBatch(self.ventricles, entries, targets, self.options.collisionMode)
+        self.vesselsHit[entryIndices, targetIndices] = Algorithms.areaIntersectBatch(self.vessels, entries, targets, self.options.collisionMode)
+        self.angles[entryIndices, targetIndices] = MeshTools.intersectionAngles(self.cortexGrid, entries, targets, self.options.normalMode)
+        if self.options.approachAngle is not None:
+            self.inApproachCone[entryIndices, targetIndices] = MeshTools.approachMask(self.cortexGrid, entries, targets,
+                                                                                      self.options.approachAngle)
+        self.distances[entryIndices, targetIndices] = np.nan
+        self.scorePairs(entryIndices, targetIndices)
+
+    def scorePairs(self, entryIndices, targetIndices):
+        clear = ~self.ventriclesHit[entryIndices, targetIndices] & ~self.vesselsHit[entryIndices, targetIndices]
+        entryIndices, targetIndices = entryIndices[clear], targetIndices[clear]
+        trajectories = TrajectorySet.TrajectorySet(self.entries, self.targets, np.stack([entryIndices, targetIndices], axis=1))
+        self.distances[entryIndices, targetIndices] = Algorithms.distanceMatrix(
+            self.precisionValue, trajectories, self.vessels, self.ventricles, distanceMode=self.options.distanceMode)
+
+    def setParameters(self, validAngleOfIntersection=None, precisionValue=None, maximumIncisionValue=None):
+        if validAngleOfIntersection is not None:
+            self.validAngleOfIntersection = validAngleOfIntersection
+        if maximumIncisionValue is not None:
+            self.maximumIncisionValue = maximumIncisionValue
+        if precisionValue is not None and precisionValue != self.precisionValue:
+            self.precisionValue = precisionValue
+            if self.options.distanceMode == 'sampled':
+                self.scorePairs(*np.nonzero(np.broadcast_to(self.targetInside, self.lengths.shape)))
+
+    def validMask(self):
+        # nan angles (missed the cortex) compare False
+        with np.errstate(invalid='ignore'):
+            return (self.targetInside[None, :] & self.inApproachCone & ~self.ventriclesHit & ~self.vesselsHit
+                    & (self.angles < self.validAngleOfIntersection))
+
+    def trajectories(self):
+        return TrajectorySet.TrajectorySet(self.entries, self.targets, np.argwhere(self.validMask()))
+
+    def topTrajectoriesPerEntry(self, k=None, criterion=None, weights=None):
+        # same result as Algorithms.topTrajectoriesPerEntry on trajectories(), from the cached scores;
+        # k, criterion and weights default to those of the session options
+        if k is None:
+            k = self.options.k
+        if criterion is None:
+            criterion, weights = self.options.criterion, self.options.weights
+        mask = self.validMask() & (self.lengths <= self.maximumIncisionValue) & (self.maximumIncisionValue > 0.00)
+        entryIndices, targetIndices = np.nonzero(mask)
+        ranking = TrajectoryRanking.TopKPerEntry(k)
+        ranking.push(entryIndices, targetIndices,
+                     TrajectoryRanking.combineScores(self.distances[entryIndices, targetIndices], criterion, weights))
+        return Algorithms.rankingByEntry(ranking, self.entries, self.targets)
+
+    def bestTrajectoryForEachEntry(self, criterion=None, weights=None):
+        return Algorithms.targetsByEntry(self.topTrajectoriesPerEntry(1, criterion, weights))
+
+    def pathsPolyData(self, k=None, criterion=None, weights=None):
+        # lines of the k best trajectories of every entry, with their score, distances, angle and length as cell data;
+        # k, criterion and weights default to those of the session options
+        if k is None:
+            k = self.options.k
+        if criterion is None:
+            criterion, weights = self.options.criterion, self.options.weights
+        mask = self.validMask() & (self.lengths <= self.maximumIncisionValue) & (self.maximumIncisionValue > 0.00)
+        entryIndices, targetIndices = np.nonzero(mask)
+        scores = TrajectoryRanking.combineScores(self.distances[entryIndices, targetIndices], criterion, weights)
+        rows = TrajectoryRanking.topRowsPerEntry(entryIndices, scores, k)
+        entryIndices, targetIndices, scores = entryIndices[rows], targetIndices[rows], scores[rows]
+        scalars = [('score', scores),
+                   ('vesselsDistance', self.distances[entryIndices, targetIndices, 0]),
+                   ('ventriclesDistance', self.distances[entryIndices, targetIndices, 1]),
+                   ('angle', self.angles[entryIndices, targetIndices]),
+                   ('length', self.lengths[entryIndices, targetIndices])]
+        trajectories = TrajectorySet.TrajectorySet(self.entries, self.targets, np.stack([entryIndices, targetIndices], axis=1))
+        return Algorithms.trajectoriesPolyData(trajectories, scalars)
+
+
+def changedRows(old, new):
+    # rows of new that were added or moved since old
+    changed = np.ones(len(new), dtype=bool)
+    common = min(len(old), len(new))
+    changed[:common] = np.any(old[:common] != new[:common], axis=1)
+    return changed
+
+def resized(array, shape, fill):
+    # keeps the overlapping block of array, the rest is fill
+    result = np.full(shape, fill, dtype=array.dtype)
+    common = tuple(slice(0, min(old, new)) for old, new in zip(array.shape, shape))
+    result[common] = array[common]
+    return result
@@ -0,0 +1,175 @@
+import numpy as np
+import MeshTools
+
+
+def clamp(values):
+    return np.clip(values, 0.0, 1.0)
+
+def safeDivide(numerator, denominator):
+    safe = np.where(denominator != 0.0, denominator, 1.0)
+    return np.where(denominator != 0.0, numerator / safe, 0.0)
+
+def pointSegmentDistances(points, a, b):
+    direction = b - a
+    t = clamp(safeDivide(MeshTools.dot(points - a, direction), MeshTools.dot(direction, direction)))
+    return np.linalg.norm(points - (a + t[:, None] * direction), axis=1)
+
+def pointTriangleDistances(points, a, b, c):
+    # the projection on the plane when it falls inside the triangle, otherwise the closest edge
+    edge1, edge2 = b - a, c - a
+    normal = MeshTools.cross(edge1, edge2)
+    normalLength = np.linalg.norm(normal, axis=1)
+    relative = points - a
+    height = safeDivide(MeshTools.dot(relative, normal), normalLength)
+    d00, d01, d11 = MeshTools.dot(edge1, edge1), MeshTools.dot(edge1, edge2), MeshTools.dot(edge2, edge2)
+    d20, d21 = MeshTools.dot(relative, edge1), MeshTools.dot(relative, edge2)
+    denominator = d00 * d11 - d01 * d01
+    v = safeDivide(d11 * d20 - d01 * d21, denominator)
+    w = safeDivide(d00 * d21 - d01 * d20, denominator)
+    inside = (normalLength > 0.0) & (v >= 0.0) & (w >= 0.0) & (v + w <= 1.0)
+    edges = np.minimum(np.minimum(pointSegmentDistances(points, a, b), pointSegmentDistances(points, b, c)),
+                       pointSegmentDistances(points, c, a))
+    return np.where(inside, np.abs(height), edges)
+
+def segmentSegmentDistances(p1, q1, p2, q2, epsilon=1e-12):
+    # closest points of two segments (Ericson, Real-Time Collision Detection 5.1.9) on matching rows
+    d1, d2, r = q1 - p1, q2 - p2, p1 - p2
+    a, e, f = MeshTools.dot(d1, d1), MeshTools.dot(d2, d2), MeshTools.dot(d2, r)
+    c, b = MeshTools.dot(d1, r), MeshTools.dot(d1, d2)
+    denominator = a * e - b * b
+    s = np.where(denominator > epsilon, clamp(safeDivide(b * f - c * e, denominator)), 0.0)
+    t = safeDivide(b * s + f, e)
+    s = np.where(t < 0.0, clamp(safeDivide(-c, a)), np.where(t > 1.0, clamp(safeDivide(b - c, a)), s))
+    t = clamp(t)
+    # degenerate segments are points
+    s = np.where(a <= epsilon, 0.0, s)
+    t = np.where(a <= epsilon, clamp(safeDivide(f, e)), t)
+    t = np.where(e <= epsilon, 0.0, t)
+    s = np.where((e <= epsilon) & (a > epsilon), clamp(safeDivide(-c, a)), s)
+    return np.linalg.norm((p1 + s[:, None] * d1) - (p2 + t[:, None] * d2), axis=1)
+
+def segmentTriangleDistances(p, q, a, b, c):
+    """Exact distance between segments p->q and triangles abc on matching rows: zero
+    when they cross, otherwise reached at an end of the segment or on an edge.
+    """
+    hit, _ = MeshTools.segmentTriangleIntersection(p, q, a, b - a, c - a)
+    distances = np.minimum(pointTriangleDistances(p, a, b, c), pointTriangleDistances(q, a, b, c))
+    for start, end in ((a, b), (b, c), (c, a)):
+        distances = np.minimum(distances, segmentSegmentDistances(p, q, start, end))
+    return np.where(hit, 0.0, distances)
+
+
+def mortonCodes(points, bits=10):
+    lower, upper = points.min(axis=0), points.max(axis=0)
+    cells = ((points - lower) / np.maximum(upper - lower, 1e-12) * ((1 << bits) - 1)).astype(np.int64)
+    codes = np.zeros(len(points), dtype=np.int64)
+    for bit in range(bits):
+        for axis in range(3):
+            codes |= ((cells[:, axis] >> bit) & 1) << (3 * bit + axis)
+    return codes
+
+
+class TriangleBVH(object):
+    """Bounding volume hierarchy over the triangles of a surface. Triangles are
+    sorted along a Morton curve and every node splits its range in two halves,
+    so the tree is built level by level without a Python loop per node.
+    """
+
+    def __init__(self, triangles, leafSize=1):
+        triangles = np.ascontiguousarray(triangles, dtype=np.float64).reshape(-1, 3, 3)
+        if len(triangles) == 0:
+            self.triangles = triangles
+            self.nodeStart = self.nodeStop = self.nodeLeft = np.zeros(0, dtype=np.int64)
+            self.nodeLower = self.nodeUpper = np.zeros((0, 3))
+            return
+        self.triangles = triangles[np.argsort(mortonCodes(triangles.mean(axis=1)), kind='stable')]
+
+        starts, stops, lefts = [], [], []
+        levelStart = np.array([0])
+        levelStop = np.array([len(self.triangles)])
+        numberOfNodes = 0
+        while len(levelStart):
+            split = (levelStop - levelStart) > leafSize
+            middle = (levelStart + levelStop) // 2
+            # children of this level are numbered after every node built so far
+            firstChild = numberOfNodes + len(levelStart) + 2 * (np.cumsum(split) - split)
+            starts.append(levelStart)
+            stops.append(levelStop)
+            lefts.append(np.where(split, firstChild, -1))
+            numberOfNodes += len(levelStart)
+            levelStart, levelStop = (np.stack([levelStart[split], middle[split]], axis=1).ravel(),
+                                     np.stack([middle[split], levelStop[split]], axis=1).ravel())
+        self.nodeStart = np.concatenate(starts)
+        self.nodeStop = np.concatenate(stops)
+        self.nodeLeft = np.concatenate(lefts)
+
+        # leaves split the sorted triangles into consecutive ranges, parents merge their children
+        self.nodeLower = np.zeros((numberOfNodes, 3))
+        self.nodeUpper = np.zeros((numberOfNodes, 3))
+        leaves = np.nonzero(self.nodeLeft < 0)[0]
+        leaves = leaves[np.argsort(self.nodeStart[leaves])]
+        self.nodeLower[leaves] = np.minimum.reduceat(self.triangles.min(axis=1), self.nodeStart[leaves], axis=0)
+        self.nodeUpper[leaves] = np.maximum.reduceat(self.triangles.max(axis=1), self.nodeStart[leaves], axis=0)
+        levelEnds = np.cumsum([len(level) for level in starts])
+        for levelEnd, level in reversed(list(zip(levelEnds, lefts))):
+            parents = np.arange(levelEnd - len(level), levelEnd)[level >= 0]
+            children = self.nodeLeft[parents]
+            self.nodeLower[parents] = np.minimum(self.nodeLower[children], self.nodeLower[children + 1])
+            self.nodeUpper[parents] = np.maximum(self.nodeUpper[children], self.nodeUpper[children + 1])
+
+    @classmethod
+    def fromArrays(cls, arrays):
+        bvh = cls.__new__(cls)
+        for name, array in arrays.items():
+            setattr(bvh, name, array)
+        return bvh
+
+    def arrays(self):
+        return {'triangles': self.triangles, 'nodeStart': self.nodeStart, 'nodeStop': self.nodeStop,
+                'nodeLeft': self.nodeLeft, 'nodeLower': self.nodeLower, 'nodeUpper': self.nodeUpper}
+
+    def minimumDistances(self, entries, targets, chunkSize=1024):
+        """Exact minimum distance from every entry->target segment to the surface.
+        All segments descend the tree together; a node is dropped for a segment once
+        its bounds are further than the best distance found so far, and a corner of
+        every visited node keeps that best distance tight.
+        """
+        entries = np.asarray(entries, dtype=np.float64).reshape(-1, 3)
+        targets = np.asarray(targets, dtype=np.float64).reshape(-1, 3)
+        distances = np.full(len(entries), np.inf)
+        if len(self.triangles) == 0:
+            return distances
+        centres = (self.nodeLower + self.nodeUpper) / 2.0
+        halfDiagonals = np.linalg.norm(self.nodeUpper - self.nodeLower, axis=1) / 2.0
+        corners = self.triangles[self.nodeStart, 0]
+        for start in range(0, len(entries), chunkSize):
+            p = entries[start:start + chunkSize]
+            q = targets[start:start + chunkSize]
+            lower, upper = np.minimum(p, q), np.maximum(p, q)
+            best = np.full(len(p), np.inf)
+            segments = np.arange(len(p))
+            nodes = np.zeros(len(p), dtype=np.int64)
+            while len(segments):
+                np.minimum.at(best, segments, pointSegmentDistances(corners[nodes], p[segments], q[segments]))
+                # the larger of the bounding sphere distance and the gap between the boxes
+                bound = np.maximum(
+                    pointSegmentDistances(centres[nodes], p[segments], q[segments]) - halfDiagonals[nodes],
+                    np.linalg.norm(np.maximum(np.maximum(self.nodeLower[nodes] - upper[segments],
+                                                         lower[segments] - self.nodeUpper[nodes]), 0.0), axis=1))
+                keep = (bound < best[segments]) & (best[segments] > 0.0)
+                segments, nodes = segments[keep], nodes[keep]
+
+                leaf = self.nodeLeft[nodes] < 0
+                leafSegments, leafNodes = segments[leaf], nodes[leaf]
+                counts = self.nodeStop[leafNodes] - self.nodeStart[leafNodes]
+                pairSegments = np.repeat(leafSegments, counts)
+                offsets = np.arange(int(counts.sum())) - np.repeat(np.cumsum(counts) - counts, counts)
+                triangles = self.triangles[np.repeat(self.nodeStart[leafNodes], counts) + offsets]
+                np.minimum.at(best, pairSegments, segmentTriangleDistances(
+                    p[pairSegments], q[pairSegments], triangles[:, 0], triangles[:, 1], triangles[:, 2]))
+
+                segments, nodes = segments[~leaf], nodes[~leaf]
+                segments = np.repeat(segments, 2)
+                nodes = (self.nodeLeft[nodes][:, None] + np.array([0, 1])).ravel()
+            distances[start:start + chunkSize] = best
+        return distances
@@ -7,7 +7,15 @@ import numpy as np
 import time
 import math
 import Algorithms
+import BackgroundPlanner
+import Instrumentation
 import MathTools
+import MeshCache
+import ParallelPlanner
+import PlanningOptions
+import PlanningSession
+import TrajectoryFile
+import TrajectorySet
 
 
 # import sympy
@@ -151,9 +159,15 @@ class Task1Widget(ScriptedLoadableModuleWidget):
         self.precisionSlider.minimum = 0.001
         self.precisionSlider.maximum = 0.1
         self.precisionSlider.value = 0.01
-        self.precisionSlider.setToolTip("Set precision value for maximising distance to the critical structure")
+        self.precisionSlider.setToolTip("Step along each trajectory when the distance to the critical structures is sampled instead of exact")
+        self.precisionSlider.enabled = False
         parametersFormLayout.addRow("Precision", self.precisionSlider)
 
+        self.distanceModeSelector = qt.QComboBox()
+        self.distanceModeSelector.addItems(list(PlanningOptions.distanceModes))
+        self.distanceModeSelector.setToolTip("Distance to the critical structures used to rank the trajectories: exact, or sampled every Precision along them")
+        parametersFormLayout.addRow("Distance", self.distanceModeSelector)
+
         self.maximumIncisionLengthSlider = ctk.ctkSliderWidget()
         self.maximumIncisionLengthSlider.singleStep = 1
         self.maximumIncisionLengthSlider.minimum = 0.00
@@ -171,10 +185,42 @@ class Task1Widget(ScriptedLoadableModuleWidget):
         self.applyButton.enabled = False
         parametersFormLayout.addRow(self.applyButton)
 
+        #
+        # Background run: the pairs are planned in a worker thread and GoodPaths fills in chunk by chunk
+        #
+        self.backgroundButton = qt.QPushButton("Apply in background")
+        self.backgroundButton.toolTip = "Run the algorithm without blocking Slicer, showing partial results."
+        self.backgroundButton.enabled = False
+        self.cancelButton = qt.QPushButton("Cancel")
+        self.cancelButton.toolTip = "Stop the background run after the chunk being planned."
+        self.cancelButton.enabled = False
+        backgroundLayout = qt.QHBoxLayout()
+        backgroundLayout.addWidget(self.backgroundButton)
+        backgroundLayout.addWidget(self.cancelButton)
+        parametersFormLayout.addRow(backgroundLayout)
+        self.progressBar = qt.QProgressBar()
+        self.progressBar.setRange(0, 100)
+        self.progressBar.setValue(0)
+        parametersFormLayout.addRow(self.progressBar)
+        self.job = None
+        self.jobBest = {}
+        self.pollTimer = qt.QTimer()
+        self.pollTimer.setInterval(100)
+
         # connections
         self.applyButton.connect('clicked(bool)', self.onApplyButton)
+        self.backgroundButton.connect('clicked(bool)', self.onBackgroundButton)
+        self.cancelButton.connect('clicked(bool)', self.onCancelButton)
+        self.pollTimer.connect('timeout()', self.onPollJob)
         self.inputEntryFiducialSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
         self.inputTargetFiducialSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
+        # after the first Apply, sliders and moved markups update the plan incrementally
+        self.session = None
+        self.pathNode = None
+        self.validAngleSlider.connect('valueChanged(double)', self.onParameterChanged)
+        self.precisionSlider.connect('valueChanged(double)', self.onParameterChanged)
+        self.maximumIncisionLengthSlider.connect('valueChanged(double)', self.onParameterChanged)
+        self.distanceModeSelector.connect('currentIndexChanged(int)', self.onDistanceModeChanged)
 
         # Add vertical spacer
         self.layout.addStretch(1)
@@ -183,21 +229,120 @@ class Task1Widget(ScriptedLoadableModuleWidget):
         self.onSelect()
 
     def cleanup(self):
-        pass
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+        if self.job is not None:
+            # the job stops after its current chunk, its messages are never polled
+            self.job.cancel()
+            self.job.wait()
+            self.finishJob()
 
     def onSelect(self):
         self.applyButton.enabled = self.hippoSelector.currentNode() and self.ventSelector.currentNode() and self.vesselSelector.currentNode() and self.cortexSelector.currentNode() and self.inputTargetFiducialSelector.currentNode() and self.inputEntryFiducialSelector.currentNode()
+        self.backgroundButton.enabled = self.applyButton.enabled and self.job is None
 
     def onApplyButton(self):
         logic = Task1Logic()
         validAngleOfIntersection = self.validAngleSlider.value
         precisionValue = self.precisionSlider.value
         maximumIncisionValue = self.maximumIncisionLengthSlider.value
-        logic.run(self.hippoSelector.currentNode(), self.ventSelector.currentNode(), self.vesselSelector.currentNode(),
-                  self.cortexSelector.currentNode(),
-                  self.inputTargetFiducialSelector.currentNode(),
-                  self.inputEntryFiducialSelector.currentNode(),
-                  validAngleOfIntersection, precisionValue, maximumIncisionValue)
+        self.cleanup()
+        self.session = logic.startSession(self.hippoSelector.currentNode(), self.ventSelector.currentNode(), self.vesselSelector.currentNode(),
+                                          self.cortexSelector.currentNode(),
+                                          self.inputTargetFiducialSelector.currentNode(),
+                                          self.inputEntryFiducialSelector.currentNode(),
+                                          validAngleOfIntersection, precisionValue, maximumIncisionValue,
+                                          onChanged=self.onSessionChanged, distanceMode=self.distanceModeSelector.currentText)
+        if self.session is not None:
+            self.showBestTrajectories()
+
+    def onParameterChanged(self, value):
+        if self.session is None:
+            return
+        self.session.setParameters(self.validAngleSlider.value, self.precisionSlider.value, self.maximumIncisionLengthSlider.value)
+        self.showBestTrajectories()
+
+    def onDistanceModeChanged(self, index):
+        # the precision is only the sampling step of the sampled distances; the session keeps its mode until the next Apply
+        self.precisionSlider.enabled = self.distanceModeSelector.currentText == 'sampled'
+
+    def onSessionChanged(self, session):
+        self.showBestTrajectories()
+
+    def showBestTrajectories(self):
+        startTime = time.time()
+        # coloured by score, the distances, angle and length are extra cell arrays
+        allPaths = self.session.pathsPolyData()
+        self.showPaths(allPaths)
+        print('Best trajectories: ', allPaths.GetNumberOfLines(), 'entries,', time.time() - startTime, 'seconds,',
+              self.session.lastUpdate['pairs'], 'pairs recomputed')
+
+    def showPaths(self, allPaths):
+        if self.pathNode is None or slicer.mrmlScene.GetNodeByID(self.pathNode.GetID()) is None:
+            self.pathNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode', 'GoodPaths')
+        self.pathNode.SetAndObserveMesh(allPaths)
+        scalars = allPaths.GetCellData().GetScalars()
+        if scalars is not None:
+            self.pathNode.CreateDefaultDisplayNodes()
+            displayNode = self.pathNode.GetDisplayNode()
+            if hasattr(displayNode, 'SetActiveScalar'):
+                displayNode.SetActiveScalar(scalars.GetName(), vtk.vtkAssignAttribute.CELL_DATA)
+            else:
+                displayNode.SetActiveScalarName(scalars.GetName())
+            displayNode.SetScalarVisibility(True)
+
+    def onBackgroundButton(self):
+        logic = Task1Logic()
+        self.cleanup()
+        self.job = logic.startBackgroundRun(self.hippoSelector.currentNode(), self.ventSelector.currentNode(), self.vesselSelector.currentNode(),
+                                            self.cortexSelector.currentNode(),
+                                            self.inputTargetFiducialSelector.currentNode(),
+                                            self.inputEntryFiducialSelector.currentNode(),
+                                            self.validAngleSlider.value, self.precisionSlider.value, self.maximumIncisionLengthSlider.value,
+                                            distanceMode=self.distanceModeSelector.currentText)
+        if self.job is None:
+            return
+        self.jobBest = {}
+        self.progressBar.setValue(0)
+        self.applyButton.enabled = False
+        self.backgroundButton.enabled = False
+        self.cancelButton.enabled = True
+        self.pollTimer.start()
+
+    def onCancelButton(self):
+        if self.job is not None:
+            self.job.cancel()
+            self.cancelButton.enabled = False
+
+    def onPollJob(self):
+        # runs on the main thread, the only place the background run touches the scene
+        if self.job is None:
+            self.pollTimer.stop()
+            return
+        updated = False
+        for message in self.job.poll():
+            if message['type'] == 'progress':
+                self.progressBar.setValue(int(100 * message['done'] / max(message['total'], 1)))
+                if message['best']:
+                    bestTrajectories = BackgroundPlanner.mergeBest(self.jobBest, message['best'])
+                    updated = True
+            elif message['type'] == 'finished':
+                print('Background run: ', 'cancelled' if message['cancelled'] else 'finished', 'in', message['seconds'], 'seconds,',
+                      len(self.jobBest), 'entries')
+                self.finishJob()
+            elif message['type'] == 'error':
+                logging.error(message['message'])
+                slicer.util.errorDisplay('Background run failed.')
+                self.finishJob()
+        if updated:
+            self.showPaths(Algorithms.printEntryAndTargetsInDict(bestTrajectories))
+
+    def finishJob(self):
+        self.job = None
+        self.pollTimer.stop()
+        self.cancelButton.enabled = False
+        self.onSelect()
 
 
 #
@@ -246,10 +391,27 @@ class Task1Logic(ScriptedLoadableModuleLogic):
             return False
         return True
 
-    def run(self, hippo, ventricles, vessels, cortex, targetsNode, entriesNode, validAngleOfIntersection, precisionValue, maximumIncisionValue):
+    def run(self, hippo, ventricles, vessels, cortex, targetsNode, entriesNode, validAngleOfIntersection, precisionValue, maximumIncisionValue, options=None, runDiagnostics=False, printTiming=True, instrumentation=None, **settings):
         """
         Run the actual algorithm
+        options and settings are the PlanningOptions of the run (such as collisionMode='voxel' or workers=4)
+        runDiagnostics also runs each constraint separately over every entry/target pair
+        printTiming prints the timings and counts of the steps
+        instrumentation is an optional Instrumentation.Recorder that collects the spans and counters of the run
         """
+        options = PlanningOptions.planningOptions(options, **settings)
+        if instrumentation is not None:
+            with Instrumentation.recording(instrumentation):
+                result = self.run(hippo, ventricles, vessels, cortex, targetsNode, entriesNode, validAngleOfIntersection, precisionValue,
+                                  maximumIncisionValue, options, runDiagnostics, printTiming)
+            if printTiming:
+                print(instrumentation.report())
+            return result
+        if options.workers != 1 and ParallelPlanner.activePool is None:
+            # the constraints and the scoring share one set of worker processes
+            with ParallelPlanner.pooled(options.workers):
+                return self.run(hippo, ventricles, vessels, cortex, targetsNode, entriesNode, validAngleOfIntersection, precisionValue,
+                                maximumIncisionValue, options, runDiagnostics, printTiming)
         if not self.isValidInputOutputData(hippo, ventricles, vessels, cortex, targetsNode, entriesNode, validAngleOfIntersection, precisionValue, maximumIncisionValue):
             slicer.util.errorDisplay('Invalid input.')
             return False
@@ -264,42 +426,100 @@ class Task1Logic(ScriptedLoadableModuleLogic):
         startTime = time.time()
         newTargets = Algorithms.getValidTargets(targetsNode, hippo)
         endTime = time.time()
-        print('Hippo targets: ', endTime - startTime, 'seconds')
+        if printTiming:
+            print('Hippo targets: ', endTime - startTime, 'seconds')
+
+        if runDiagnostics:
+            self.runDiagnostics(ventricles, vessels, cortex, targetsNode, entriesNode, validAngleOfIntersection, options.collisionMode)
+
+        # length and geometry tests on the coordinates, before any surface query
+        prefilters = Algorithms.buildPrefilters(maximumIncisionValue, cortex, options.approachAngle)
+        if options.streaming:
+            # the pairs are made, filtered and ranked a chunk at a time, only the best of each entry is kept
+            topTrajectories, result = Algorithms.streamTopTrajectoriesPerEntry(
+                precisionValue, maximumIncisionValue, MathTools.getCoordinatesArray(entriesNode), newTargets, ventricles, vessels,
+                cortex, validAngleOfIntersection, options.collisionMode, options.normalMode, prefilters, workers=options.workers,
+                criterion=options.criterion, weights=options.weights, chunkSize=options.chunkSize,
+                distanceMode=options.distanceMode)
+            Algorithms.printTopTrajectories(topTrajectories)
+            if printTiming:
+                print('Valid Trajectories: ', result.numberOfValid)
+                print(result.report())
+                print('Mesh cache: ', MeshCache.defaultCache.statistics())
+            logging.info('Processing completed')
+            return True
+
+        combinedEntriesAndTargets = Algorithms.entriesAndTargetsSet(entriesNode, newTargets)
+        result = Algorithms.runConstraintPipeline(combinedEntriesAndTargets, ventricles, vessels, cortex, validAngleOfIntersection, options.collisionMode, workers=options.workers, hierarchical=options.hierarchical, normalMode=options.normalMode, prefilters=prefilters)
+        combinedEntriesAndTargets = result.trajectories
+        if printTiming:
+            print('Valid Trajectories: ', len(combinedEntriesAndTargets))
+            print(result.report())
+
+        # good to have some way of seeing our results
+        # allPaths = self.printEntryAndTargetsInDict(combinedEntriesAndTargets)
+        # pathNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode', 'GoodPaths')
+        # pathNode.SetAndObserveMesh(allPaths)
 
-        entriesAndTargets = Algorithms.entriesAndTargetsInDict(entriesNode, Algorithms.convertMarkupNodeToPoints(targetsNode))
+        bestTrajectiries = Algorithms.printBestTrajectoryForEachEntry(precisionValue, maximumIncisionValue, combinedEntriesAndTargets, vessels, ventricles, workers=options.workers, criterion=options.criterion, weights=options.weights, distanceMode=options.distanceMode)
+        # you can add something here to output the good entry target pairs
+        if printTiming:
+            print('Mesh cache: ', MeshCache.defaultCache.statistics())
+        logging.info('Processing completed')
+        return True
 
+    def startSession(self, hippo, ventricles, vessels, cortex, targetsNode, entriesNode, validAngleOfIntersection, precisionValue, maximumIncisionValue, options=None, onChanged=None, **settings):
+        """
+        Plans every entry/target pair once and returns a PlanningSession that follows the markups,
+        onChanged(session) is called after moved markups were re-planned
+        options and settings are the PlanningOptions of run, so the session ranks like run
+        """
+        if not self.isValidInputOutputData(hippo, ventricles, vessels, cortex, targetsNode, entriesNode, validAngleOfIntersection, precisionValue, maximumIncisionValue):
+            slicer.util.errorDisplay('Invalid input.')
+            return None
         startTime = time.time()
-        Algorithms.getIncisionsWithValidArea(entriesAndTargets, ventricles)
+        session = PlanningSession.PlanningSession(hippo, ventricles, vessels, cortex, targetsNode, entriesNode, validAngleOfIntersection,
+                                                  precisionValue, maximumIncisionValue, options, onChanged=onChanged, **settings)
+        session.observe()
+        print('Planning session: ', session.lastUpdate['pairs'], 'pairs in', time.time() - startTime, 'seconds')
+        return session
+
+    def startBackgroundRun(self, hippo, ventricles, vessels, cortex, targetsNode, entriesNode, validAngleOfIntersection, precisionValue, maximumIncisionValue, options=None, chunkSize=4096, **settings):
+        """
+        Starts the planning in a worker thread and returns the BackgroundPlanner.PlanningJob,
+        the markups and volumes are copied here so the worker never touches them
+        options and settings are the PlanningOptions of run
+        """
+        if not self.isValidInputOutputData(hippo, ventricles, vessels, cortex, targetsNode, entriesNode, validAngleOfIntersection, precisionValue, maximumIncisionValue):
+            slicer.util.errorDisplay('Invalid input.')
+            return None
+        job = BackgroundPlanner.PlanningJob(hippo, ventricles, vessels, cortex, MathTools.getCoordinatesArray(targetsNode),
+                                            MathTools.getCoordinatesArray(entriesNode), validAngleOfIntersection,
+                                            precisionValue, maximumIncisionValue, options, chunkSize, **settings)
+        return job.start()
+
+    def runDiagnostics(self, ventricles, vessels, cortex, targetsNode, entriesNode, validAngleOfIntersection, collisionMode='mesh'):
+        entriesAndTargets = Algorithms.entriesAndTargetsSet(entriesNode, Algorithms.convertMarkupNodeToPoints(targetsNode))
+
+        startTime = time.time()
+        Algorithms.getIncisionsWithValidArea(entriesAndTargets, ventricles, collisionMode)
         endTime = time.time()
         print('Incisions - Ventricles: ', endTime - startTime, 'seconds')
 
         startTime = time.time()
-        Algorithms.getIncisionsWithValidArea(entriesAndTargets, vessels)
+        Algorithms.getIncisionsWithValidArea(entriesAndTargets, vessels, collisionMode)
         endTime = time.time()
         print('Incisions - Blood Vessels: ', endTime - startTime, 'seconds')
 
+        if collisionMode == 'voxel':
+            print('Voxel/mesh agreement - Ventricles: ', Algorithms.collisionAgreement(entriesAndTargets, ventricles))
+            print('Voxel/mesh agreement - Blood Vessels: ', Algorithms.collisionAgreement(entriesAndTargets, vessels))
+
         startTime = time.time()
         Algorithms.getIncisionsWithValidAngle(entriesAndTargets, cortex, validAngleOfIntersection)
         endTime = time.time()
         print('Incisions - Valid Angle: ', endTime - startTime, 'seconds')
 
-        startTime = time.time()
-        newTargets = Algorithms.getValidTargets(targetsNode, hippo)
-        combinedEntriesAndTargets = Algorithms.entriesAndTargetsInDict(entriesNode, newTargets)
-        combinedEntriesAndTargets = Algorithms.combineConstraints(combinedEntriesAndTargets, ventricles, vessels, cortex, validAngleOfIntersection)
-        endTime = time.time()
-        print('Incisions - Combined: ', endTime - startTime, 'seconds')
-
-        # good to have some way of seeing our results
-        # allPaths = self.printEntryAndTargetsInDict(combinedEntriesAndTargets)
-        # pathNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode', 'GoodPaths')
-        # pathNode.SetAndObserveMesh(allPaths)
-
-        bestTrajectiries = Algorithms.printBestTrajectoryForEachEntry(precisionValue, maximumIncisionValue, combinedEntriesAndTargets, vessels, ventricles)
-        # you can add something here to output the good entry target pairs
-        logging.info('Processing completed')
-        return True
-
     
 
 
@@ -361,8 +581,8 @@ class Task1Test(ScriptedLoadableModuleTest):
         """Run as few or as many tests as needed here.
         """
         self.setUp()
-        self.test_LoadData(
-            "C:\Users\PWW\Documents\Assigment1")
+        # folder holding the patient data, Benchmark.py covers the stages with synthetic phantoms
+        self.test_LoadData(os.environ.get('TASK1_DATA_DIR', os.path.dirname(os.path.abspath(__file__))))
         # # self.testGetHippoTargets()
         self.testAvoidVentriclesValidPath()
         self.testAvoidVentriclesInvalidPath()
@@ -370,6 +590,17 @@ class Task1Test(ScriptedLoadableModuleTest):
         self.testAvoidBloodVesselsInvalidPath()
         self.testAngleValidPath()
         self.testAngleInvalidPath()
+        self.testAngleMissedCortexIsInvalid()
+        self.testBatchIntersectionMatchesCellLocator()
+        self.testVoxelCollisionAgreesWithMesh()
+        self.testPyramidCollisionMatchesVoxel()
+        self.testTrajectorySetDictRoundTrip()
+        self.testStreamingMatchesFullPlan()
+        self.testPrefiltersKeepValidTrajectories()
+        self.testExactDistanceBelowSampledDistance()
+        self.testBulkCoordinatesMatchFiducials()
+        self.testTrajectoryFileRoundTrip()
+        self.testBatchManifestDefaults()
         self.setUp()  # to reclear data
 
     def test_LoadData(self, path):
@@ -453,3 +684,138 @@ class Task1Test(ScriptedLoadableModuleTest):
         result = Algorithms.getIncisionsWithValidAngle(entriesAndTargets, cortex,55)
         self.assertTrue(len(result) == 0)
         self.delayDisplay('testAngleInvalidPath passed!')
+
+    def testAngleMissedCortexIsInvalid(self):
+        entriesAndTargets = {(1000.0, 1000.0, 1000.0): [[1001.0, 1000.0, 1000.0]]}
+        cortex = slicer.util.getNode("cortex")
+        self.assertTrue(len(Algorithms.getIncisionsWithValidAngle(entriesAndTargets, cortex, 55)) == 0)
+        surface = MeshCache.defaultCache.getSurface(cortex, (0, 0.5))
+        self.assertFalse(Algorithms.hasIntersectionValidAngle(surface.polyData, surface.getOBBTree(),
+                                                              [1000.0, 1000.0, 1000.0], [1001.0, 1000.0, 1000.0], 55))
+        self.delayDisplay('testAngleMissedCortexIsInvalid passed!')
+
+    def testBatchIntersectionMatchesCellLocator(self):
+        entriesID = [4,5,7,11,12,16,17,33,451,452,453,454]
+        targetsID = [3,4,5,6,7,10,11,12,161,162,163,164]
+        entriesAndTargets = Algorithms.addEntriesAndTargetsInDictFromID(entriesID,targetsID)
+        entries, targets = Algorithms.dictToArrays(entriesAndTargets)
+        for name in ["ventricles", "vessels"]:
+            area = slicer.util.getNode(name)
+            # vtkOBBTree misses hits near triangle edges, the cell locator tests every candidate cell
+            locator = MeshCache.defaultCache.getSurface(area).getCellLocator()
+            hits, _, _ = Algorithms.pointsIntersectBatch(Algorithms.getTriangleGrid(area), entries, targets)
+            for i in range(len(entries)):
+                t, point, parametric, subId = vtk.mutable(0.0), [0.0, 0.0, 0.0], [0.0, 0.0, 0.0], vtk.mutable(0)
+                self.assertEqual(bool(hits[i]), bool(locator.IntersectWithLine(entries[i], targets[i], 0.0, t, point, parametric, subId)))
+        self.delayDisplay('testBatchIntersectionMatchesCellLocator passed!')
+
+    def testVoxelCollisionAgreesWithMesh(self):
+        entriesID = [4,5,7,11,12,16,17,33,451,452,453,454]
+        targetsID = [3,4,5,6,7,10,11,12,161,162,163,164]
+        entriesAndTargets = Algorithms.addEntriesAndTargetsInDictFromID(entriesID,targetsID)
+        for name in ["ventricles", "vessels"]:
+            agreement = Algorithms.collisionAgreement(entriesAndTargets, slicer.util.getNode(name))
+            self.assertTrue(agreement > 0.9)
+        self.delayDisplay('testVoxelCollisionAgreesWithMesh passed!')
+
+    def testPyramidCollisionMatchesVoxel(self):
+        entriesAndTargets = Algorithms.addEntriesAndTargetsInDictFromID([4,5,7,11,12,16,17,33,451,452,453,454],[3,4,5,6,7,10,11,12,161,162,163,164])
+        entries, targets = Algorithms.dictToArrays(entriesAndTargets)
+        for name in ["ventricles", "vessels"]:
+            area = slicer.util.getNode(name)
+            voxelHits = Algorithms.areaIntersectBatch(area, entries, targets, 'voxel')
+            pyramidHits = Algorithms.areaIntersectBatch(area, entries, targets, 'pyramid')
+            self.assertTrue(np.array_equal(voxelHits, pyramidHits))
+        self.delayDisplay('testPyramidCollisionMatchesVoxel passed!')
+
+    def testTrajectorySetDictRoundTrip(self):
+        entriesAndTargets = Algorithms.addEntriesAndTargetsInDictFromID([451,452,453],[161,162])
+        trajectories = TrajectorySet.TrajectorySet.fromDict(entriesAndTargets)
+        self.assertEqual(len(trajectories), 6)
+        self.assertEqual(trajectories.toDict(), entriesAndTargets)
+        filtered = trajectories.filter(np.array([True, False, True, False, True, False]))
+        self.assertTrue(filtered.entries is trajectories.entries)
+        self.assertEqual(len(filtered.toDict()), 3)
+        self.delayDisplay('testTrajectorySetDictRoundTrip passed!')
+
+    def testStreamingMatchesFullPlan(self):
+        entries = MathTools.getCoordinatesArray(slicer.util.getNode("entries"))
+        targets = np.array(Algorithms.getValidTargets(slicer.util.getNode("targets"), slicer.util.getNode("r_hippo")))
+        ventricles, vessels, cortex = [slicer.util.getNode(name) for name in ["ventricles", "vessels", "cortex"]]
+        result = Algorithms.runConstraintPipeline(TrajectorySet.TrajectorySet.fromProduct(entries, targets), ventricles, vessels, cortex, 55.0)
+        full = Algorithms.topTrajectoriesPerEntry(0.01, 9999999999999.0, result.trajectories, vessels, ventricles, k=2)
+        streamed, summary = Algorithms.streamTopTrajectoriesPerEntry(0.01, 9999999999999.0, entries, targets, ventricles, vessels, cortex, 55.0, k=2, chunkSize=1000)
+        self.assertEqual(summary.numberOfValid, len(result.trajectories))
+        self.assertEqual(list(streamed.items()), list(full.items()))
+        self.delayDisplay('testStreamingMatchesFullPlan passed!')
+
+    def testPrefiltersKeepValidTrajectories(self):
+        entriesAndTargets = Algorithms.addEntriesAndTargetsInDictFromID([4,5,7,11,12,16,17,33,451,452,453,454],[3,4,5,6,7,10,11,12,161,162,163,164])
+        ventricles, vessels, cortex = [slicer.util.getNode(name) for name in ["ventricles", "vessels", "cortex"]]
+        plain = Algorithms.runConstraintPipeline(entriesAndTargets, ventricles, vessels, cortex, 55.0)
+        prefiltered = Algorithms.runConstraintPipeline(entriesAndTargets, ventricles, vessels, cortex, 55.0, prefilters=Algorithms.buildPrefilters(40.0))
+        lengths = MathTools.getDistancesBetweenPoints(plain.trajectories.entryPoints(), plain.trajectories.targetPoints())
+        self.assertEqual(prefiltered.order[0], 'incisionLength')
+        self.assertTrue(np.array_equal(prefiltered.trajectories.pairs, plain.trajectories.pairs[lengths <= 40.0]))
+        self.delayDisplay('testPrefiltersKeepValidTrajectories passed!')
+
+    def testExactDistanceBelowSampledDistance(self):
+        entriesAndTargets = Algorithms.addEntriesAndTargetsInDictFromID([451,452,453],[161,162])
+        entries, targets = Algorithms.dictToArrays(entriesAndTargets)
+        vessels = slicer.util.getNode("vessels")
+        locator = Algorithms.treesOfNodes(vessels)[0]
+        exact = Algorithms.distancesFromLinesToNodes(0.01, entries, targets, vessels)
+        for i in range(len(entries)):
+            sampled = Algorithms.distanceToClosestPointToLine(locator, entries[i], targets[i], 0.001)
+            self.assertTrue(exact[i] <= sampled + 1e-6)
+            self.assertTrue(sampled - exact[i] < 1.0)
+        self.delayDisplay('testExactDistanceBelowSampledDistance passed!')
+
+    def testBulkCoordinatesMatchFiducials(self):
+        entries = slicer.util.getNode("entries")
+        coordinates = MathTools.getCoordinatesArray(entries)
+        self.assertEqual(len(coordinates), entries.GetNumberOfMarkups())
+        for i in (0, 451, len(coordinates) - 1):
+            self.assertTrue(np.allclose(coordinates[i], MathTools.getCoordinates(entries, i)))
+        self.assertTrue(MathTools.getCoordinatesArray(entries) is coordinates)
+        entries.SetNthFiducialPosition(0, *(coordinates[0] + 1.0))
+        self.assertTrue(np.allclose(MathTools.getCoordinatesArray(entries)[0], coordinates[0] + 1.0))
+        self.delayDisplay('testBulkCoordinatesMatchFiducials passed!')
+
+    def testTrajectoryFileRoundTrip(self):
+        import tempfile
+        entries = np.array([[0.0, 0.0, 0.0], [1.0, 0.0, 0.0]])
+        targets = np.array([[0.0, 5.0, 0.0], [0.0, 0.0, 5.0], [3.0, 4.0, 0.0]])
+        path = os.path.join(tempfile.mkdtemp(), 'plan.traj')
+        with TrajectoryFile.TrajectoryWriter(path, entries, targets) as writer:
+            writer.write([0, 0], [0, 1], [1.0, 3.0], [[0.5, 0.5], [1.0, 2.0]])
+            writer.write([1], [2], [2.0], [[1.0, 1.0]])
+        planned = TrajectoryFile.readTrajectories(path)
+        self.assertEqual(len(planned), 3)
+        self.assertTrue(np.array_equal(planned.entries, entries))
+        self.assertEqual(planned.ranked()['score'].tolist(), [3.0, 2.0, 1.0])
+        self.assertTrue(np.allclose(planned.records['length'], [5.0, 5.0, np.sqrt(20.0)]))
+        self.assertEqual(planned.trajectories(slice(1, 2)).toDict(), {(0.0, 0.0, 0.0): [[0.0, 0.0, 5.0]]})
+        self.delayDisplay('testTrajectoryFileRoundTrip passed!')
+
+    def testBatchManifestDefaults(self):
+        import json
+        import tempfile
+        import BatchPlanner
+        folder = tempfile.mkdtemp()
+        manifest = {'defaults': {'angle': 40.0},
+                    'cases': [{'name': 'a', 'dataDir': 'data'},
+                              {'name': 'b', 'dataDir': 'data', 'angle': 30.0, 'entries': 'other/entries.fcsv', 'k': 3}]}
+        path = os.path.join(folder, 'cases.json')
+        with open(path, 'w') as manifestFile:
+            json.dump(manifest, manifestFile)
+        first, second = BatchPlanner.readManifest(path)
+        self.assertEqual((first['angle'], second['angle'], first['precision']), (40.0, 30.0, 0.01))
+        self.assertEqual(first['hippo'], os.path.join(folder, 'data', 'r_hippo.nii.gz'))
+        self.assertEqual(second['entries'], os.path.join(folder, 'other', 'entries.fcsv'))
+        self.assertEqual((first['options'].k, second['options'].k, second['options'].workers), (1, 3, 1))
+        manifest['cases'].append({'name': 'a', 'dataDir': 'data'})
+        with open(path, 'w') as manifestFile:
+            json.dump(manifest, manifestFile)
+        self.assertRaises(ValueError, BatchPlanner.readManifest, path)
+        self.delayDisplay('testBatchManifestDefaults passed!')
\ No newline at end of file
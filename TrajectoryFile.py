@@ -0,0 +1,153 @@
+"""Binary file of planned trajectories that loads through numpy.memmap:
+
+    32 byte preamble   magic, version, header length, number of pairs, offset of the rank order
+    JSON header        structures, metadata and the record layout, padded to 64 bytes
+    entries            (E,3) float64 RAS coordinates
+    targets            (T,3) float64 RAS coordinates
+    records            one per valid pair: entryIndex, targetIndex, score, length and the
+                       distance to each structure
+    order              int64 record indices by decreasing score
+
+Records are appended while the plan is scored, the pair count and the order are
+written when the file is closed.
+"""
+import json
+import struct
+import numpy as np
+import TrajectorySet
+
+magic = b'TRAJSET\x00'
+version = 1
+preamble = struct.Struct('<8sIIQQ')
+alignment = 64
+
+
+def recordType(numberOfStructures):
+    return np.dtype([('entryIndex', '<i4'), ('targetIndex', '<i4'), ('score', '<f8'),
+                     ('length', '<f8'), ('distances', '<f8', (numberOfStructures,))], align=True)
+
+def recordLayout(dtype):
+    # numpy dtype arguments that rebuild the record type, sub-array formats as '(n,)<f8'
+    formats = []
+    for name in dtype.names:
+        field = dtype.fields[name][0]
+        formats.append(field.str if field.shape == () else '%s%s' % (field.shape, field.base.str))
+    return {'names': list(dtype.names), 'formats': formats,
+            'offsets': [dtype.fields[name][1] for name in dtype.names], 'itemsize': dtype.itemsize}
+
+def padding(position):
+    return -position % alignment
+
+
+class TrajectoryWriter(object):
+    """Streams records to path. Use as a context manager or call close(), which
+    writes the pair count and the rank order; a file that was never closed reads
+    as empty.
+    """
+
+    def __init__(self, path, entries, targets, structures=('vessels', 'ventricles'), metadata=None):
+        self.entries = np.ascontiguousarray(entries, dtype='<f8').reshape(-1, 3)
+        self.targets = np.ascontiguousarray(targets, dtype='<f8').reshape(-1, 3)
+        self.structures = list(structures)
+        self.recordType = recordType(len(self.structures))
+        self.numberOfPairs = 0
+        self.scores = []
+        self.file = open(path, 'wb')
+
+        header = {'structures': self.structures, 'metadata': metadata or {},
+                  'numberOfEntries': len(self.entries), 'numberOfTargets': len(self.targets),
+                  'record': recordLayout(self.recordType)}
+        headerBytes = json.dumps(header).encode('utf-8')
+        headerBytes += b' ' * padding(preamble.size + len(headerBytes))
+        self.headerLength = len(headerBytes)
+        self.file.write(preamble.pack(magic, version, self.headerLength, 0, 0))
+        self.file.write(headerBytes)
+        self.file.write(self.entries.tobytes())
+        self.file.write(b'\x00' * padding(self.file.tell()))
+        self.file.write(self.targets.tobytes())
+        self.file.write(b'\x00' * padding(self.file.tell()))
+
+    def write(self, entryIndices, targetIndices, scores, distances=None):
+        entryIndices = np.asarray(entryIndices).ravel()
+        records = np.zeros(len(entryIndices), dtype=self.recordType)
+        records['entryIndex'] = entryIndices
+        records['targetIndex'] = np.asarray(targetIndices).ravel()
+        records['score'] = np.asarray(scores, dtype=np.float64).ravel()
+        records['length'] = np.linalg.norm(self.targets[records['targetIndex']] - self.entries[records['entryIndex']], axis=1)
+        if distances is not None:
+            records['distances'] = np.asarray(distances, dtype=np.float64).reshape(len(records), len(self.structures))
+        self.file.write(records.tobytes())
+        self.scores.append(records['score'].copy())
+        self.numberOfPairs += len(records)
+
+    def close(self):
+        if self.file.closed:
+            return
+        scores = np.concatenate(self.scores) if self.scores else np.zeros(0)
+        order = np.argsort(-scores, kind='stable').astype('<i8')
+        self.file.write(b'\x00' * padding(self.file.tell()))
+        orderOffset = self.file.tell()
+        self.file.write(order.tobytes())
+        self.file.seek(0)
+        self.file.write(preamble.pack(magic, version, self.headerLength, self.numberOfPairs, orderOffset))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+        return False
+
+
+class TrajectoryFile(object):
+    """Read-only view of a file written by TrajectoryWriter. Nothing is parsed but
+    the header: entries, targets, records and order are memory-mapped, so slices
+    only read the pages they touch.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as inputFile:
+            data = inputFile.read(preamble.size)
+            if len(data) < preamble.size or not data.startswith(magic):
+                raise ValueError('%s is not a trajectory file' % path)
+            _, fileVersion, headerLength, numberOfPairs, orderOffset = preamble.unpack(data)
+            if fileVersion > version:
+                raise ValueError('%s has version %d, this reader supports up to %d' % (path, fileVersion, version))
+            self.header = json.loads(inputFile.read(headerLength).decode('utf-8'))
+        self.path = path
+        self.version = fileVersion
+        self.structures = self.header['structures']
+        self.metadata = self.header['metadata']
+        self.recordType = np.dtype(self.header['record'])
+
+        offset = preamble.size + headerLength
+        self.entries = self.map(offset, '<f8', (self.header['numberOfEntries'], 3))
+        offset += self.entries.nbytes + padding(offset + self.entries.nbytes)
+        self.targets = self.map(offset, '<f8', (self.header['numberOfTargets'], 3))
+        offset += self.targets.nbytes + padding(offset + self.targets.nbytes)
+        # a file that was not closed has no pair count
+        self.records = self.map(offset, self.recordType, (numberOfPairs if orderOffset else 0,))
+        self.order = self.map(orderOffset, '<i8', (len(self.records),))
+
+    def map(self, offset, dtype, shape):
+        if int(np.prod(shape)) == 0:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(self.path, dtype=dtype, mode='r', offset=offset, shape=shape)
+
+    def __len__(self):
+        return len(self.records)
+
+    def ranked(self, count=None):
+        # records by decreasing score
+        order = self.order[:count] if count is not None else self.order
+        return self.records[np.asarray(order)]
+
+    def trajectories(self, rows=slice(None)):
+        records = self.records[rows]
+        return TrajectorySet.TrajectorySet(self.entries, self.targets,
+                                           np.stack([records['entryIndex'], records['targetIndex']], axis=1))
+
+
+def readTrajectories(path):
+    return TrajectoryFile(path)
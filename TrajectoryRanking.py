@@ -0,0 +1,77 @@
+import heapq
+import numpy as np
+
+criteria = ('sum', 'min', 'weighted')
+
+
+def combineScores(distances, criterion='sum', weights=None):
+    """(N,S) distances to each structure -> (N,) scores, larger is better. 'sum'
+    adds the distances, 'min' keeps the closest structure and 'weighted' sums
+    the distances times weights (one per structure).
+    """
+    distances = np.asarray(distances, dtype=np.float64).reshape(len(distances), -1)
+    if criterion == 'sum':
+        return distances.sum(axis=1)
+    if criterion == 'min':
+        return distances.min(axis=1) if distances.shape[1] else np.zeros(len(distances))
+    if criterion == 'weighted':
+        if weights is None or len(weights) != distances.shape[1]:
+            raise ValueError('weighted scores need one weight per structure')
+        return distances.dot(np.asarray(weights, dtype=np.float64))
+    raise ValueError('unknown score criterion: %s' % criterion)
+
+
+def topRowsPerEntry(entryIndices, scores, k, arrival=None):
+    # rows of the k best scores of every entry, ties go to the earlier arrival (row order by default)
+    entryIndices = np.asarray(entryIndices).ravel()
+    scores = np.asarray(scores, dtype=np.float64).ravel()
+    if arrival is None:
+        arrival = np.arange(len(scores))
+    order = np.lexsort((arrival, -scores, entryIndices))
+    sortedEntries = entryIndices[order]
+    firstOfEntry = np.searchsorted(sortedEntries, sortedEntries, side='left')
+    return order[np.arange(len(order)) - firstOfEntry < k]
+
+
+class TopKPerEntry(object):
+    """Keeps the k best scored trajectories of every entry from a stream of chunks,
+    using O(entries x k) memory. Ties keep the trajectory that arrived first, so
+    equal scores are never merged or dropped arbitrarily.
+    """
+
+    def __init__(self, k=1):
+        self.k = k
+        self.heaps = {}
+        self.count = 0
+
+    def push(self, entryIndices, targetIndices, scores):
+        entryIndices = np.asarray(entryIndices).ravel()
+        scores = np.asarray(scores, dtype=np.float64).ravel()
+        arrival = self.count + np.arange(len(scores))
+        self.count += len(scores)
+        # k best of each entry inside the chunk first, so only those reach the heaps
+        for row in topRowsPerEntry(entryIndices, scores, self.k, arrival).tolist():
+            # heap items are (score, -arrival) so the root is the worst one kept
+            item = (float(scores[row]), -int(arrival[row]), int(targetIndices[row]))
+            heap = self.heaps.setdefault(int(entryIndices[row]), [])
+            if len(heap) < self.k:
+                heapq.heappush(heap, item)
+            elif item > heap[0]:
+                heapq.heapreplace(heap, item)
+
+    def consume(self, chunks):
+        # chunks yields (entryIndices, targetIndices, scores)
+        for entryIndices, targetIndices, scores in chunks:
+            self.push(entryIndices, targetIndices, scores)
+        return self
+
+    def results(self):
+        """{entryIndex: [(score, targetIndex), ...]} best first, entries ordered by
+        their best score and then by arrival.
+        """
+        ranked = {}
+        for entryIndex, heap in self.heaps.items():
+            ranked[entryIndex] = sorted(heap, reverse=True)
+        order = sorted(ranked, key=lambda entryIndex: ranked[entryIndex][0][:2], reverse=True)
+        return dict((entryIndex, [(score, targetIndex) for score, _, targetIndex in ranked[entryIndex]])
+                    for entryIndex in order)
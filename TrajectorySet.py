@@ -0,0 +1,102 @@
+import numpy as np
+
+
+def contiguous(array, dtype, columns):
+    # keeps the same array object when it already has the right layout
+    array = np.asarray(array, dtype=dtype)
+    if array.ndim != 2 or array.shape[1] != columns or not array.flags.c_contiguous:
+        array = np.ascontiguousarray(array).reshape(-1, columns)
+    return array
+
+
+class TrajectorySet(object):
+    """Entry/target pairs stored as contiguous float64 entry and target coordinates
+    plus an int32 (P,2) array of [entry index, target index] pairs. Filtering only
+    builds a new pair array, the coordinate arrays are shared between sets.
+    """
+
+    def __init__(self, entries, targets, pairs):
+        self.entries = contiguous(entries, np.float64, 3)
+        self.targets = contiguous(targets, np.float64, 3)
+        self.pairs = contiguous(pairs, np.int32, 2)
+
+    @classmethod
+    def fromProduct(cls, entries, targets):
+        entries = np.asarray(entries, dtype=np.float64).reshape(-1, 3)
+        targets = np.asarray(targets, dtype=np.float64).reshape(-1, 3)
+        entryIndices, targetIndices = np.meshgrid(np.arange(len(entries)), np.arange(len(targets)), indexing='ij')
+        return cls(entries, targets, np.stack([entryIndices.ravel(), targetIndices.ravel()], axis=1))
+
+    @classmethod
+    def productChunks(cls, entries, targets, chunkSize=16384):
+        # the pairs of fromProduct, chunkSize at a time, so the whole pair array is never built
+        entries = np.asarray(entries, dtype=np.float64).reshape(-1, 3)
+        targets = np.asarray(targets, dtype=np.float64).reshape(-1, 3)
+        numberOfPairs = len(entries) * len(targets)
+        for start in range(0, numberOfPairs, chunkSize):
+            yield cls.fromProductRows(entries, targets, np.arange(start, min(start + chunkSize, numberOfPairs)))
+
+    @classmethod
+    def fromProductRows(cls, entries, targets, rows):
+        # the pairs of fromProduct at rows
+        entries = np.asarray(entries, dtype=np.float64).reshape(-1, 3)
+        targets = np.asarray(targets, dtype=np.float64).reshape(-1, 3)
+        entryIndices, targetIndices = np.divmod(np.asarray(rows, dtype=np.int64), len(targets))
+        return cls(entries, targets, np.stack([entryIndices, targetIndices], axis=1))
+
+    @classmethod
+    def fromArrays(cls, entryPoints, targetPoints):
+        # one row per pair, repeated coordinates are shared
+        entryPoints = np.asarray(entryPoints, dtype=np.float64).reshape(-1, 3)
+        targetPoints = np.asarray(targetPoints, dtype=np.float64).reshape(-1, 3)
+        entries, entryIndices = np.unique(entryPoints, axis=0, return_inverse=True)
+        targets, targetIndices = np.unique(targetPoints, axis=0, return_inverse=True)
+        return cls(entries, targets, np.stack([entryIndices.ravel(), targetIndices.ravel()], axis=1))
+
+    @classmethod
+    def fromDict(cls, entriesAndTargets):
+        entries = []
+        targets = []
+        targetIndex = {}
+        pairs = []
+        for entry, entryTargets in entriesAndTargets.items():
+            entries.append(entry)
+            for target in entryTargets:
+                key = tuple(target)
+                if key not in targetIndex:
+                    targetIndex[key] = len(targets)
+                    targets.append(key)
+                pairs.append((len(entries) - 1, targetIndex[key]))
+        return cls(entries, targets, pairs)
+
+    def toDict(self):
+        paths = {}
+        for entryIndex, targetIndex in self.pairs.tolist():
+            key = tuple(self.entries[entryIndex].tolist())
+            if key in paths:
+                paths[key].append(self.targets[targetIndex].tolist())
+            else:
+                paths[key] = [self.targets[targetIndex].tolist()]
+        return paths
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def entryPoints(self):
+        return self.entries[self.pairs[:, 0]]
+
+    def targetPoints(self):
+        return self.targets[self.pairs[:, 1]]
+
+    def filter(self, mask):
+        return TrajectorySet(self.entries, self.targets, self.pairs[mask])
+
+    def chunks(self, chunkSize):
+        for start in range(0, len(self), chunkSize):
+            yield TrajectorySet(self.entries, self.targets, self.pairs[start:start + chunkSize])
+
+
+def asTrajectorySet(entriesAndTargets):
+    if isinstance(entriesAndTargets, TrajectorySet):
+        return entriesAndTargets
+    return TrajectorySet.fromDict(entriesAndTargets)
@@ -0,0 +1,117 @@
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+
+def getRASToIJK(volumeNode):
+    matrix = vtk.vtkMatrix4x4()
+    volumeNode.GetRASToIJKMatrix(matrix)
+    return np.array([[matrix.GetElement(i, j) for j in range(4)] for i in range(4)])
+
+def getIJKToRAS(volumeNode):
+    return np.linalg.inv(getRASToIJK(volumeNode))
+
+def rasToIJK(volumeNode, points):
+    return applyMatrix(getRASToIJK(volumeNode), points)
+
+def applyMatrix(matrix, points):
+    return np.asarray(points, dtype=np.float64).reshape(-1, 3).dot(matrix[:3, :3].T) + matrix[:3, 3]
+
+def getLabelArray(volumeNode):
+    # voxel array indexed [k, j, i], shares memory with the image data
+    imageData = volumeNode.GetImageData()
+    columns, rows, slices = imageData.GetDimensions()
+    scalars = numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars())
+    return scalars.reshape(slices, rows, columns)
+
+def labelsAtPoints(volumeNode, points):
+    # label value of the voxel containing each RAS point, 0 outside the volume
+    labels = getLabelArray(volumeNode)
+    ijk = np.floor(rasToIJK(volumeNode, points) + 0.5).astype(np.int64)
+    inside = np.all((ijk >= 0) & (ijk < np.array(labels.shape[::-1])), axis=1)
+    values = np.zeros(len(ijk), dtype=labels.dtype)
+    values[inside] = labels[ijk[inside, 2], ijk[inside, 1], ijk[inside, 0]]
+    return values, inside
+
+def firstOccupiedVoxel(labels, start, end):
+    """Amanatides-Woo traversal of every start->end segment (continuous ijk, voxel
+    centres on integers) through labels, all segments stepped together.
+    Returns a (N,) hit mask and the (N,3) ijk of the first nonzero voxel (-1 on a miss).
+    """
+    start = np.asarray(start, dtype=np.float64).reshape(-1, 3) + 0.5
+    end = np.asarray(end, dtype=np.float64).reshape(-1, 3) + 0.5
+    shape = np.array(labels.shape[::-1])
+    hits = np.zeros(len(start), dtype=bool)
+    hitVoxels = np.full((len(start), 3), -1, dtype=np.int64)
+    lower, upper = occupiedBounds(labels)
+    if lower is None:
+        return hits, hitVoxels
+
+    # only the part of each segment inside the occupied bounds needs walking
+    tEnter, tExit = clipSegmentsToBox(start, end, lower, upper)
+    active = np.nonzero(tEnter <= tExit)[0]
+    start, end = start[active], end[active]
+    start, end = (start + tEnter[active, None] * (end - start),
+                  start + tExit[active, None] * (end - start))
+    direction = end - start
+    voxel = np.floor(start).astype(np.int64)
+    step = np.sign(direction).astype(np.int64)
+    moving = direction != 0
+    safeDirection = np.where(moving, direction, 1.0)
+    tDelta = np.where(moving, np.abs(1.0 / safeDirection), np.inf)
+    tMax = np.where(moving, (voxel + (step > 0) - start) / safeDirection, np.inf)
+
+    rows = active
+    active = np.arange(len(start))
+    while len(active):
+        current = voxel[active]
+        inside = np.all((current >= 0) & (current < shape), axis=1)
+        occupied = np.zeros(len(active), dtype=bool)
+        occupied[inside] = labels[current[inside, 2], current[inside, 1], current[inside, 0]] != 0
+        hits[rows[active[occupied]]] = True
+        hitVoxels[rows[active[occupied]]] = current[occupied]
+
+        nextCrossing = tMax[active].min(axis=1)
+        active = active[~occupied & (nextCrossing <= 1.0)]
+        axis = np.argmin(tMax[active], axis=1)
+        voxel[active, axis] += step[active, axis]
+        tMax[active, axis] += tDelta[active, axis]
+    return hits, hitVoxels
+
+def occupiedBounds(labels):
+    # [lower, upper) box of the nonzero voxels in the half-voxel shifted ijk frame
+    occupied = [np.nonzero(np.any(labels != 0, axis=axes))[0] for axes in ((0, 1), (0, 2), (1, 2))]
+    if len(occupied[0]) == 0:
+        return None, None
+    lower = np.array([indices[0] for indices in occupied], dtype=np.float64)
+    upper = np.array([indices[-1] + 1 for indices in occupied], dtype=np.float64)
+    return lower, upper
+
+def occupiedRASBounds(labels, rasToIJK, margin=1e-3):
+    # RAS box holding every voxel firstOccupiedVoxel can report, None without any
+    lower, upper = occupiedBounds(labels)
+    if lower is None:
+        return None
+    corners = np.array([[(upper if (corner >> axis) & 1 else lower)[axis] - 0.5 for axis in range(3)]
+                        for corner in range(8)])
+    corners = applyMatrix(np.linalg.inv(rasToIJK), corners)
+    return corners.min(axis=0) - margin, corners.max(axis=0) + margin
+
+def clipSegmentsToBox(start, end, lower, upper):
+    # slab test, returns the parametric [tEnter, tExit] of each segment inside the box (or its own (N,3) box)
+    direction = end - start
+    tEnter = np.zeros(len(start))
+    tExit = np.ones(len(start))
+    for axis in range(3):
+        d = direction[:, axis]
+        moving = d != 0
+        safe = np.where(moving, d, 1.0)
+        t0 = (lower[..., axis] - start[:, axis]) / safe
+        t1 = (upper[..., axis] - start[:, axis]) / safe
+        near = np.where(moving, np.minimum(t0, t1), -np.inf)
+        far = np.where(moving, np.maximum(t0, t1), np.inf)
+        outside = ~moving & ((start[:, axis] < lower[..., axis]) | (start[:, axis] > upper[..., axis]))
+        far[outside] = -np.inf
+        tEnter = np.maximum(tEnter, near)
+        tExit = np.minimum(tExit, far)
+    return tEnter, tExit
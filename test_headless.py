@@ -0,0 +1,969 @@
+"""Checks that run without Slicer or patient data, on the synthetic phantoms of
+Benchmark.py. Each compares a planning engine with the reference it replaced:
+
+    python -m pytest -q test_headless.py
+"""
+import json
+import os
+import signal
+import threading
+import numpy as np
+import pytest
+import vtk
+import Algorithms
+import BackgroundPlanner
+import BatchPlanner
+import Benchmark
+import ConstraintPipeline
+import DistanceField
+import HeadlessPlanner
+import Instrumentation
+import MathTools
+import MeshCache
+import MeshTools
+import OccupancyPyramid
+import ParallelPlanner
+import PlanningOptions
+import PlanningSession
+import SurfaceDistance
+import TrajectoryFile
+import TrajectoryRanking
+import TrajectorySet
+import VolumeTools
+
+
+class LabelVolume(object):
+    # the parts of a vtkMRMLLabelMapVolumeNode the planning code reads
+    def __init__(self, imageData, ijkToRAS, name, nodeID=None):
+        self.imageData = imageData
+        self.ijkToRAS = np.asarray(ijkToRAS, dtype=np.float64)
+        self.name = name
+        self.nodeID = nodeID or 'test.' + name
+
+    def GetImageData(self):
+        return self.imageData
+
+    def GetName(self):
+        return self.name
+
+    def GetID(self):
+        return self.nodeID
+
+    def GetMTime(self):
+        return self.imageData.GetMTime()
+
+    def GetIJKToRASMatrix(self, matrix):
+        matrix.DeepCopy(list(self.ijkToRAS.ravel()))
+
+    def GetRASToIJKMatrix(self, matrix):
+        matrix.DeepCopy(list(np.linalg.inv(self.ijkToRAS).ravel()))
+
+
+class FiducialList(object):
+    # a vtkMRMLMarkupsFiducialNode holding a fixed (N,3) RAS array, read one point at a time
+    def __init__(self, points, name):
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        self.name = name
+
+    def GetID(self):
+        return 'test.' + self.name
+
+    def GetMTime(self):
+        return 0
+
+    def GetNumberOfMarkups(self):
+        return len(self.points)
+
+    def GetNthFiducialPosition(self, index, position):
+        position[:] = self.points[index].tolist()
+
+
+@pytest.fixture(autouse=True)
+def freshCaches():
+    # phantoms reuse node IDs, nothing may carry over from another test
+    previous = MeshCache.defaultCache
+    MeshCache.defaultCache = MeshCache.MeshCache(None)
+    DistanceField.fieldCache.clear()
+    OccupancyPyramid.pyramidCache.clear()
+    MathTools.coordinatesCache.clear()
+    yield
+    MeshCache.defaultCache = previous
+
+
+def phantomPairs(phantom):
+    return TrajectorySet.TrajectorySet.fromProduct(phantom['entries'].points, phantom['targets'].points)
+
+def writePhantom(phantom, folder):
+    # the phantom as the files HeadlessPlanner --data-dir reads
+    for key in ('hippo', 'ventricles', 'vessels', 'cortex'):
+        writer = vtk.vtkNIFTIImageWriter()
+        writer.SetInputData(phantom[key].GetImageData())
+        writer.SetFileName(os.path.join(folder, phantom[key].GetName() + '.nii.gz'))
+        writer.Write()
+    for key in ('targets', 'entries'):
+        with open(os.path.join(folder, key + '.fcsv'), 'w') as fiducialFile:
+            fiducialFile.write('# CoordinateSystem = RAS\n')
+            for index, point in enumerate(phantom[key].points):
+                fiducialFile.write('%d,%r,%r,%r\n' % ((index,) + tuple(point.tolist())))
+
+def movedVolume(volume, matrix):
+    return LabelVolume(volume.GetImageData(), np.dot(matrix, volume.ijkToRAS), volume.GetName(), 'moved.' + volume.GetName())
+
+def surface(volume):
+    return MeshTools.extractSurface(volume.GetImageData(), None, VolumeTools.getIJKToRAS(volume))
+
+def collisions(volume, entries, targets, collisionMode):
+    # hit mask of each segment with the mesh or the voxels of volume
+    if collisionMode == 'mesh':
+        return MeshTools.intersectSegments(MeshTools.TriangleGrid(MeshTools.getTriangles(surface(volume))), entries, targets)[0]
+    start, end = VolumeTools.rasToIJK(volume, entries), VolumeTools.rasToIJK(volume, targets)
+    return VolumeTools.firstOccupiedVoxel(VolumeTools.getLabelArray(volume), start, end)[0]
+
+
+def testBatchIntersectionMatchesCellLocator():
+    # vtkCellLocator tests every triangle of the cells a line crosses, as the grid does
+    phantom = Benchmark.makePhantom(32, 40, 20)
+    pairs = phantomPairs(phantom)
+    entries, targets = pairs.entryPoints(), pairs.targetPoints()
+    for name in ('ventricles', 'vessels', 'cortex'):
+        polyData = surface(phantom[name])
+        grid = MeshTools.TriangleGrid(MeshTools.getTriangles(polyData))
+        assert len(grid.cellStart) == len(grid.occupiedCells) + 1 < np.prod(grid.shape)
+        hits, _, cellIds = MeshTools.intersectSegments(grid, entries, targets)
+        locator = vtk.vtkCellLocator()
+        locator.SetDataSet(polyData)
+        locator.BuildLocator()
+        expected = np.zeros(len(entries), dtype=bool)
+        for i in range(len(entries)):
+            t, point, parametric, subId = vtk.mutable(0.0), [0.0, 0.0, 0.0], [0.0, 0.0, 0.0], vtk.mutable(0)
+            expected[i] = locator.IntersectWithLine(entries[i], targets[i], 0.0, t, point, parametric, subId)
+        assert hits.any()
+        assert np.array_equal(hits, expected), name
+        assert np.array_equal(cellIds >= 0, hits)
+
+
+def testSurfacesShareTheFiducialFrame():
+    # axes swapped and flipped as in an LPS scan, the hits of the moved segments must not change
+    phantom = Benchmark.makePhantom(32, 40, 20)
+    pairs = phantomPairs(phantom)
+    entries, targets = pairs.entryPoints(), pairs.targetPoints()
+    frame = np.array([[0.0, -1.0, 0.0, 40.0], [1.0, 0.0, 0.0, -12.0], [0.0, 0.0, -1.0, 7.0], [0.0, 0.0, 0.0, 1.0]])
+    movedEntries = entries.dot(frame[:3, :3].T) + frame[:3, 3]
+    movedTargets = targets.dot(frame[:3, :3].T) + frame[:3, 3]
+    for name in ('ventricles', 'vessels'):
+        moved = movedVolume(phantom[name], frame)
+        for collisionMode in ('mesh', 'voxel'):
+            hits = collisions(phantom[name], entries, targets, collisionMode)
+            movedHits = collisions(moved, movedEntries, movedTargets, collisionMode)
+            assert 0 < hits.sum() < len(hits)
+            assert np.array_equal(hits, movedHits), (name, collisionMode)
+
+
+def testAreaIntersectBatchMatchesTheEngines():
+    # Algorithms picks the engine of the collision mode and builds its surface through the mesh cache
+    phantom = Benchmark.makePhantom(32, 40, 20)
+    pairs = phantomPairs(phantom)
+    entries, targets = pairs.entryPoints(), pairs.targetPoints()
+    for name in ('ventricles', 'vessels'):
+        for collisionMode in ('mesh', 'voxel'):
+            assert np.array_equal(Algorithms.areaIntersectBatch(phantom[name], entries, targets, collisionMode),
+                                  collisions(phantom[name], entries, targets, collisionMode)), (name, collisionMode)
+        assert np.array_equal(Algorithms.getTriangleGrid(phantom[name]).triangles,
+                              MeshTools.getTriangles(surface(phantom[name])))
+
+
+def testEmptyStructureIsInfinitelyFar():
+    # a structure without any voxel is infinitely far from every segment
+    phantom = Benchmark.makePhantom(24, 10, 5)
+    pairs = phantomPairs(phantom)
+    entries, targets = pairs.entryPoints(), pairs.targetPoints()
+    empty = Benchmark.labelVolume(np.zeros((24, 24, 24), dtype=bool), 'empty')
+    assert np.isfinite(DistanceField.minimumDistances(phantom['vessels'], entries, targets, 0.05)).all()
+    assert np.isposinf(DistanceField.minimumDistances(empty, entries, targets, 0.05)).all()
+
+
+def bruteForceDistances(features, spacing):
+    # distance from every voxel centre to the nearest feature voxel, pair by pair
+    scale = np.asarray(spacing, dtype=np.float64)
+    voxels = np.argwhere(np.ones(features.shape, dtype=bool)) * scale
+    featureVoxels = np.argwhere(features) * scale
+    distances = np.linalg.norm(voxels[:, None, :] - featureVoxels[None, :, :], axis=2).min(axis=1)
+    return distances.reshape(features.shape)
+
+
+def testDistanceTransformMatchesBruteForce():
+    rng = np.random.RandomState(5)
+    labels = rng.random_sample((7, 8, 9)) < 0.05
+    assert 0 < labels.sum() < labels.size
+    for spacing in ((1.0, 1.0, 1.0), (1.0, 2.0, 0.5)):
+        assert np.allclose(DistanceField.euclideanDistanceTransform(labels, spacing), bruteForceDistances(labels, spacing))
+    # positive outside the labels, negative inside
+    field = DistanceField.getDistanceField(Benchmark.labelVolume(labels, 'random')).field
+    expected = bruteForceDistances(labels, (1.0, 1.0, 1.0)) - bruteForceDistances(~labels, (1.0, 1.0, 1.0))
+    assert np.allclose(field, expected)
+
+    # the cache keeps the fields of the most recently used volumes only
+    volumes = [Benchmark.labelVolume(labels, 'random%d' % index) for index in range(DistanceField.maximumFields + 2)]
+    for volume in volumes:
+        DistanceField.getDistanceField(volume)
+    assert len(DistanceField.fieldCache) == DistanceField.maximumFields
+    assert volumes[0].GetID() not in DistanceField.fieldCache and volumes[-1].GetID() in DistanceField.fieldCache
+
+
+def testMeshCacheRebuildsBrokenEntries(tmp_path):
+    volume = Benchmark.makePhantom(24, 10, 5)['ventricles']
+    built = MeshCache.MeshCache(str(tmp_path)).getSurface(volume)
+    files = sorted(os.listdir(str(tmp_path)))
+    assert [os.path.splitext(name)[1] for name in files] == ['.npy', '.vtp']
+
+    cache = MeshCache.MeshCache(str(tmp_path))
+    assert np.array_equal(cache.getSurface(volume).triangles, built.triangles)
+    assert cache.statistics()['diskHits'] == 1
+
+    # a surface file cut short and a triangle file of another layout are both rebuilt
+    polyDataPath = os.path.join(str(tmp_path), files[1])
+    with open(polyDataPath, 'rb') as polyDataFile:
+        data = polyDataFile.read()
+    for name, content in ((files[1], data[:len(data) // 2]), (files[0], b'not an array')):
+        with open(os.path.join(str(tmp_path), name), 'wb') as brokenFile:
+            brokenFile.write(content)
+        cache = MeshCache.MeshCache(str(tmp_path))
+        assert np.array_equal(cache.getSurface(volume).triangles, built.triangles)
+        assert cache.statistics()['misses'] == 1
+        assert sorted(os.listdir(str(tmp_path))) == files
+    assert MeshCache.MeshCache(str(tmp_path)).getSurface(volume).polyData.GetNumberOfPolys() == len(built.triangles)
+
+
+def testMeshCacheKeepsTheLocators(tmp_path, monkeypatch):
+    volume = Benchmark.makePhantom(24, 10, 5)['vessels']
+    assert MeshCache.MeshCache(None).getSurface(volume).locatorPrefix is None
+    built = MeshCache.MeshCache(str(tmp_path)).getSurface(volume).getTriangleGrid()
+    gridPaths = [os.path.join(str(tmp_path), name) for name in os.listdir(str(tmp_path)) if name.endswith('.grid.npz')]
+    assert len(gridPaths) == 1
+
+    def binned(*arguments):
+        raise AssertionError('the grid was binned again')
+    with monkeypatch.context() as patch:
+        patch.setattr(MeshTools.TriangleGrid, '__init__', binned)
+        loaded = MeshCache.MeshCache(str(tmp_path)).getSurface(volume).getTriangleGrid()
+    for name, array in built.arrays().items():
+        assert np.array_equal(loaded.arrays()[name], array), name
+
+    # the normals are saved next to the grid on their first use, and loaded instead of computed afterwards
+    normals = MeshCache.MeshCache(str(tmp_path)).getSurface(volume).getTriangleGrid(normals=True)
+    assert len([name for name in os.listdir(str(tmp_path)) if name.endswith('.normals.npz')]) == 1
+
+    def computedAgain(*arguments):
+        raise AssertionError('the normals were computed again')
+    with monkeypatch.context() as patch:
+        patch.setattr(MeshTools, 'surfaceNormals', computedAgain)
+        loaded = MeshCache.MeshCache(str(tmp_path)).getSurface(volume).getTriangleGrid(normals=True)
+    for name in ('faceNormals', 'smoothNormals', 'cornerNormals'):
+        assert np.array_equal(getattr(loaded, name), getattr(normals, name)), name
+
+    # a grid file cut short is dropped and saved again
+    with open(gridPaths[0], 'rb') as gridFile:
+        data = gridFile.read()
+    with open(gridPaths[0], 'wb') as gridFile:
+        gridFile.write(data[:len(data) // 2])
+    rebuilt = MeshCache.MeshCache(str(tmp_path)).getSurface(volume).getTriangleGrid()
+    assert np.array_equal(rebuilt.cellTriangles, built.cellTriangles)
+    with np.load(gridPaths[0]) as saved:
+        assert np.array_equal(saved['occupiedCells'], built.occupiedCells)
+        assert 'triangles' not in saved.files
+
+    # the BVH sorts the triangles, it is saved with its own copy of them
+    bvh = MeshCache.MeshCache(str(tmp_path)).getSurface(volume).getBVH()
+
+    def sortedAgain(*arguments):
+        raise AssertionError('the BVH was built again')
+    with monkeypatch.context() as patch:
+        patch.setattr(SurfaceDistance.TriangleBVH, '__init__', sortedAgain)
+        loaded = MeshCache.MeshCache(str(tmp_path)).getSurface(volume).getBVH()
+    for name, array in bvh.arrays().items():
+        assert np.array_equal(loaded.arrays()[name], array), name
+
+
+def testTargetLabelsMatchThePointLookup():
+    # the voxel of every target, looked up one point at a time through vtkImageData.FindPoint before
+    phantom = Benchmark.makePhantom(24, 10, 300)
+    frame = np.array([[0.0, -1.5, 0.0, 40.0], [1.5, 0.0, 0.0, -12.0], [0.0, 0.0, -1.5, 7.0], [0.0, 0.0, 0.0, 1.0]])
+    hippo = movedVolume(phantom['hippo'], frame)
+    outside = np.array([[-30.0, 5.0, 5.0], [5.0, 100.0, 5.0]])
+    targets = FiducialList(np.vstack([phantom['targets'].points, outside]).dot(frame[:3, :3].T) + frame[:3, 3], 'targets')
+    points = MathTools.getCoordinatesArray(targets)
+    assert np.array_equal(points, targets.points)
+
+    values, inside = VolumeTools.labelsAtPoints(hippo, points)
+    rasToIJK = vtk.vtkMatrix4x4()
+    hippo.GetRASToIJKMatrix(rasToIJK)
+    imageData = hippo.GetImageData()
+    for i in range(len(points)):
+        ijk = rasToIJK.MultiplyPoint(list(points[i]) + [1.0])[:3]
+        voxelID = imageData.FindPoint(ijk)
+        assert inside[i] == (voxelID >= 0)
+        if voxelID >= 0:
+            voxel = imageData.GetPoint(voxelID)
+            assert values[i] == imageData.GetScalarComponentAsDouble(int(voxel[0]), int(voxel[1]), int(voxel[2]), 0)
+    assert 0 < (values != 0).sum() < len(values)
+    assert not inside[-2:].any()
+
+
+def testTrajectorySetDictRoundTrip():
+    phantom = Benchmark.makePhantom(24, 6, 4)
+    pairs = phantomPairs(phantom)
+    entriesAndTargets = pairs.toDict()
+    assert len(entriesAndTargets) == 6 and all(len(targets) == 4 for targets in entriesAndTargets.values())
+    again = TrajectorySet.TrajectorySet.fromDict(entriesAndTargets)
+    assert again.toDict() == entriesAndTargets
+    assert np.array_equal(again.entryPoints(), pairs.entryPoints())
+    assert np.array_equal(again.targetPoints(), pairs.targetPoints())
+    rows = TrajectorySet.TrajectorySet.fromArrays(pairs.entryPoints(), pairs.targetPoints())
+    assert rows.toDict() == entriesAndTargets
+
+    # filtering keeps the coordinate arrays and the order of the kept pairs
+    mask = np.arange(len(pairs)) % 3 != 1
+    kept = pairs.filter(mask)
+    assert kept.entries is pairs.entries and kept.targets is pairs.targets
+    assert np.array_equal(kept.entryPoints(), pairs.entryPoints()[mask])
+    assert np.array_equal(kept.targetPoints(), pairs.targetPoints()[mask])
+    assert TrajectorySet.asTrajectorySet(kept) is kept
+    assert TrajectorySet.asTrajectorySet(kept.toDict()).toDict() == kept.toDict()
+
+
+def testPlanningOptionsMergeInOrder():
+    # defaults, then the options, then the keyword settings
+    options = PlanningOptions.PlanningOptions({'collisionMode': 'voxel'})
+    assert PlanningOptions.PlanningOptions().collisionMode == 'mesh'
+    assert options.collisionMode == 'voxel'
+    assert PlanningOptions.PlanningOptions(options, collisionMode='mesh').collisionMode == 'mesh'
+    assert PlanningOptions.planningOptions(options) is options
+    assert options.replace(collisionMode='mesh') == PlanningOptions.PlanningOptions()
+    with pytest.raises(TypeError):
+        PlanningOptions.PlanningOptions(colisionMode='voxel')
+    with pytest.raises(ValueError):
+        PlanningOptions.PlanningOptions(collisionMode='octree')
+    with pytest.raises(ValueError):
+        PlanningOptions.PlanningOptions(workers=0)
+    with pytest.raises(ValueError):
+        PlanningOptions.PlanningOptions(distanceMode='nearest')
+    # the block tests run in one process over every pair
+    for settings in ({'workers': 4}, {'workers': None}, {'streaming': True}):
+        with pytest.raises(ValueError):
+            PlanningOptions.PlanningOptions(hierarchical=True, **settings)
+    assert PlanningOptions.PlanningOptions(hierarchical=True).hierarchical
+
+
+def testPipelineKeepsThePairsEveryConstraintKeeps():
+    # collisions with the phantom surfaces, run fused and one constraint at a time over every pair
+    phantom = Benchmark.makePhantom(32, 40, 20)
+    pairs = phantomPairs(phantom)
+    constraints = [ConstraintPipeline.Constraint(name, lambda entries, targets, name=name: ~collisions(phantom[name], entries, targets, 'mesh'))
+                   for name in ('ventricles', 'vessels')]
+    expected = np.ones(len(pairs), dtype=bool)
+    for constraint in constraints:
+        expected &= constraint.evaluate(pairs.entryPoints(), pairs.targetPoints())
+    for reorder in (True, False):
+        result = ConstraintPipeline.ConstraintPipeline(constraints, sampleSize=64, reorder=reorder).run(pairs)
+        assert np.array_equal(result.trajectories.pairs, pairs.pairs[expected])
+        assert sum(stage['rejected'] for stage in result.stages) == len(pairs) - expected.sum()
+        if not reorder:
+            assert result.order == ['ventricles', 'vessels']
+
+
+@pytest.mark.parametrize('collisionMode', ['mesh', 'voxel'])
+def testPrefiltersAndBoundsKeepTheResult(collisionMode):
+    # a maximum length that cuts about half the pairs, and segments that miss the ventricles' box
+    phantom = Benchmark.makePhantom(32, 40, 20)
+    pairs = phantomPairs(phantom)
+    nodes = (phantom['ventricles'], phantom['vessels'], phantom['cortex'], 55.0, collisionMode)
+    lengths = MathTools.getDistancesBetweenPoints(pairs.entryPoints(), pairs.targetPoints())
+    maximumLength = float(np.median(lengths))
+    plain = Algorithms.runConstraintPipeline(pairs, *nodes, reorder=False)
+    prefiltered = Algorithms.runConstraintPipeline(pairs, *nodes, reorder=False,
+                                                   prefilters=Algorithms.buildPrefilters(maximumLength))
+    stages = dict((stage['name'], stage) for stage in prefiltered.stages)
+    assert stages['incisionLength']['rejected'] == int((lengths > maximumLength).sum()) > 0
+    assert np.array_equal(prefiltered.valid, plain.valid & (lengths <= maximumLength))
+    # the same constraints without their bounds evaluate every segment and keep the same pairs
+    unbounded = [ConstraintPipeline.Constraint(constraint.name, constraint.evaluate)
+                 for constraint in Algorithms.buildConstraints(*nodes)]
+    everySegment = ConstraintPipeline.ConstraintPipeline(unbounded, reorder=False).run(pairs)
+    assert dict((stage['name'], stage) for stage in plain.stages)['ventricles']['skipped'] > 0
+    assert all(stage['skipped'] == 0 for stage in everySegment.stages)
+    assert np.array_equal(everySegment.valid, plain.valid)
+
+
+def serialPipeline(phantom, collisionMode, reorder=True):
+    # the constraints of the workers, evaluated in this process; the pyramid gives the hits of the voxel traversal
+    constraints = [ConstraintPipeline.Constraint(name, lambda entries, targets, name=name: ~collisions(phantom[name], entries, targets, collisionMode))
+                   for name in ('ventricles', 'vessels')]
+    cortexGrid = MeshCache.defaultCache.getSurface(phantom['cortex'], (0, 0.5)).getTriangleGrid()
+    constraints.append(ConstraintPipeline.Constraint(
+        'cortexAngle', lambda entries, targets: MeshTools.validAngleMask(cortexGrid, entries, targets, 55.0)))
+    return ConstraintPipeline.ConstraintPipeline(constraints, reorder=reorder)
+
+
+@pytest.mark.parametrize('collisionMode', ['mesh', 'voxel', 'pyramid'])
+def testParallelMatchesSerial(collisionMode):
+    phantom = Benchmark.makePhantom(32, 40, 20)
+    pairs = phantomPairs(phantom)
+    serial = serialPipeline(phantom, collisionMode).run(pairs)
+    parallel = ParallelPlanner.parallelConstraintPipeline(pairs, phantom['ventricles'], phantom['vessels'], phantom['cortex'],
+                                                          55.0, collisionMode, workers=3)
+    assert 0 < len(serial.trajectories) < len(pairs)
+    assert np.array_equal(serial.valid, parallel.valid)
+    assert sum(stage['rejected'] for stage in serial.stages) == sum(stage['rejected'] for stage in parallel.stages)
+    entries, targets = serial.trajectories.entryPoints(), serial.trajectories.targetPoints()
+    distances = sum(DistanceField.minimumDistances(phantom[name], entries, targets, 0.05) for name in ('vessels', 'ventricles'))
+    parallelDistances = ParallelPlanner.parallelDistances(serial.trajectories, 0.05, [phantom['vessels'], phantom['ventricles']],
+                                                          workers=3, distanceMode='sampled').sum(axis=1)
+    assert np.array_equal(distances, parallelDistances)
+
+
+@pytest.mark.parametrize('collisionMode', ['mesh', 'voxel', 'pyramid'])
+def testPipelineRunsTheSameWithWorkers(collisionMode):
+    phantom = Benchmark.makePhantom(32, 40, 20)
+    pairs = phantomPairs(phantom)
+    nodes = (phantom['ventricles'], phantom['vessels'], phantom['cortex'], 55.0, collisionMode)
+    serial = Algorithms.runConstraintPipeline(pairs, *nodes)
+    parallel = Algorithms.runConstraintPipeline(pairs, *nodes, workers=3)
+    assert 0 < len(serial.trajectories) < len(pairs)
+    assert np.array_equal(serial.valid, parallel.valid)
+    assert sum(stage['rejected'] for stage in serial.stages) == sum(stage['rejected'] for stage in parallel.stages)
+    distances = Algorithms.sortedByMaximumDistanceFromLinesToNodes(0.05, serial.trajectories, phantom['vessels'], phantom['ventricles'])
+    parallelDistances = Algorithms.sortedByMaximumDistanceFromLinesToNodes(0.05, serial.trajectories, phantom['vessels'],
+                                                                           phantom['ventricles'], workers=3)
+    assert distances == parallelDistances
+
+
+def testPyramidMatchesTheVoxelTraversal():
+    phantom = Benchmark.makePhantom(48, 200, 100)
+    pairs = phantomPairs(phantom)
+    entries, targets = pairs.entryPoints(), pairs.targetPoints()
+    for name in ('ventricles', 'vessels'):
+        with Instrumentation.recording(Instrumentation.Recorder()) as recorder:
+            pyramidHits = Algorithms.areaIntersectBatch(phantom[name], entries, targets, 'pyramid')
+        voxelHits = Algorithms.areaIntersectBatch(phantom[name], entries, targets, 'voxel')
+        assert 0 < voxelHits.sum() < len(pairs)
+        assert np.array_equal(pyramidHits, voxelHits), name
+        # every pair is decided at exactly one level, most of them above full resolution
+        levels = [recorder.counters['pyramid.level%d' % factor] for factor in (8, 4, 2, 1)]
+        assert sum(levels) == len(pairs) and levels[-1] < len(pairs)
+    # a box per segment clips like one shared box
+    lower, upper = np.full((len(entries), 3), -5.0), np.full((len(entries), 3), 5.0)
+    assert np.array_equal(VolumeTools.clipSegmentsToBox(entries, targets, lower, upper),
+                          VolumeTools.clipSegmentsToBox(entries, targets, lower[0], upper[0]))
+
+    # an edited volume replaces its pyramid, and the cache keeps those of the most recently used volumes only
+    volume = phantom['ventricles']
+    built = OccupancyPyramid.getOccupancyPyramid(volume)
+    numberOfPyramids = len(OccupancyPyramid.pyramidCache)
+    volume.GetImageData().Modified()
+    assert OccupancyPyramid.getOccupancyPyramid(volume) is not built
+    assert len(OccupancyPyramid.pyramidCache) == numberOfPyramids
+    labels = np.zeros((6, 6, 6), dtype=bool)
+    labels[2, 3, 1] = True
+    volumes = [Benchmark.labelVolume(labels, 'block%d' % index) for index in range(OccupancyPyramid.maximumPyramids + 2)]
+    for volume in volumes:
+        OccupancyPyramid.getOccupancyPyramid(volume)
+    assert len(OccupancyPyramid.pyramidCache) == OccupancyPyramid.maximumPyramids
+    assert volumes[0].GetID() not in OccupancyPyramid.pyramidCache and volumes[-1].GetID() in OccupancyPyramid.pyramidCache
+
+
+def testParallelPipelineKeepsTheDeclaredOrder():
+    phantom = Benchmark.makePhantom(32, 40, 20)
+    pairs = phantomPairs(phantom)
+    serial = serialPipeline(phantom, 'mesh', reorder=False).run(pairs)
+    parallel = ParallelPlanner.parallelConstraintPipeline(pairs, phantom['ventricles'], phantom['vessels'], phantom['cortex'],
+                                                          55.0, reorder=False, workers=2)
+    assert serial.order == parallel.order == ['ventricles', 'vessels', 'cortexAngle']
+    assert np.array_equal(serial.valid, parallel.valid)
+    nodes = (phantom['ventricles'], phantom['vessels'], phantom['cortex'], 55.0)
+    assert np.array_equal(Algorithms.runConstraintPipeline(pairs, *nodes, reorder=False, workers=2).valid, serial.valid)
+
+
+def testParallelChunksShareOneOrder():
+    phantom = Benchmark.makePhantom(32, 40, 20)
+    pairs = phantomPairs(phantom)
+    with Instrumentation.recording(Instrumentation.Recorder()) as recorder:
+        result = ParallelPlanner.parallelConstraintPipeline(pairs, phantom['ventricles'], phantom['vessels'],
+                                                            phantom['cortex'], 55.0, workers=3)
+    # calibrated once in this process, so the merged stages chain like those of a serial run
+    assert recorder.totals()['constraintCalibration']['calls'] == 1
+    assert [stage['name'] for stage in result.stages] == result.order
+    assert result.stages[0]['pairsIn'] == len(pairs)
+    assert all(before['pairsOut'] == after['pairsIn'] for before, after in zip(result.stages, result.stages[1:]))
+    assert result.stages[-1]['pairsOut'] == len(result.trajectories)
+    # the spans of the workers reach this recorder
+    totals = recorder.totals()
+    assert all(totals['constraint.' + stage['name']]['pairsIn'] == stage['pairsIn'] for stage in result.stages)
+    assert all(record['thread'].startswith('worker ') for record in recorder.spans if record['name'].startswith('constraint.'))
+
+
+def testHeadlessPlannerMatchesInMemoryPlan(tmp_path):
+    # the command line run from files gives the CSV of plan() on the nodes themselves
+    phantom = Benchmark.makePhantom(32, 40, 20)
+    writePhantom(phantom, str(tmp_path))
+    output = str(tmp_path / 'trajectories.csv')
+    meshes = str(tmp_path / 'meshes')
+    assert HeadlessPlanner.main(['--data-dir', str(tmp_path), '--output', output, '--angle', '60',
+                                 '--mesh-cache', meshes, '--summary', str(tmp_path / 'summary.json')]) == 0
+    assert any(name.endswith('.vtp') for name in os.listdir(meshes))
+    ranked, best, _ = HeadlessPlanner.plan(phantom['hippo'], phantom['ventricles'], phantom['vessels'], phantom['cortex'],
+                                           phantom['targets'], phantom['entries'], 60.0, 0.01, 9999999999999.0)
+    assert len(ranked) > 0
+    expected = str(tmp_path / 'expected.csv')
+    HeadlessPlanner.writeTrajectories(expected, ranked, best)
+    with open(output) as outputFile, open(expected) as expectedFile:
+        assert outputFile.read() == expectedFile.read()
+
+
+def testBenchmarkReportsStagesAndRegressions(tmp_path):
+    cache = MeshCache.defaultCache
+    output = str(tmp_path / 'results.json')
+    assert Benchmark.main(['--sizes', '24', '--entries', '10', '--targets', '5', '--repeats', '1', '--output', output]) == 0
+    assert MeshCache.defaultCache is cache and not DistanceField.fieldCache
+    assert not OccupancyPyramid.pyramidCache and not MathTools.coordinatesCache
+    with open(output) as resultsFile:
+        case = json.load(resultsFile)['cases'][0]
+    assert case['candidatePairs'] >= case['validPairs'] > 0
+    assert 'combineConstraints' in case['stages']
+    # a case starts without the caller's pyramids and gives them back afterwards
+    OccupancyPyramid.pyramidCache['caller'] = (0, None)
+    Benchmark.benchmarkCase(24, 10, 5, repeats=1, collisionMode='pyramid')
+    assert list(OccupancyPyramid.pyramidCache.items()) == [('caller', (0, None))]
+
+    def results(seconds):
+        stages = dict((stage, {'bestSeconds': value}) for stage, value in seconds.items())
+        return {'cases': [{'size': 24, 'entries': 10, 'targets': 5, 'collisionMode': 'mesh', 'stages': stages}]}
+    regressions = Benchmark.compare(results({'slower': 0.5, 'same': 0.1, 'tiny': 0.0009, 'new': 1.0}),
+                                    results({'slower': 0.1, 'same': 0.1, 'tiny': 0.0001}), 1.25)
+    assert [regression['stage'] for regression in regressions] == ['slower']
+
+
+def testArrayKernelsMatchScalarOnes():
+    rng = np.random.RandomState(1)
+    entries, intersections, p1, p2, p3 = (rng.uniform(-50, 50, (200, 3)) for _ in range(5))
+    angles = MathTools.getAngles(entries, intersections, p1, p2, p3)
+    lengths = MathTools.getDistancesBetweenPoints(entries, intersections)
+    for index in range(len(entries)):
+        assert np.isclose(angles[index], MathTools.getAngle(entries[index], intersections[index], p1[index], p2[index], p3[index]))
+        assert np.isclose(lengths[index], MathTools.getDistanceBetweenPoints(entries[index], intersections[index]))
+    assert np.allclose(MathTools.perpendicularVectorsFromThreePoints(p1, p2, p3),
+                       [MathTools.returnPerpendicularVectorFromThreePoints(*points) for points in zip(p1, p2, p3)])
+    assert np.allclose(MathTools.anglesInDegreesBetweenVectors(p1, p2),
+                       [MathTools.angleInDegreesBetweenTwoVectors(a, b) for a, b in zip(p1, p2)])
+
+
+def testCortexNormalsPointOutwardAndKeepTheFaceAngles():
+    sphere = vtk.vtkSphereSource()
+    sphere.SetRadius(10.0)
+    sphere.SetThetaResolution(24)
+    sphere.SetPhiResolution(24)
+    sphere.Update()
+    triangles = MeshTools.getTriangles(sphere.GetOutput())
+    rng = np.random.RandomState(2)
+    directions = MeshTools.unitVectors(rng.normal(size=(200, 3)))
+    entries, targets = 30.0 * directions, np.zeros((200, 3))
+    # either winding of the surface gives outward normals
+    for surface in (triangles, triangles[:, ::-1]):
+        grid = MeshTools.TriangleGrid(surface).computeNormals()
+        centres = surface.mean(axis=1)
+        assert (MeshTools.dot(grid.faceNormals, centres) > 0).all()
+        assert (MeshTools.dot(grid.smoothNormals, centres) > 0).all()
+        assert np.allclose(np.linalg.norm(grid.cornerNormals, axis=2), 1.0)
+
+        hits, points, cellIds = MeshTools.intersectSegments(grid, entries, targets)
+        assert hits.all()
+        faces = surface[cellIds]
+        expected = MathTools.getAngles(entries, points, faces[:, 0], faces[:, 1], faces[:, 2])
+        assert np.allclose(MeshTools.intersectionAngles(grid, entries, targets, 'face'), expected)
+        # lines through the centre are radial, the interpolated normals nearly so
+        vertexAngles = MeshTools.intersectionAngles(grid, entries, targets, 'vertex')
+        assert vertexAngles.max() < 2.0 < expected.max()
+
+        # the approach cone keeps the radial lines from the surface and drops the tangent ones
+        surfaceEntries = 10.0 * directions
+        tangents = surfaceEntries + 5.0 * MeshTools.unitVectors(np.cross(directions, rng.normal(size=(200, 3))))
+        known = ~np.isnan(MeshTools.nearestFaceNormals(grid, surfaceEntries)[:, 0])
+        assert known.any()
+        assert MeshTools.approachMask(grid, surfaceEntries, targets, 20.0).all()
+        assert not MeshTools.approachMask(grid, surfaceEntries, tangents, 20.0)[known].any()
+        assert np.isfinite(MeshTools.intersectionAngles(grid, entries, targets, 'smooth')).all()
+
+    # a line that misses the surface has no angle and is never valid
+    miss = [[100.0, 100.0, 100.0]], [[101.0, 100.0, 100.0]]
+    assert np.isnan(MeshTools.intersectionAngles(grid, *miss)).all()
+    assert not MeshTools.validAngleMask(grid, miss[0], miss[1], 55.0, 'vertex').any()
+    with pytest.raises(ValueError):
+        PlanningOptions.PlanningOptions(normalMode='polygon')
+
+@pytest.mark.parametrize('collisionMode', ['mesh', 'voxel'])
+def testHierarchicalMatchesExhaustive(collisionMode):
+    phantom = Benchmark.makePhantom(48, 200, 100)
+    pairs = phantomPairs(phantom)
+    nodes = (phantom['ventricles'], phantom['vessels'], phantom['cortex'], 55.0, collisionMode)
+    exhaustive = Algorithms.runConstraintPipeline(pairs, *nodes)
+    hierarchical = Algorithms.runConstraintPipeline(pairs, *nodes, hierarchical=True)
+    assert np.array_equal(exhaustive.valid, hierarchical.valid)
+    # the blocks must have decided part of the pairs for the comparison to mean anything
+    stages = dict((stage['name'], stage) for stage in hierarchical.stages)
+    assert stages['ventricles']['blocksClear'] + stages['ventricles']['blocksBlocked'] > 0
+    assert stages['vessels']['pairsTestedExactly'] < stages['vessels']['pairsIn']
+
+
+
+def testSurfaceDistanceMatchesBruteForce():
+    phantom = Benchmark.makePhantom(32, 40, 20)
+    pairs = phantomPairs(phantom)
+    rows = np.random.RandomState(2).choice(len(pairs), 40, replace=False)
+    entries, targets = pairs.entryPoints()[rows], pairs.targetPoints()[rows]
+    surface = MeshCache.defaultCache.getSurface(phantom['vessels'])
+    triangles = surface.triangles
+    distances = SurfaceDistance.TriangleBVH(triangles).minimumDistances(entries, targets)
+
+    # every triangle against every segment, so the tree may not prune a closer triangle
+    for index in range(len(entries)):
+        p = np.repeat(entries[index:index + 1], len(triangles), axis=0)
+        q = np.repeat(targets[index:index + 1], len(triangles), axis=0)
+        bruteForce = SurfaceDistance.segmentTriangleDistances(p, q, triangles[:, 0], triangles[:, 1], triangles[:, 2]).min()
+        assert distances[index] == bruteForce
+
+    # the closest points of vtkCellLocator at dense samples are at most half a step further away
+    locator = surface.getCellLocator()
+    steps = np.linspace(0.0, 1.0, 401)
+    closest, cellId, subId, squared = [0.0, 0.0, 0.0], vtk.reference(0), vtk.reference(0), vtk.reference(0.0)
+    for index in range(len(entries)):
+        sampled = []
+        for t in steps:
+            locator.FindClosestPoint(entries[index] + t * (targets[index] - entries[index]), closest, cellId, subId, squared)
+            sampled.append(np.sqrt(squared.get()))
+        halfStep = 0.5 * np.linalg.norm(targets[index] - entries[index]) / (len(steps) - 1)
+        assert distances[index] - 1e-9 <= min(sampled) <= distances[index] + halfStep + 1e-9
+    assert (distances == 0.0).any() and (distances > 0.0).any()
+
+
+
+@pytest.mark.parametrize('k', [1, 3])
+def testRankingHeapsMatchAFullSort(k):
+    rng = np.random.RandomState(3)
+    entryIndices = rng.randint(0, 20, 5000)
+    targetIndices = rng.randint(0, 400, 5000)
+    # rounded scores make ties, which go to the earlier arrival
+    scores = np.round(rng.uniform(0, 10, 5000), 1)
+    ranking = TrajectoryRanking.TopKPerEntry(k)
+    ranking.consume((entryIndices[start:start + 700], targetIndices[start:start + 700], scores[start:start + 700])
+                    for start in range(0, 5000, 700))
+
+    expected = {}
+    for row in sorted(range(5000), key=lambda row: (-scores[row], row)):
+        kept = expected.setdefault(int(entryIndices[row]), [])
+        if len(kept) < k:
+            kept.append((row, float(scores[row]), int(targetIndices[row])))
+    order = sorted(expected, key=lambda entryIndex: (-expected[entryIndex][0][1], expected[entryIndex][0][0]))
+    results = ranking.results()
+    assert list(results) == order
+    for entryIndex in order:
+        assert results[entryIndex] == [(score, targetIndex) for _, score, targetIndex in expected[entryIndex]]
+
+
+def testPlanScoresOnceOnOnePool(monkeypatch):
+    phantom = Benchmark.makePhantom(32, 40, 20)
+    nodes = [phantom[key] for key in ('hippo', 'ventricles', 'vessels', 'cortex', 'targets', 'entries')]
+    ranked, best, result = HeadlessPlanner.plan(*nodes + [55.0, 0.01, 40.0], k=2)
+    assert 0 < len(ranked)
+    scored, pools = [], []
+    distanceMatrix, poolInit = Algorithms.distanceMatrix, ParallelPlanner.PlannerPool.__init__
+    monkeypatch.setattr(Algorithms, 'distanceMatrix', lambda *arguments, **options: scored.append(len(arguments[1])) or
+                        distanceMatrix(*arguments, **options))
+    monkeypatch.setattr(ParallelPlanner.PlannerPool, '__init__', lambda pool, *arguments: pools.append(pool) or
+                        poolInit(pool, *arguments))
+    parallel = HeadlessPlanner.plan(*nodes + [55.0, 0.01, 40.0], k=2, workers=2)
+    assert parallel[:2] == (ranked, best)
+    assert sum(scored) == len(ranked) and len(pools) == 1
+    # the same ranking as the two separate passes
+    separate = Algorithms.topTrajectoriesPerEntry(0.01, 40.0, result.trajectories, phantom['vessels'], phantom['ventricles'], k=2)
+    assert Algorithms.rankedTrajectories(0.01, 40.0, result.trajectories, phantom['vessels'], phantom['ventricles']) == ranked
+    assert list(best) == list(separate) and all(best[entry] == [target for _, target in separate[entry]] for entry in best)
+
+
+def testStreamingPlanMatchesTheEagerOne():
+    phantom = Benchmark.makePhantom(32, 40, 20)
+    nodes = [phantom[key] for key in ('hippo', 'ventricles', 'vessels', 'cortex', 'targets', 'entries')]
+    chunks = list(TrajectorySet.TrajectorySet.productChunks(phantom['entries'].points, phantom['targets'].points, 97))
+    assert np.array_equal(np.concatenate([chunk.pairs for chunk in chunks]), phantomPairs(phantom).pairs)
+    assert max(len(chunk) for chunk in chunks) == 97
+
+    ranked, best, result = HeadlessPlanner.plan(*nodes + [55.0, 0.01, 40.0], k=2)
+    with Instrumentation.recording(Instrumentation.Recorder()) as recorder:
+        streamedRanked, streamedBest, summary = HeadlessPlanner.plan(*nodes + [55.0, 0.01, 40.0], k=2, streaming=True,
+                                                                     chunkSize=97)
+    assert streamedBest == best and summary.trajectories is None
+    # the streamed ranking holds the k best of each entry, by decreasing score
+    kept = set((tuple(entry), tuple(target)) for entry, targets in best.items() for target in targets)
+    assert sorted(streamedRanked) == sorted(item for item in ranked if (tuple(item[1][0]), tuple(item[1][1])) in kept)
+    assert [score for score, _ in streamedRanked] == sorted((score for score, _ in streamedRanked), reverse=True)
+    assert summary.numberOfValid == len(result.trajectories)
+    # the constraint order is calibrated once, on a sample of the whole product that the chunks do not reuse
+    totals = recorder.totals()
+    numberOfPairs = len(phantom['entries'].points) * len(Algorithms.getValidTargets(phantom['targets'], phantom['hippo']))
+    stages = dict((stage['name'], stage) for stage in summary.stages)
+    assert totals['constraintCalibration']['calls'] == 1
+    assert 0 < totals['constraintCalibration']['pairsIn'] <= 256
+    assert summary.order[0] == 'incisionLength' and stages['incisionLength']['pairsIn'] == numberOfPairs
+    assert stages[summary.order[1]]['pairsIn'] == stages['incisionLength']['pairsOut']
+
+
+def testSessionRanksLikeThePlan():
+    phantom = Benchmark.makePhantom(32, 40, 20)
+    nodes = [phantom[key] for key in ('hippo', 'ventricles', 'vessels', 'cortex', 'targets', 'entries')]
+    options = dict(normalMode='smooth', criterion='weighted', weights=(2.0, 1.0), k=2, approachAngle=70.0)
+    ranked, best, result = HeadlessPlanner.plan(*nodes + [55.0, 0.01, 40.0], **options)
+    session = PlanningSession.PlanningSession(*nodes + [55.0, 0.01, 40.0], **options)
+    # the plan indexes only the targets inside the hippocampus, the session all of them
+    coordinates = lambda trajectories: sorted(np.hstack([trajectories.entryPoints(), trajectories.targetPoints()]).tolist())
+    valid = session.trajectories()
+    lengths = MathTools.getDistancesBetweenPoints(valid.entryPoints(), valid.targetPoints())
+    assert coordinates(valid.filter(lengths <= 40.0)) == coordinates(result.trajectories)
+    top = session.topTrajectoriesPerEntry()
+    assert list(top) == list(best) and all(best[entry] == [target for _, target in top[entry]] for entry in best)
+
+    # an entry moved along the shell recomputes its pairs with the targets inside the hippocampus only,
+    # and the session then plans like a run from scratch
+    targets = phantom['targets'].points.copy()
+    assert session.updatePoints(phantom['entries'].points, targets) == 0
+    entries = phantom['entries'].points.copy()
+    entries[3] = 16.0 + (entries[3] - 16.0)[[1, 0, 2]]
+    inside = Algorithms.getValidTargets(phantom['targets'], phantom['hippo'])
+    assert 0 < session.updatePoints(entries, targets) == len(inside) < len(targets)
+    movedEntries = HeadlessPlanner.FiducialList(entries, 'movedEntries')
+    ranked, best, result = HeadlessPlanner.plan(*nodes[:5] + [movedEntries, 55.0, 0.01, 40.0], **options)
+    valid = session.trajectories()
+    lengths = MathTools.getDistancesBetweenPoints(valid.entryPoints(), valid.targetPoints())
+    assert coordinates(valid.filter(lengths <= 40.0)) == coordinates(result.trajectories)
+    top = session.topTrajectoriesPerEntry()
+    assert list(top) == list(best) and all(best[entry] == [target for _, target in top[entry]] for entry in best)
+
+    # a target moved out of the hippocampus recomputes no pair but leaves the plan
+    targets[0] = (1000.0, 1000.0, 1000.0)
+    assert session.updatePoints(entries, targets) == 0
+    assert not session.validMask()[:, 0].any()
+
+
+def testBackgroundJobPlansFromItsOwnCopies():
+    phantom = Benchmark.makePhantom(32, 40, 20)
+    nodes = [phantom[key] for key in ('hippo', 'ventricles', 'vessels', 'cortex')]
+    job = BackgroundPlanner.PlanningJob(*nodes + [phantom['targets'].points, phantom['entries'].points, 55.0, 0.01, 40.0],
+                                        chunkSize=200)
+    # the worker thread only sees the copies, clearing the live volume afterwards changes nothing
+    assert all(copy.GetImageData() is not node.GetImageData() for copy, node in
+               zip((job.hippo, job.ventricles, job.vessels, job.cortex), nodes))
+    VolumeTools.getLabelArray(phantom['vessels'])[:] = 0
+    phantom['vessels'].GetImageData().Modified()
+    job.start().wait()
+    jobBest, best = {}, {}
+    messages = job.poll()
+    for message in messages[:-1]:
+        best = BackgroundPlanner.mergeBest(jobBest, message['best'])
+    assert messages[-1]['type'] == 'finished' and not messages[-1]['cancelled']
+    phantom = Benchmark.makePhantom(32, 40, 20)
+    expected = HeadlessPlanner.plan(*[phantom[key] for key in ('hippo', 'ventricles', 'vessels', 'cortex', 'targets', 'entries')]
+                                    + [55.0, 0.01, 40.0])[1]
+    assert best == expected and list(best) == list(expected)
+
+
+def countInSpan(name):
+    with Instrumentation.span(name):
+        Instrumentation.count('calls')
+
+def testSpansNestAndCountersAddUp():
+    recorder = Instrumentation.Recorder(memory=True)
+    with Instrumentation.recording(recorder):
+        with Instrumentation.span('outer', pairsIn=10) as counters:
+            with Instrumentation.span('inner', pairsIn=4):
+                kept = np.ones(1 << 20)
+            with Instrumentation.span('inner', pairsIn=6):
+                Instrumentation.count('calls', 2)
+            counters['pairsOut'] = 3
+            # another thread starts its own stack
+            thread = threading.Thread(target=countInSpan, args=('other',), name='worker')
+            thread.start()
+            thread.join()
+    assert Instrumentation.getRecorder().enabled is False
+    spans = dict((record['name'], record) for record in recorder.spans)
+    assert spans['other']['depth'] == 0 and spans['other']['thread'] == 'worker'
+    inner = [record for record in recorder.spans if record['name'] == 'inner']
+    assert spans['outer']['depth'] == 0 and [record['depth'] for record in inner] == [1, 1]
+    assert all(spans['outer']['start'] <= record['start'] and record['start'] + record['seconds'] <=
+               spans['outer']['start'] + spans['outer']['seconds'] for record in inner)
+    # the peak of a child is part of its parent's
+    assert spans['outer']['peakTracedBytes'] >= inner[0]['peakTracedBytes'] >= kept.nbytes
+    totals = recorder.totals()
+    assert list(totals) == ['outer', 'inner', 'other'] and totals['other']['calls'] == 1
+    assert totals['inner']['calls'] == 2 and totals['inner']['pairsIn'] == 10
+    assert totals['outer'] == dict(totals['outer'], calls=1, pairsIn=10, pairsOut=3)
+    assert abs(totals['inner']['seconds'] - sum(record['seconds'] for record in inner)) < 1e-9
+    assert recorder.counters == {'calls': 3}
+    events = recorder.chromeTrace()['traceEvents']
+    assert sorted(event['name'] for event in events if event['ph'] == 'X') == ['inner', 'inner', 'other', 'outer']
+    assert [event['args'] for event in events if event['ph'] == 'C'] == [{'calls': 3}]
+
+
+def testPlanSpansMatchTheResult():
+    phantom = Benchmark.makePhantom(32, 40, 20)
+    recorder = Instrumentation.Recorder()
+    with Instrumentation.recording(recorder):
+        ranked, best, result = HeadlessPlanner.plan(*[phantom[key] for key in ('hippo', 'ventricles', 'vessels', 'cortex',
+                                                                               'targets', 'entries')] + [55.0, 0.01, 40.0])
+    spans = sorted(recorder.spans, key=lambda record: record['start'])
+    totals = recorder.totals()
+    targets = totals['targetFilter']['pairsOut']
+    assert totals['targetFilter']['pairsIn'] == len(phantom['targets'].points)
+    # the length prefilter sees every pair, the first constraint every pair it kept that the
+    # calibration sample did not resolve, after it every constraint the pairs the one before kept
+    assert totals['prefilter.incisionLength']['pairsIn'] == targets * len(phantom['entries'].points)
+    constraints = [record['counters'] for record in spans if record['name'].startswith('constraint.')]
+    assert constraints[0]['pairsIn'] + totals['constraintCalibration']['pairsIn'] == totals['prefilter.incisionLength']['pairsOut']
+    assert all(before['pairsOut'] == after['pairsIn'] for before, after in zip(constraints, constraints[1:]))
+    # incisions longer than the maximum never reach the surface queries or the scoring
+    assert totals['distanceScoring']['pairsIn'] == len(result.trajectories) == len(ranked)
+    scoring = [record for record in spans if record['name'] == 'distanceScoring'][0]
+    assert all(record['depth'] == scoring['depth'] + 1 for record in spans
+               if scoring['start'] < record['start'] < scoring['start'] + scoring['seconds'])
+    assert recorder.counters['meshCache.misses'] == totals['meshBuild']['calls'] == 3
+
+
+def testBinaryExportReadsBackTheRanking(tmp_path):
+    phantom = Benchmark.makePhantom(32, 40, 20)
+    exported = str(tmp_path / 'planned.traj')
+    ranked, best, result = HeadlessPlanner.plan(*[phantom[key] for key in ('hippo', 'ventricles', 'vessels', 'cortex',
+                                                                           'targets', 'entries')] + [55.0, 0.01, 40.0],
+                                                export=exported)
+    path = str(tmp_path / 'plan.traj')
+    # small chunks so the records are streamed in several writes
+    written = Algorithms.exportTrajectories(path, 0.01, 40.0, result.trajectories, phantom['vessels'], phantom['ventricles'],
+                                            chunkSize=97, metadata={'case': 'phantom'})
+    planned = TrajectoryFile.readTrajectories(path)
+    assert written == len(planned) == len(ranked)
+    assert isinstance(planned.records, np.memmap) and planned.metadata == {'case': 'phantom'}
+    records = planned.ranked()
+    assert np.allclose(records['score'], [score for score, _ in ranked])
+    assert np.allclose(records['distances'].sum(axis=1), records['score'])
+    assert planned.trajectories(planned.order[:1]).toDict() == {tuple(ranked[0][1][0]): [ranked[0][1][1]]}
+    # the plan writes the same records while it ranks, without scoring again
+    assert np.array_equal(TrajectoryFile.readTrajectories(exported).ranked(), records)
+
+
+def perLinePolyData(entriesAndTargets):
+    # the builder printEntryAndTargetsInDict used before, two new points per line
+    points = vtk.vtkPoints()
+    lines = vtk.vtkCellArray()
+    for entry, targets in entriesAndTargets.items():
+        entryId = points.InsertNextPoint(entry[0], entry[1], entry[2])
+        for target in targets:
+            targetInd = points.InsertNextPoint(target[0], target[1], target[2])
+            line = vtk.vtkLine()
+            line.GetPointIds().SetId(0, entryId)
+            line.GetPointIds().SetId(1, targetInd)
+            lines.InsertNextCell(line)
+    paths = vtk.vtkPolyData()
+    paths.SetPoints(points)
+    paths.SetLines(lines)
+    return paths
+
+def lineSegments(polyData):
+    # (L,6) entry and target coordinates of every line, in cell order
+    points = np.array([polyData.GetPoint(index) for index in range(polyData.GetNumberOfPoints())])
+    ids = vtk.vtkIdList()
+    segments = []
+    for cellId in range(polyData.GetNumberOfCells()):
+        polyData.GetCellPoints(cellId, ids)
+        segments.append(np.concatenate([points[ids.GetId(0)], points[ids.GetId(1)]]))
+    return np.array(segments).reshape(-1, 6)
+
+class LegacyCellArray(vtk.vtkCellArray):
+
+    @property
+    def SetData(self):
+        raise AttributeError('SetData')
+
+@pytest.mark.parametrize('legacy', [False, True])
+def testPathsMatchThePerLineBuild(monkeypatch, legacy):
+    if legacy:
+        monkeypatch.setattr(vtk, 'vtkCellArray', LegacyCellArray)
+    phantom = Benchmark.makePhantom(32, 40, 20)
+    nodes = [phantom[key] for key in ('hippo', 'ventricles', 'vessels', 'cortex', 'targets', 'entries')]
+    result = HeadlessPlanner.plan(*nodes + [55.0, 0.01, 40.0])[2]
+    expected = perLinePolyData(result.trajectories.toDict())
+    paths = Algorithms.printEntryAndTargetsInDict(result.trajectories)
+    assert paths.GetNumberOfLines() == expected.GetNumberOfLines() == len(result.trajectories)
+    # every entry and target is one shared point
+    assert paths.GetNumberOfPoints() == len(np.unique(result.trajectories.pairs[:, 0])) + \
+        len(np.unique(result.trajectories.pairs[:, 1]))
+    # the per-line build stored float32 points
+    assert sorted(lineSegments(paths).astype(np.float32).tolist()) == sorted(lineSegments(expected).astype(np.float32).tolist())
+
+    # the session's cell arrays follow its lines, one per entry with k=1
+    session = PlanningSession.PlanningSession(*nodes + [55.0, 0.01, 40.0])
+    paths = session.pathsPolyData()
+    segments = lineSegments(paths)
+    cellData = paths.GetCellData()
+    assert cellData.GetScalars().GetName() == 'score'
+    lengths = np.array([cellData.GetArray('length').GetValue(index) for index in range(len(segments))])
+    assert np.allclose(lengths, np.linalg.norm(segments[:, :3] - segments[:, 3:], axis=1))
+    best = session.bestTrajectoryForEachEntry()
+    assert sorted(segments.tolist()) == sorted(list(entry) + targets[0] for entry, targets in best.items())
+    # and the k of the session options otherwise
+    session = PlanningSession.PlanningSession(*nodes + [55.0, 0.01, 40.0], k=2)
+    top = session.topTrajectoriesPerEntry()
+    assert session.pathsPolyData().GetNumberOfLines() == sum(len(scored) for scored in top.values()) > len(top)
+
+
+def testTimeLimitWaitsForCacheWrites(tmp_path, monkeypatch):
+    volume = Benchmark.makePhantom(24, 10, 5)['ventricles']
+    cache = BatchPlanner.WorkerMeshCache(str(tmp_path))
+    previous = signal.signal(signal.SIGALRM, BatchPlanner.raiseTimeout)
+    save = np.save
+    # the time limit goes off between the two files of the entry
+    monkeypatch.setattr(np, 'save', lambda *arguments: save(*arguments) or os.kill(os.getpid(), signal.SIGALRM))
+    try:
+        with pytest.raises(BatchPlanner.CaseTimeout):
+            cache.getSurface(volume)
+    finally:
+        signal.signal(signal.SIGALRM, previous)
+    assert sorted(os.path.splitext(name)[1] for name in os.listdir(str(tmp_path))) == ['.npy', '.vtp']
+    monkeypatch.undo()
+    assert MeshCache.MeshCache(str(tmp_path)).readFromDisk(cache.contentKey(volume)) is not None
+
+
+def testBatchKeepsGoingPastATimeout(tmp_path):
+    cases = []
+    for name, size, timeLimit in (('planned', 32, None), ('late', 40, 1e-4)):
+        folder = tmp_path / name
+        folder.mkdir()
+        writePhantom(Benchmark.makePhantom(size, 40, 20), str(folder))
+        cases.append({'name': name, 'dataDir': name, 'angle': 60.0, 'timeLimit': timeLimit})
+    with open(str(tmp_path / 'cases.json'), 'w') as manifestFile:
+        json.dump({'cases': cases}, manifestFile)
+    output = tmp_path / 'results'
+    manifest = BatchPlanner.readManifest(str(tmp_path / 'cases.json'))
+    results = BatchPlanner.BatchPlanner(manifest, str(output), workers=2).run()
+    assert [result['status'] for result in results] == ['ok', 'timeout']
+    assert set(result['worker'] for result in results) == set([0, 1])
+    # the worker reports the files its store holds, which the scheduler matches cases against
+    assert set(results[0]['loadedPaths']) == BatchPlanner.inputPaths(manifest[0])
+
+    phantom = Benchmark.makePhantom(32, 40, 20)
+    ranked = HeadlessPlanner.plan(*[phantom[key] for key in ('hippo', 'ventricles', 'vessels', 'cortex', 'targets', 'entries')]
+                                  + [60.0, 0.01, 9999999999999.0])[0]
+    assert results[0]['rankedTrajectories'] == len(ranked) > 0
+    with open(str(output / 'batch.json')) as summaryFile:
+        assert json.load(summaryFile)['statuses'] == {'ok': 1, 'timeout': 1}
+    # no temporary or half written entry is left in the shared cache
+    cacheFiles = os.listdir(str(output / 'meshCache'))
+    assert cacheFiles and not [name for name in cacheFiles if name.startswith('.')]
+    # surfaces are <key>.vtp and <key>.npy, their locators <key>.<locator>.npz
+    keys = set(name.split('.')[0] for name in cacheFiles if os.path.splitext(name)[1] in ('.vtp', '.npy'))
+    assert all(MeshCache.MeshCache(str(output / 'meshCache')).readFromDisk(key) is not None for key in keys)
+    assert all(name.split('.')[0] in keys for name in cacheFiles if name.endswith('.npz'))